@@ -0,0 +1,96 @@
+"""Micro-benchmark: CPU cost of one room broadcast as the room grows.
+
+Compares the old path (``send_text`` per recipient, so the server re-encodes
+the string for every socket) with the shared Frame path used by FanOut (one
+UTF-8 encoding, as for an envelope, and one pre-built event per broadcast). The ASGI ``send`` stub
+does what uvicorn does with each event: encode text payloads and serialize a
+WebSocket frame.
+
+    python benchmarks/bench_broadcast.py --sizes 10 100 1000 5000 20000
+"""
+import argparse
+import asyncio
+import gc
+import os
+import sys
+import time
+
+from starlette.websockets import WebSocket, WebSocketState
+from websockets.frames import Frame as WireFrame, Opcode
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "server")))
+from common.fanout import Frame
+
+
+async def asgi_send(message):
+    """Stands in for the ASGI server: encode if needed, then frame the payload."""
+    if message.get("text") is not None:
+        WireFrame(Opcode.TEXT, message["text"].encode()).serialize(mask=False)
+    else:
+        WireFrame(Opcode.BINARY, message["bytes"]).serialize(mask=False)
+
+
+async def asgi_receive():
+    return {"type": "websocket.disconnect"}
+
+
+def make_clients(count: int):
+    clients = []
+    for _ in range(count):
+        ws = WebSocket({"type": "websocket", "path": "/ws/bench", "headers": []}, asgi_receive, asgi_send)
+        ws.application_state = WebSocketState.CONNECTED
+        ws.client_state = WebSocketState.CONNECTED
+        clients.append(ws)
+    return clients
+
+
+async def per_recipient_send_text(clients, message: str):
+    for ws in clients:
+        await ws.send_text(message)
+
+
+async def shared_frame(clients, message: str):
+    frame = Frame(message.encode("utf-8"))
+    for ws in clients:
+        await ws.send(frame.event)
+
+
+async def measure(fn, clients, message: str, repeat: int) -> float:
+    """Best-of CPU seconds for one broadcast."""
+    best = float("inf")
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            started = time.process_time()
+            await fn(clients, message)
+            best = min(best, time.process_time() - started)
+    finally:
+        gc.enable()
+    return best
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000, 5000, 20000])
+    parser.add_argument("--message-size", type=int, default=512, help="characters per message")
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+
+    # Mixed ASCII and multi-byte characters, like real chat text
+    message = ("alice: hello 👋 wörld " * args.message_size)[:args.message_size]
+
+    print(f"message: {args.message_size} chars, {len(message.encode())} bytes UTF-8")
+    print(f"{'room size':>10} {'send_text ms':>14} {'shared ms':>10} {'us/client old':>14} {'us/client new':>14} {'saved':>6}")
+    for size in args.sizes:
+        clients = make_clients(size)
+        old = await measure(per_recipient_send_text, clients, message, args.repeat)
+        new = await measure(shared_frame, clients, message, args.repeat)
+        saved = 100 * (1 - new / old) if old else 0.0
+        print(
+            f"{size:>10} {old * 1000:>14.2f} {new * 1000:>10.2f} "
+            f"{old / size * 1e6:>14.2f} {new / size * 1e6:>14.2f} {saved:>5.0f}%"
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
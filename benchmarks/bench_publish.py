@@ -0,0 +1,124 @@
+"""Benchmark: publishing bursts of chat messages to Redis, one round trip per message vs batched pipelines.
+
+Every room has --senders coroutines that each publish a burst of --burst
+messages at once, as a popular room does when many members post together.
+The "redis" broker awaits one PUBLISH per message; the "batching" broker
+collects publishes for up to --linger milliseconds into pipelines. Reports
+messages per second and the p50 / p99 / max time publish() takes. The "redis"
+broker needs a connection per concurrent publish, so its pool is sized to the
+number of senders. A subscriber on every room channel also checks that each
+sender's messages arrive complete and in order.
+
+    # Against a running Redis
+    python benchmarks/bench_publish.py --redis-url redis://127.0.0.1:6379
+    # Self-contained, with benchmarks/fake_redis.py
+    python benchmarks/bench_publish.py --fake-redis --rooms 10 --senders 50 --burst 20
+"""
+import argparse
+import asyncio
+import os
+import struct
+import sys
+import tempfile
+import time
+
+import redis.asyncio as redis
+
+from loadgen import BENCHMARKS_DIR, spawn
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "server")))
+from common.broker import create_broker
+
+# Message body: sender id and its message number
+BODY = struct.Struct("!II")
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+async def run(args, name: str, linger_ms: float):
+    # One connection per concurrent PUBLISH for the "redis" broker; redis-py's pool allows 100 by default
+    client = redis.from_url(args.redis_url, max_connections=args.rooms * args.senders + 10)
+    broker = create_broker(name, client, linger=linger_ms / 1000)
+    broker.start()
+    rooms = [f"bench-publish-{i}" for i in range(args.rooms)]
+    expected = args.senders * args.burst
+    received = {room: [] for room in rooms}
+    done = asyncio.Event()
+    remaining = [len(rooms)]
+
+    async def on_message(room, data):
+        received[room].append(BODY.unpack(data[-BODY.size:]))
+        if len(received[room]) == expected:
+            remaining[0] -= 1
+            if not remaining[0]:
+                done.set()
+
+    for room in rooms:
+        await broker.subscribe(room, lambda data, room=room: on_message(room, data))
+    await asyncio.sleep(0.2)
+
+    latencies = []
+
+    async def sender(room, sender_id):
+        for n in range(args.burst):
+            payload = os.urandom(args.message_size) + BODY.pack(sender_id, n)
+            started = time.perf_counter()
+            await broker.publish(room, payload)
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(sender(room, i) for room in rooms for i in range(args.senders)))
+    elapsed = time.perf_counter() - started
+    await asyncio.wait_for(done.wait(), 30)
+
+    for room, messages in received.items():
+        per_sender = {}
+        for sender_id, n in messages:
+            per_sender.setdefault(sender_id, []).append(n)
+        assert all(ns == list(range(args.burst)) for ns in per_sender.values()), f"{room}: out of order or lost"
+
+    await broker.close()
+    await client.aclose()
+    latencies.sort()
+    total = expected * len(rooms)
+    batches = f", {total / broker.stats.batches:.1f} msgs/pipeline" if broker.stats.batches else ""
+    print(
+        f"{name:>9} linger {linger_ms:>4.1f} ms: {total / elapsed:>9.0f} msg/s, publish p50 "
+        f"{1e3 * percentile(latencies, 0.5):.2f} ms p99 {1e3 * percentile(latencies, 0.99):.2f} ms "
+        f"max {1e3 * latencies[-1]:.2f} ms{batches}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--redis-url", default="redis://127.0.0.1:6379")
+    parser.add_argument("--fake-redis", action="store_true", help="Start benchmarks/fake_redis.py on --redis-port")
+    parser.add_argument("--redis-port", type=int, default=6381)
+    parser.add_argument("--rooms", type=int, default=10)
+    parser.add_argument("--senders", type=int, default=50, help="Concurrent senders per room")
+    parser.add_argument("--burst", type=int, default=20, help="Messages each sender publishes back to back")
+    parser.add_argument("--message-size", type=int, default=100)
+    parser.add_argument("--linger", type=float, nargs="+", default=[0, 1, 5], help="Linger windows to try, in ms")
+    args = parser.parse_args()
+
+    server = None
+    if args.fake_redis:
+        workdir = tempfile.mkdtemp(prefix="bench-publish-")
+        server = spawn([sys.executable, os.path.join(BENCHMARKS_DIR, "fake_redis.py"), "--port", str(args.redis_port)],
+                       workdir, dict(os.environ), os.path.join(workdir, "fake_redis.log"), args.redis_port)
+        args.redis_url = f"redis://127.0.0.1:{args.redis_port}"
+    try:
+        asyncio.run(run(args, "redis", 0))
+        for linger in args.linger:
+            asyncio.run(run(args, "batching", linger))
+        print("every sender's messages arrived complete and in order")
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == "__main__":
+    main()
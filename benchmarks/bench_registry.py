@@ -0,0 +1,142 @@
+"""Micro-benchmark: connection churn in the registry.
+
+Connects N clients and disconnects them in random order, once in a single room
+(the worst case for the previous per-room lists, where every leave was an O(n)
+``list.remove``) and once spread over rooms of --room-size while clients keep
+joining and leaving. The list-based layout is timed alongside for sizes up to
+--baseline-max. The registry's consistency under the same churn is checked by
+tests/test_registry.py.
+
+    python benchmarks/bench_registry.py --connections 100000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "server")))
+from common.registry import ConnectionRegistry
+
+
+class ListRooms:
+    """The previous layout: {room: {"clients": [websocket, ...]}} with list.remove on leave."""
+
+    def __init__(self):
+        self.rooms = {}
+
+    def connect(self, room, websocket):
+        self.rooms.setdefault(room, {"clients": []})["clients"].append(websocket)
+
+    def disconnect(self, room, websocket):
+        clients = self.rooms[room]["clients"]
+        clients.remove(websocket)
+        if not clients:
+            del self.rooms[room]
+
+
+def single_room(n: int, seed: int):
+    websockets = [object() for _ in range(n)]
+    order = websockets[:]
+    random.Random(seed).shuffle(order)
+
+    registry = ConnectionRegistry()
+    start = time.perf_counter()
+    connections = {ws: registry.connect("big", ws, f"user{i}")[0] for i, ws in enumerate(websockets)}
+    joined = time.perf_counter()
+    for ws in order:
+        registry.disconnect(connections[ws])
+    return joined - start, time.perf_counter() - joined
+
+
+def single_room_lists(n: int, seed: int):
+    websockets = [object() for _ in range(n)]
+    order = websockets[:]
+    random.Random(seed).shuffle(order)
+    rooms = ListRooms()
+    start = time.perf_counter()
+    for ws in websockets:
+        rooms.connect("big", ws)
+    joined = time.perf_counter()
+    for ws in order:
+        rooms.disconnect("big", ws)
+    return joined - start, time.perf_counter() - joined
+
+
+def churn(n: int, room_size: int, operations: int, seed: int):
+    """Fill rooms of `room_size` to n connections, then mix random joins and leaves."""
+    rng = random.Random(seed)
+    room_count = max(1, n // room_size)
+    users = max(1, n // 2)  # so that some users hold several connections
+    registry = ConnectionRegistry()
+    live = {}
+    connections = {}
+
+    def join():
+        ws = object()
+        room, username = f"room{rng.randrange(room_count)}", f"user{rng.randrange(users)}"
+        connections[ws] = registry.connect(room, ws, username)[0]
+        live[ws] = (room, username)
+
+    for _ in range(n):
+        join()
+
+    sockets = list(live)
+    start = time.perf_counter()
+    for _ in range(operations):
+        if rng.random() < 0.5 and sockets:
+            # Swap-remove a random socket from the sample list
+            i = rng.randrange(len(sockets))
+            sockets[i], sockets[-1] = sockets[-1], sockets[i]
+            ws = sockets.pop()
+            registry.disconnect(connections.pop(ws))
+            del live[ws]
+        else:
+            join()
+            sockets.append(next(reversed(live)))
+    return time.perf_counter() - start
+
+
+def memory_per_connection(n: int, room_size: int) -> float:
+    websockets = [object() for _ in range(n)]
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    registry = ConnectionRegistry()
+    for i, ws in enumerate(websockets):
+        registry.connect(f"room{i // room_size}", ws, f"user{i}")
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return used / n
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--connections", type=int, default=100_000)
+    parser.add_argument("--room-size", type=int, default=100)
+    parser.add_argument("--operations", type=int, default=200_000, help="joins and leaves in the churn phase")
+    parser.add_argument("--baseline-max", type=int, default=20_000, help="largest room timed with the list layout")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    n = args.connections
+
+    join_s, leave_s = single_room(n, args.seed)
+    print(f"one room of {n}: join {1e6 * join_s / n:.2f} us/conn, leave {1e6 * leave_s / n:.2f} us/conn (registry)")
+    for size in sorted({min(n, 1000), min(n, 5000), min(n, args.baseline_max)}):
+        list_join, list_leave = single_room_lists(size, args.seed)
+        _, reg_leave = single_room(size, args.seed)
+        print(
+            f"one room of {size}: leave {1e6 * list_leave / size:.2f} us/conn with lists, "
+            f"{1e6 * reg_leave / size:.2f} us/conn with the registry"
+        )
+
+    elapsed = churn(n, args.room_size, args.operations, args.seed)
+    print(
+        f"churn at {n} connections in rooms of {args.room_size}: "
+        f"{args.operations} joins/leaves, {1e6 * elapsed / args.operations:.2f} us/op"
+    )
+    print(f"memory: {memory_per_connection(n, args.room_size):.0f} bytes/connection (registry, rooms of {args.room_size})")
+
+
+if __name__ == "__main__":
+    main()
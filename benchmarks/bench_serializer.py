@@ -0,0 +1,93 @@
+"""Micro-benchmark: per-message cost of JSON parsing and serialization by backend.
+
+Runs the same payloads through common/serializer.py once per installed backend
+(orjson, msgspec and the standard library, selected like CHAT_JSON does) and
+reports microseconds per operation and the saving against the standard library:
+
+- parse:    a chat message as received from a WebSocket text frame
+- digest:   a presence digest encoded into an envelope body
+- history:  a GET /history page of envelopes rendered as a response body
+
+    python benchmarks/bench_serializer.py --page-size 100 --message-size 80
+"""
+import argparse
+import importlib
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "server")))
+from common import serializer
+from common.envelope import MESSAGE, Envelope
+
+
+def load_backend(name: str):
+    """The serializer module configured for one backend, or None if it is not installed."""
+    os.environ["CHAT_JSON"] = name
+    try:
+        return importlib.reload(serializer)
+    except ImportError:
+        return None
+    finally:
+        del os.environ["CHAT_JSON"]
+
+
+def per_op_us(fn, min_seconds: float = 0.5) -> float:
+    """Microseconds per call of `fn`, timed over at least `min_seconds`."""
+    count = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(count):
+            fn()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_seconds:
+            return 1e6 * elapsed / count
+        count *= 2
+
+
+def workloads(args):
+    text = ("héllo wörld " * (args.message_size // 12 + 1))[:args.message_size]
+    frame = serializer.dumps_str({"username": "alice", "message": text})
+    digest = {"joined": [f"user{i}" for i in range(20)], "left": ["bob", "carol"], "count": 1234}
+    page = {
+        "chat_room": "bench",
+        "messages": [Envelope(MESSAGE, "bench", text, f"user{i % 50}", seq=i + 1).to_dict() for i in range(args.page_size)],
+        "next_before": 1,
+    }
+    return [
+        ("parse", lambda backend: lambda: backend.loads(frame)),
+        ("digest", lambda backend: lambda: backend.dumps_str(digest)),
+        ("history", lambda backend: lambda: backend.JSONResponse(page).body),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--page-size", type=int, default=100, help="messages in the history page")
+    parser.add_argument("--message-size", type=int, default=80, help="characters per chat message")
+    parser.add_argument("--seconds", type=float, default=0.5, help="minimum timing per measurement")
+    args = parser.parse_args()
+
+    cases = workloads(args)
+    # Measured right after loading each backend: reloading rebinds the module's functions
+    results = {}
+    for name in serializer.BACKENDS:
+        backend = load_backend(name)
+        if backend is None:
+            print(f"{name}: not installed, skipped")
+            continue
+        for label, make in cases:
+            results[label, name] = per_op_us(make(backend), args.seconds)
+    importlib.reload(serializer)
+
+    print(f"{'workload':>10} {'backend':>8} {'us/op':>10} {'vs json':>8}")
+    for label, _ in cases:
+        baseline = results[label, "json"]
+        for name in serializer.BACKENDS:
+            if (label, name) in results:
+                us = results[label, name]
+                print(f"{label:>10} {name:>8} {us:>10.2f} {1 - us / baseline:>7.0%}")
+
+
+if __name__ == "__main__":
+    main()
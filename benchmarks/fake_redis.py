@@ -0,0 +1,246 @@
+"""A minimal local Redis stand-in for running the chat servers without Redis.
+
+Speaks enough RESP2 and RESP3 (negotiated with HELLO, as redis-py does) for
+the servers' use of redis-py's asyncio client: pub/sub (PUBLISH / SUBSCRIBE /
+UNSUBSCRIBE), strings and counters (GET / SET / INCR / INCRBY / DEL), hashes
+(HSET / HSETNX / HGET / HGETALL / HEXISTS / HDEL / HLEN), PING and ECHO. Keys never expire. Any other command gets an error reply, which
+redis-py tolerates for the CLIENT SETINFO it sends on connect. Nothing is
+persisted.
+
+    python benchmarks/fake_redis.py --port 6380
+    REDIS_PORT=6380 uvicorn app:app ...            # history service
+    REDIS_URL=redis://localhost:6380 uvicorn ...   # trial server
+"""
+import argparse
+import asyncio
+from typing import Dict, List, Optional, Set
+
+
+def bulk(value: bytes) -> bytes:
+    return b"$%d\r\n%s\r\n" % (len(value), value)
+
+
+def array(*items: bytes) -> bytes:
+    return b"*%d\r\n" % len(items) + b"".join(items)
+
+
+def push(*items: bytes) -> bytes:
+    """Out-of-band message: a push type in RESP3, a plain array in RESP2."""
+    return b">%d\r\n" % len(items) + b"".join(items)
+
+
+def integer(value: int) -> bytes:
+    return b":%d\r\n" % value
+
+
+NIL = b"$-1\r\n"
+
+HASH_COMMANDS = {b"HSET", b"HSETNX", b"HGET", b"HGETALL", b"HEXISTS", b"HDEL", b"HLEN"}
+STRING_COMMANDS = {b"GET", b"SET", b"INCR", b"INCRBY", b"DEL"}
+
+
+class Client:
+    __slots__ = ("writer", "protocol", "subscribed")
+
+    def __init__(self, writer: asyncio.StreamWriter):
+        self.writer = writer
+        self.protocol = 2
+        self.subscribed: Set[bytes] = set()
+
+    def push(self, *items: bytes) -> bytes:
+        return push(*items) if self.protocol == 3 else array(*items)
+
+    def map(self, *items: bytes) -> bytes:
+        """Alternating keys and values: a map type in RESP3, a flat array in RESP2."""
+        if self.protocol == 3:
+            return b"%%%d\r\n" % (len(items) // 2) + b"".join(items)
+        return array(*items)
+
+
+class ProtocolError(Exception):
+    pass
+
+
+async def read_command(reader: asyncio.StreamReader) -> Optional[List[bytes]]:
+    """One command as a list of arguments, or None at end of stream."""
+    line = await reader.readline()
+    if not line:
+        return None
+    if not line.startswith(b"*"):
+        # Inline command, e.g. typed into telnet
+        return line.split()
+    args = []
+    for _ in range(int(line[1:])):
+        header = await reader.readline()
+        if not header.startswith(b"$"):
+            raise ProtocolError("expected bulk string")
+        data = await reader.readexactly(int(header[1:]) + 2)
+        args.append(data[:-2])
+    return args
+
+
+class FakeRedis:
+    def __init__(self):
+        self.channels: Dict[bytes, Set[Client]] = {}
+        self.hashes: Dict[bytes, Dict[bytes, bytes]] = {}
+        self.strings: Dict[bytes, bytes] = {}
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        client = Client(writer)
+        try:
+            while True:
+                try:
+                    args = await read_command(reader)
+                except (ProtocolError, ValueError, asyncio.IncompleteReadError):
+                    break
+                if args is None:
+                    break
+                if not args:
+                    continue
+                writer.write(self.execute(client, args))
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            for channel in client.subscribed:
+                self._remove(channel, client)
+            writer.close()
+
+    def execute(self, client: Client, args: List[bytes]) -> bytes:
+        command = args[0].upper()
+        subscribed = client.subscribed
+        if command == b"HELLO":
+            if len(args) > 1:
+                if args[1] not in (b"2", b"3"):
+                    return b"-NOPROTO unsupported protocol version\r\n"
+                client.protocol = int(args[1])
+            return client.map(bulk(b"server"), bulk(b"redis"), bulk(b"version"), bulk(b"7.0.0"),
+                              bulk(b"proto"), integer(client.protocol))
+        if command == b"PUBLISH" and len(args) == 3:
+            return integer(self.publish(args[1], args[2]))
+        if command == b"SUBSCRIBE" and len(args) > 1:
+            replies = []
+            for channel in args[1:]:
+                subscribed.add(channel)
+                self.channels.setdefault(channel, set()).add(client)
+                replies.append(client.push(bulk(b"subscribe"), bulk(channel), integer(len(subscribed))))
+            return b"".join(replies)
+        if command == b"UNSUBSCRIBE":
+            channels = args[1:] or sorted(subscribed)
+            if not channels:
+                return client.push(bulk(b"unsubscribe"), NIL, integer(0))
+            replies = []
+            for channel in channels:
+                subscribed.discard(channel)
+                self._remove(channel, client)
+                replies.append(client.push(bulk(b"unsubscribe"), bulk(channel), integer(len(subscribed))))
+            return b"".join(replies)
+        if command in HASH_COMMANDS:
+            return self.hash_command(client, command, args)
+        if command in STRING_COMMANDS:
+            return self.string_command(command, args)
+        if command == b"PING":
+            if subscribed and client.protocol == 2:
+                return array(bulk(b"pong"), bulk(args[1] if len(args) > 1 else b""))
+            return bulk(args[1]) if len(args) > 1 else b"+PONG\r\n"
+        if command == b"ECHO" and len(args) == 2:
+            return bulk(args[1])
+        return b"-ERR unknown command '%s'\r\n" % args[0]
+
+    def string_command(self, command: bytes, args: List[bytes]) -> bytes:
+        if command == b"GET" and len(args) == 2:
+            value = self.strings.get(args[1])
+            return NIL if value is None else bulk(value)
+        if command == b"SET" and len(args) >= 3:
+            # Options other than NX (e.g. EX / PX) are accepted and ignored
+            if b"NX" in (arg.upper() for arg in args[3:]) and args[1] in self.strings:
+                return NIL
+            self.strings[args[1]] = args[2]
+            return b"+OK\r\n"
+        if command in (b"INCR", b"INCRBY") and len(args) == (2 if command == b"INCR" else 3):
+            try:
+                value = int(self.strings.get(args[1], b"0")) + (int(args[2]) if command == b"INCRBY" else 1)
+            except ValueError:
+                return b"-ERR value is not an integer or out of range\r\n"
+            self.strings[args[1]] = b"%d" % value
+            return integer(value)
+        if command == b"DEL" and len(args) >= 2:
+            removed = 0
+            for key in args[1:]:
+                removed += self.strings.pop(key, None) is not None or self.hashes.pop(key, None) is not None
+            return integer(removed)
+        return b"-ERR wrong number of arguments for '%s'\r\n" % command.lower()
+
+    def hash_command(self, client: Client, command: bytes, args: List[bytes]) -> bytes:
+        if len(args) < 2:
+            return b"-ERR wrong number of arguments\r\n"
+        fields = self.hashes.get(args[1], {})
+        if command == b"HSET" and len(args) >= 4 and len(args) % 2 == 0:
+            added = 0
+            for field, value in zip(args[2::2], args[3::2]):
+                added += field not in fields
+                fields[field] = value
+            self.hashes[args[1]] = fields
+            return integer(added)
+        if command == b"HSETNX" and len(args) == 4:
+            if args[2] in fields:
+                return integer(0)
+            fields[args[2]] = args[3]
+            self.hashes[args[1]] = fields
+            return integer(1)
+        if command == b"HGET" and len(args) == 3:
+            value = fields.get(args[2])
+            return NIL if value is None else bulk(value)
+        if command == b"HGETALL" and len(args) == 2:
+            return client.map(*(bulk(item) for pair in fields.items() for item in pair))
+        if command == b"HEXISTS" and len(args) == 3:
+            return integer(args[2] in fields)
+        if command == b"HDEL" and len(args) >= 3:
+            removed = sum(fields.pop(field, None) is not None for field in args[2:])
+            if not fields:
+                self.hashes.pop(args[1], None)
+            return integer(removed)
+        if command == b"HLEN" and len(args) == 2:
+            return integer(len(fields))
+        return b"-ERR wrong number of arguments for '%s'\r\n" % command.lower()
+
+    def publish(self, channel: bytes, data: bytes) -> int:
+        subscribers = self.channels.get(channel)
+        if not subscribers:
+            return 0
+        # The message is encoded once and shared by every subscriber of the same protocol
+        items = (bulk(b"message"), bulk(channel), bulk(data))
+        encoded = {2: array(*items), 3: push(*items)}
+        for subscriber in subscribers:
+            subscriber.writer.write(encoded[subscriber.protocol])
+        return len(subscribers)
+
+    def _remove(self, channel: bytes, client: Client):
+        subscribers = self.channels.get(channel)
+        if subscribers is not None:
+            subscribers.discard(client)
+            if not subscribers:
+                del self.channels[channel]
+
+
+async def serve(host: str, port: int):
+    fake = FakeRedis()
+    server = await asyncio.start_server(fake.handle, host, port)
+    print(f"Fake Redis listening on {host}:{port}", flush=True)
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6380)
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,416 @@
+"""Headless load generator for the WebSocket chat servers.
+
+Opens ``--rooms`` x ``--room-size`` WebSocket clients against the history
+service (server/history_service/app.py), the chat gateway
+(server/chat_service/chat_service.py) or the trial server (trial/server.py).
+In every room the members take turns sending time-stamped messages at
+``--rate`` messages per second, and every client records how long each stamped
+message took to reach it. Reports p50 / p99 / p999 end-to-end delivery latency,
+messages per second and the server's resident memory.
+
+    # Self-contained: start a fake Redis and the server, then load them
+    python benchmarks/loadgen.py --target history --spawn --fake-redis \\
+        --rooms 20 --room-size 100 --rate 10 --duration 30
+
+    # One chat gateway; --spawn also starts a history consumer to save and publish the messages
+    python benchmarks/loadgen.py --target gateway --spawn --fake-redis --rooms 50 --room-size 100
+
+    # A single process without Redis at all (in-process message bus)
+    python benchmarks/loadgen.py --target history --spawn --broker inprocess
+
+    # An already running server; pass its pid to sample its RSS
+    python benchmarks/loadgen.py --target trial --url http://127.0.0.1:8000 --server-pid 1234
+
+Load is generated open-loop: a message's timestamp is the time it was scheduled
+to be sent, so a client that falls behind shows up as latency instead of
+silently sending less. Several generator processes (``--processes``) keep the
+generator itself from becoming the bottleneck; latencies are comparable across
+them because they share the system's monotonic clock.
+
+Both servers rate-limit incoming messages per room (ROOM_MESSAGE_RATE, 200/s by
+default) and per connection; messages they drop count as undelivered. Raise the
+limits or set them to 0 in the environment for runs above that rate.
+
+With AUTH_KEYS in the environment (as for the servers), every client connects
+with a token signed by the first key instead of ?username=.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+from array import array
+
+import websockets
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "server")))
+from common.tokens import TokenSigner, parse_keys
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+
+# Marker carried by every measured message: "@lg:<scheduled send time in ns>"
+STAMP = re.compile(rb"@lg:(\d+)")
+
+TARGETS = {
+    # target -> (uvicorn app dir, uvicorn app, default port)
+    "history": (os.path.join(REPO_DIR, "server", "history_service"), "app:app", 5000),
+    "gateway": (os.path.join(REPO_DIR, "server", "chat_service"), "chat_service:app", 5001),
+    "trial": (os.path.join(REPO_DIR, "trial"), "server:app", 8000),
+}
+
+
+def raise_open_file_limit():
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+# ====== Server side: spawning and memory sampling ======
+
+def port_in_use(host, port):
+    try:
+        with socket.create_connection((host, port), timeout=1.0):
+            return True
+    except OSError:
+        return False
+
+
+def spawn(command, cwd, env, log_path, port, timeout=30.0):
+    """Start a server process and wait until it listens on `port`."""
+    if port_in_use("127.0.0.1", port):
+        raise RuntimeError(f"Port {port} is already in use; stop whatever is listening there first")
+    log = open(log_path, "wb")
+    process = subprocess.Popen(command, cwd=cwd, env=env, stdout=log, stderr=subprocess.STDOUT)
+    deadline = time.monotonic() + timeout
+    while not port_in_use("127.0.0.1", port):
+        if process.poll() is not None or time.monotonic() > deadline:
+            process.kill()
+            raise RuntimeError(f"Server did not start; see {log_path}")
+        time.sleep(0.1)
+    return process
+
+
+def process_tree(pid):
+    """The pid and all of its descendants (uvicorn --workers runs the app in child processes)."""
+    pids = [pid]
+    for current in pids:
+        try:
+            tasks = os.listdir(f"/proc/{current}/task")
+        except OSError:
+            continue
+        for tid in tasks:
+            try:
+                with open(f"/proc/{current}/task/{tid}/children") as f:
+                    pids.extend(int(child) for child in f.read().split())
+            except OSError:
+                pass
+    return pids
+
+
+def rss_bytes(pid):
+    """Resident memory of a process and its descendants, or None if it cannot be read."""
+    total = 0
+    found = False
+    for current in process_tree(pid):
+        try:
+            with open(f"/proc/{current}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) * 1024
+                        found = True
+                        break
+        except OSError:
+            pass
+    return total if found else None
+
+
+# ====== Client side ======
+
+def create_rooms(base_url, rooms, signer=None):
+    """The history service only accepts WebSocket clients for rooms created over REST."""
+    headers = {"Content-Type": "application/json"}
+    if signer is not None:
+        headers["Authorization"] = f"Bearer {signer.issue('loadgen')[0]}"
+    for room in rooms:
+        request = urllib.request.Request(
+            f"{base_url}/create-chat-room",
+            data=json.dumps({"username": "loadgen", "chat_room_name": room}).encode(),
+            headers=headers,
+        )
+        with urllib.request.urlopen(request, timeout=30) as response:
+            response.read()
+
+
+def client_url(args, room, name):
+    ws_base = re.sub(r"^http", "ws", args.url)
+    if args.target in ("history", "gateway"):
+        if args.signer is not None:
+            return f"{ws_base}/ws/{room}?token={args.signer.issue(name)[0]}"
+        return f"{ws_base}/ws/{room}?username={name}"
+    return f"{ws_base}/ws/{room}/{name}"
+
+
+def outgoing(args, name, stamp):
+    text = f"hello from {name} @lg:{stamp}"
+    if args.target in ("history", "gateway"):
+        return json.dumps({"message": text})
+    return text
+
+
+class Results:
+    def __init__(self):
+        self.connected = 0
+        self.failed = 0
+        self.sent = 0
+        self.expected = 0
+        self.delivered = 0
+        self.errors = 0
+        self.latencies = array("q")  # microseconds
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+
+async def receive(ws, results, window):
+    """Record the latency of every stamped message sent inside the measurement window."""
+    try:
+        async for data in ws:
+            if isinstance(data, str):
+                data = data.encode()
+            received = time.monotonic_ns()
+            for match in STAMP.finditer(data):
+                stamp = int(match.group(1))
+                if window[0] <= stamp < window[1]:
+                    results.delivered += 1
+                    results.latencies.append((received - stamp) // 1000)
+    except websockets.ConnectionClosed:
+        pass
+
+
+async def send_loop(args, members, results, window):
+    """Open-loop sender for one room: members take turns at a fixed rate."""
+    interval = 1_000_000_000 // args.rate
+    # Spread the rooms' first messages over one interval
+    scheduled = window[0] - args.warmup_ns + int.from_bytes(os.urandom(4), "little") % interval
+    turn = 0
+    while scheduled < window[1]:
+        delay = scheduled - time.monotonic_ns()
+        if delay > 0:
+            await asyncio.sleep(delay / 1e9)
+        name, ws = members[turn % len(members)]
+        turn += 1
+        try:
+            await ws.send(outgoing(args, name, scheduled))
+        except websockets.ConnectionClosed:
+            results.errors += 1
+        else:
+            if scheduled >= window[0]:
+                results.sent += 1
+                results.expected += len(members)
+        scheduled += interval
+
+
+async def worker_main(args, worker, rooms, barrier, queue):
+    results = Results()
+    semaphore = asyncio.Semaphore(args.connect_concurrency)
+    compression = None if args.no_deflate else "deflate"
+
+    async def connect(room, name):
+        async with semaphore:
+            try:
+                ws = await websockets.connect(
+                    client_url(args, room, name), max_size=None, ping_interval=None,
+                    open_timeout=60, compression=compression,
+                )
+            except Exception:
+                results.failed += 1
+                return None
+        results.connected += 1
+        return name, ws
+
+    members = {}
+    for room in rooms:
+        names = [f"w{worker}-{room}-u{i}" for i in range(args.room_size)]
+        connected = await asyncio.gather(*(connect(room, name) for name in names))
+        members[room] = [member for member in connected if member is not None]
+
+    # Measurement window, fixed once every process has connected its clients
+    window = [0, 0]
+    receivers = [asyncio.create_task(receive(ws, results, window))
+                 for room_members in members.values() for _, ws in room_members]
+    await asyncio.get_running_loop().run_in_executor(None, barrier.wait)
+    start = time.monotonic_ns() + args.warmup_ns
+    window[0], window[1] = start, start + int(args.duration * 1e9)
+
+    await asyncio.gather(*(send_loop(args, room_members, results, window)
+                           for room_members in members.values() if room_members))
+    await asyncio.sleep(args.drain)
+
+    for room_members in members.values():
+        for _, ws in room_members:
+            await ws.close()
+    for task in receivers:
+        task.cancel()
+    queue.put(results.to_dict())
+
+
+def run_worker(args, worker, rooms, barrier, queue):
+    raise_open_file_limit()
+    asyncio.run(worker_main(args, worker, rooms, barrier, queue))
+
+
+# ====== Report ======
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return float("nan")
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def mib(value):
+    return "n/a" if value is None else f"{value / (1024 * 1024):.1f} MiB"
+
+
+def report(args, totals, rss):
+    latencies = sorted(totals.latencies)
+    clients = args.rooms * args.room_size
+    ratio = totals.delivered / totals.expected * 100 if totals.expected else 0.0
+    print(f"target     {args.target} at {args.url}")
+    print(f"clients    {totals.connected} connected, {totals.failed} failed "
+          f"({args.rooms} rooms x {args.room_size}, {args.processes} generator processes)")
+    print(f"sent       {totals.sent} messages, {totals.sent / args.duration:.1f} msg/s "
+          f"({args.rate} msg/s per room over {args.duration:.0f}s), {totals.errors} send errors")
+    print(f"delivered  {totals.delivered} of {totals.expected} ({ratio:.2f}%), "
+          f"{totals.delivered / args.duration:.1f} msg/s")
+    print("latency    " + "  ".join(
+        f"{name} {percentile(latencies, q) / 1000:.2f} ms"
+        for name, q in (("p50", 0.5), ("p99", 0.99), ("p999", 0.999))
+    ) + (f"  max {latencies[-1] / 1000:.2f} ms" if latencies else ""))
+    print(f"server RSS idle {mib(rss['idle'])}, connected {mib(rss['connected'])}, "
+          f"peak {mib(rss['peak'])} ({clients} clients)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--target", choices=sorted(TARGETS), default="history")
+    parser.add_argument("--url", help="Server base URL (default: http://127.0.0.1:<target port>)")
+    parser.add_argument("--rooms", type=int, default=10)
+    parser.add_argument("--room-size", type=int, default=100, help="Clients per room")
+    parser.add_argument("--rate", type=int, default=10, help="Messages per second sent in each room")
+    parser.add_argument("--duration", type=float, default=20.0, help="Measured seconds")
+    parser.add_argument("--warmup", type=float, default=2.0, help="Seconds of load before measuring")
+    parser.add_argument("--drain", type=float, default=3.0, help="Seconds to wait for in-flight messages")
+    parser.add_argument("--processes", type=int, default=1, help="Generator processes; rooms are split between them")
+    parser.add_argument("--connect-concurrency", type=int, default=200, help="Handshakes in flight per process")
+    parser.add_argument("--room-prefix", default="loadgen")
+    parser.add_argument("--no-deflate", action="store_true", help="Disable permessage-deflate on client connections")
+    parser.add_argument("--server-pid", type=int, help="Pid of an already running server, for RSS sampling")
+    parser.add_argument("--spawn", action="store_true", help="Start the target server with uvicorn in a temporary directory")
+    parser.add_argument("--fake-redis", action="store_true", help="With --spawn, also start benchmarks/fake_redis.py")
+    parser.add_argument("--redis-port", type=int, default=6380, help="Port for --fake-redis")
+    parser.add_argument("--broker", choices=("inprocess", "redis", "batching"), help="With --spawn, the server's CHAT_BROKER")
+    args = parser.parse_args()
+
+    app_dir, app_name, default_port = TARGETS[args.target]
+    args.url = (args.url or f"http://127.0.0.1:{default_port}").rstrip("/")
+    args.warmup_ns = int(args.warmup * 1e9)
+    auth_keys = parse_keys(os.environ.get("AUTH_KEYS", ""))
+    args.signer = TokenSigner(auth_keys) if auth_keys else None
+    raise_open_file_limit()
+
+    processes = []
+    try:
+        if args.spawn:
+            workdir = tempfile.mkdtemp(prefix="loadgen-")
+            env = dict(os.environ)
+            if args.fake_redis:
+                processes.append(spawn([sys.executable, os.path.join(BENCHMARKS_DIR, "fake_redis.py"),
+                                        "--port", str(args.redis_port)],
+                                       workdir, env, os.path.join(workdir, "fake_redis.log"), args.redis_port))
+                env["REDIS_PORT"] = str(args.redis_port)
+                env["REDIS_URL"] = f"redis://127.0.0.1:{args.redis_port}"
+            if args.broker:
+                env["CHAT_BROKER"] = args.broker
+            if args.target == "gateway":
+                # Messages only reach the room's channel through a history consumer
+                env["CHAT_HISTORY_DIR"] = os.path.join(workdir, "chat_history")
+                with open(os.path.join(workdir, "history_consumer.log"), "w") as log:
+                    processes.append(subprocess.Popen(
+                        [sys.executable, os.path.join(REPO_DIR, "server", "history_service", "history_consumer.py")],
+                        cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT))
+            port = int(args.url.rsplit(":", 1)[1])
+            server = spawn([sys.executable, "-m", "uvicorn", app_name, "--app-dir", app_dir,
+                            "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+                           workdir, env, os.path.join(workdir, "server.log"), port)
+            processes.append(server)
+            args.server_pid = server.pid
+            print(f"Spawned {args.target} server (pid {server.pid}); logs and data in {workdir}")
+
+        rss = {"idle": None, "connected": None, "peak": None}
+        if args.server_pid:
+            rss["idle"] = rss_bytes(args.server_pid)
+
+        rooms = [f"{args.room_prefix}-{i}" for i in range(args.rooms)]
+        if args.target == "history":
+            create_rooms(args.url, rooms, args.signer)
+
+        count = max(1, min(args.processes, len(rooms)))
+        args.processes = count
+        barrier = multiprocessing.Barrier(count + 1)
+        queue = multiprocessing.Queue()
+        workers = [multiprocessing.Process(target=run_worker, args=(args, i, rooms[i::count], barrier, queue))
+                   for i in range(count)]
+        for worker in workers:
+            worker.start()
+
+        # Every generator has connected its clients once the barrier opens
+        barrier.wait(timeout=max(300.0, args.rooms * args.room_size / 50))
+        if args.server_pid:
+            rss["connected"] = rss_bytes(args.server_pid)
+        collected = []
+        while len(collected) < count:
+            if args.server_pid:
+                current = rss_bytes(args.server_pid)
+                if current is not None:
+                    rss["peak"] = max(rss["peak"] or 0, current)
+            while not queue.empty():
+                collected.append(queue.get())
+            time.sleep(0.5)
+        for worker in workers:
+            worker.join()
+
+        totals = Results()
+        for part in collected:
+            for key, value in part.items():
+                if key == "latencies":
+                    totals.latencies.extend(value)
+                else:
+                    setattr(totals, key, getattr(totals, key) + value)
+        report(args, totals, rss)
+    except (urllib.error.URLError, RuntimeError) as e:
+        print(f"Load test failed: {e}")
+        sys.exit(1)
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+            process.wait()
+
+
+if __name__ == "__main__":
+    main()
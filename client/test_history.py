@@ -1,60 +1,88 @@
 import asyncio
+import os
+import sys
 import websockets
 import json
 import aiohttp
+from urllib.parse import quote
+
+# Make the shared `common` package (server/common) importable when run from this directory
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "server")))
+from common.envelope import decode_all
 
 SERVER_URL = "http://localhost:5000"
+# Auth service issuing the token the WebSocket is opened with; leave unset for servers without AUTH_KEYS
+AUTH_URL = os.environ.get("AUTH_URL")
+# Seconds between reconnection attempts, doubling up to the maximum
+RECONNECT_DELAY = 1
+MAX_RECONNECT_DELAY = 30
 
 
 def print_menu():
     print("\nOptions:")
     print("1. Create chat room -> {\"username\": \"your_name\", \"create\": \"chat_room_name\"}")
     print("2. Join chat room -> {\"username\": \"your_name\", \"join\": \"chat_room_name\"}")
-    print("3. Send message -> {\"username\": \"your_name\", \"message\": \"your_message\"}")
+    print("3. Send message -> {\"message\": \"your_message\"}")
+    if AUTH_URL:
+        print("Add \"password\": \"your_password\" to create and join commands to log in with the auth service.")
 
 
-async def create_room(session, command):
-    """Sends a request to create a chat room."""
+async def create_room(session, command, token=None):
+    """Sends a request to create a chat room, as the token's user when there is one."""
     endpoint = "/create-chat-room"
     payload = {
         "username": command["username"],
         "chat_room_name": command["create"]
     }
-    async with session.post(SERVER_URL + endpoint, json=payload) as response:
+    headers = {"Authorization": f"Bearer {token}"} if token else None
+    async with session.post(SERVER_URL + endpoint, json=payload, headers=headers) as response:
         if response.status == 200:
             data = await response.json()
             print(f"\nCreated chat room: {data['chat_room']}")
-            return data.get("websocket_url")
+            return data.get("websocket_url"), None
+        else:
+            print(f"Error: {await response.text()}")
+            return None, None
+
+
+async def get_token(session, username, password=None):
+    """Requests a token for the username from the auth service."""
+    async with session.post(AUTH_URL + "/token", json={"username": username, "password": password}) as response:
+        if response.status == 200:
+            data = await response.json()
+            return data["token"]
         else:
             print(f"Error: {await response.text()}")
             return None
 
 
-async def join_room(session, command):
-    """Sends a request to join a chat room and returns the WebSocket URL."""
+async def join_room(session, command, token=None):
+    """Sends a request to join a chat room, as the token's user when there is one, and returns the WebSocket URL."""
     endpoint = "/join-chat-room"
     payload = {
         "username": command["username"],
         "chat_room_name": command["join"]
     }
-    async with session.post(SERVER_URL + endpoint, json=payload) as response:
+    headers = {"Authorization": f"Bearer {token}"} if token else None
+    async with session.post(SERVER_URL + endpoint, json=payload, headers=headers) as response:
         if response.status == 200:
             data = await response.json()
             print(f"\nJoined chat room: {data['chat_room']}")
             print("\nChat History:")
             for msg in data["history"]:
                 print(msg)
-            return data.get("websocket_url")
+            return data.get("websocket_url"), data.get("last_seq")
         else:
             print(f"Error: {await response.text()}")
-            return None
+            return None, None
 
 
-async def send_message(websocket, username):
+async def send_message(connection):
     """Handles sending messages via WebSocket."""
     while True:
         try:
-            user_input = input("Enter JSON command: ")
+            # Read in a thread so messages keep arriving while waiting for input
+            user_input = await asyncio.to_thread(input, "Enter JSON command: ")
             if user_input.lower() == "exit":
                 print("Exiting chat...")
                 break
@@ -66,35 +94,68 @@ async def send_message(websocket, username):
                 continue
 
             if "message" in command:
-                message_data = {
-                    "username": command.get("username", username),
-                    "message": command["message"]
-                }
+                # The server knows who sent it from the connection
+                message_data = {"message": command["message"]}
+                websocket = connection["websocket"]
+                if websocket is None:
+                    print("Not connected, message not sent. Reconnecting...")
+                    continue
                 await websocket.send(json.dumps(message_data))
             else:
-                print("Invalid command format. Use {\"username\": \"your_name\", \"message\": \"text\"}")
+                print("Invalid command format. Use {\"message\": \"text\"}")
+        except websockets.exceptions.ConnectionClosed:
+            print("Connection lost, message not sent. Reconnecting...")
         except Exception as e:
             print(f"Error sending message: {e}")
             break
 
 
-async def receive_messages(websocket):
-    """Handles receiving messages from WebSocket."""
-    try:
-        async for message in websocket:
-            print(f"\n{message}")
-    except websockets.exceptions.ConnectionClosed:
-        print("Connection closed.")
-
+async def receive_messages(websocket_url, connection):
+    """Handles receiving messages from WebSocket, reconnecting whenever the connection drops.
 
-async def handle_chat(websocket_url, username):
+    Each reconnection asks for the messages after the last one received (?after=<seq>),
+    so nothing sent while disconnected is lost and nothing is shown twice.
+    """
+    delay = RECONNECT_DELAY
+    while True:
+        last_seq = connection["last_seq"]
+        if last_seq is None:
+            url = websocket_url
+        else:
+            url = f"{websocket_url}{'&' if '?' in websocket_url else '?'}after={last_seq}"
+        try:
+            async with websockets.connect(url) as websocket:
+                connection["websocket"] = websocket
+                delay = RECONNECT_DELAY
+                if connection["connected"]:
+                    print(f"\nReconnected, catching up after message {last_seq}.")
+                else:
+                    connection["connected"] = True
+                    print("Connected to chat room. Start sending messages!")
+                async for message in websocket:
+                    # Each binary frame carries one or more envelopes back to back
+                    for envelope in decode_all(message):
+                        if envelope.seq:
+                            connection["last_seq"] = envelope.seq
+                        print(f"\n{envelope.text}")
+        except (OSError, websockets.exceptions.WebSocketException):
+            pass
+        connection["websocket"] = None
+        print(f"\nConnection lost. Reconnecting in {delay}s...")
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, MAX_RECONNECT_DELAY)
+
+
+async def handle_chat(websocket_url, last_seq=None):
     """Handles WebSocket connection for chatting."""
-    async with websockets.connect(websocket_url) as websocket:
-        print("Connected to chat room. Start sending messages!")
-        await asyncio.gather(
-            send_message(websocket, username),
-            receive_messages(websocket)
-        )
+    connection = {"websocket": None, "last_seq": last_seq, "connected": False}
+    receiver = asyncio.create_task(receive_messages(websocket_url, connection))
+    try:
+        await send_message(connection)
+    finally:
+        receiver.cancel()
+        if connection["websocket"] is not None:
+            await connection["websocket"].close()
 
 
 async def main():
@@ -109,14 +170,21 @@ async def main():
                 print("Invalid JSON format. Try again.")
                 continue
 
-            ws_url = None
+            ws_url, last_seq, token = None, None, None
+            if AUTH_URL and "username" in command:
+                token = await get_token(session, command["username"], command.get("password"))
+                if token is None:
+                    continue
             if "create" in command:
-                ws_url = await create_room(session, command)
+                ws_url, last_seq = await create_room(session, command, token)
             elif "join" in command:
-                ws_url = await join_room(session, command)
+                ws_url, last_seq = await join_room(session, command, token)
+
+            if ws_url and token:
+                ws_url = f"{ws_url}{'&' if '?' in ws_url else '?'}token={quote(token)}"
 
             if ws_url:
-                await handle_chat(ws_url, command["username"])
+                await handle_chat(ws_url, last_seq)
             else:
                 print("Invalid command format. Check the menu for correct format.")
 
@@ -0,0 +1,178 @@
+"""
+Content-addressed storage for uploaded files.
+
+Files are split into fixed-size chunks stored once under their SHA-256, so a
+file (or any chunk of it) uploaded by many users takes disk space only once and
+an interrupted upload resumes by sending just the chunks the store lacks.
+
+    <root>/chunks/ab/abcdef...      chunk bytes, named by their SHA-256
+    <root>/files/12/123456....json  manifest: size, chunk size and chunk hashes
+    <root>/names.log                one JSON line per upload: filename -> file id
+
+A file's id is the SHA-256 of its size, its chunk size and its chunk hashes (as
+raw bytes, in order), so the server never re-reads the file to name it, and a
+manifest registered with a wrong size cannot take the id of the real file.
+A file only counts as complete once its stored chunks add up to that size.
+"""
+import hashlib
+import json
+import os
+import uuid
+
+HASH_HEX_LENGTH = 64
+
+
+def file_id_for(size, chunk_size, chunk_hashes):
+    """The id of a file of `size` bytes made of the given chunks of `chunk_size` bytes."""
+    digest = hashlib.sha256(f"{size}:{chunk_size}:".encode("ascii"))
+    for chunk_hash in chunk_hashes:
+        digest.update(bytes.fromhex(chunk_hash))
+    return digest.hexdigest()
+
+
+def is_hash(value):
+    if not isinstance(value, str) or len(value) != HASH_HEX_LENGTH:
+        return False
+    try:
+        bytes.fromhex(value)
+    except ValueError:
+        return False
+    return True
+
+
+class ContentStore:
+    def __init__(self, root):
+        self.root = root
+        self.chunks_dir = os.path.join(root, "chunks")
+        self.files_dir = os.path.join(root, "files")
+        self.names_path = os.path.join(root, "names.log")
+        os.makedirs(self.chunks_dir, exist_ok=True)
+        os.makedirs(self.files_dir, exist_ok=True)
+        # filename -> file id of its latest upload
+        self.names = {}
+        if os.path.exists(self.names_path):
+            with open(self.names_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.names[entry["filename"]] = entry["file_id"]
+
+    # ====== Chunks ======
+
+    def chunk_path(self, chunk_hash):
+        return os.path.join(self.chunks_dir, chunk_hash[:2], chunk_hash)
+
+    def has_chunk(self, chunk_hash):
+        return os.path.exists(self.chunk_path(chunk_hash))
+
+    def put_chunk(self, chunk_hash, data):
+        """
+        Store a chunk after checking it matches its hash. Returns False on a mismatch.
+        Storing a chunk that already exists is a no-op, which is what deduplicates it.
+        """
+        if hashlib.sha256(data).hexdigest() != chunk_hash:
+            return False
+        path = self.chunk_path(chunk_hash)
+        if os.path.exists(path):
+            return True
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write under a unique temporary name so concurrent uploads of one chunk never see a partial file
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        return True
+
+    # ====== Files ======
+
+    def manifest_path(self, file_id):
+        return os.path.join(self.files_dir, file_id[:2], f"{file_id}.json")
+
+    def begin(self, size, chunk_size, chunk_hashes):
+        """
+        Register a file to be uploaded. Returns (file_id, indices of chunks still missing).
+        Calling it again for the same file is how an interrupted upload resumes.
+        """
+        file_id = file_id_for(size, chunk_size, chunk_hashes)
+        path = self.manifest_path(file_id)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"size": size, "chunk_size": chunk_size, "chunks": chunk_hashes}, f)
+            os.replace(tmp_path, path)
+        missing = [i for i, chunk_hash in enumerate(chunk_hashes) if not self.has_chunk(chunk_hash)]
+        return file_id, missing
+
+    def manifest(self, file_id):
+        """The manifest of a registered file, or None."""
+        if not is_hash(file_id):
+            return None
+        try:
+            with open(self.manifest_path(file_id), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def is_complete(self, file_id):
+        """
+        Whether every chunk of the file is stored and the chunks have the sizes its manifest
+        declares: `chunk_size` bytes each except the last, `size` bytes in total.
+        """
+        manifest = self.manifest(file_id)
+        if manifest is None:
+            return False
+        size, chunk_size, chunks = manifest["size"], manifest["chunk_size"], manifest["chunks"]
+        if len(chunks) != -(-size // chunk_size):
+            return False
+        for index, chunk_hash in enumerate(chunks):
+            expected = chunk_size if index < len(chunks) - 1 else size - chunk_size * index
+            try:
+                if os.path.getsize(self.chunk_path(chunk_hash)) != expected:
+                    return False
+            except FileNotFoundError:
+                return False
+        return True
+
+    def put_file(self, data, chunk_size):
+        """Chunk and store a whole in-memory file. Returns its file id."""
+        chunk_hashes = []
+        for start in range(0, len(data), chunk_size):
+            chunk = data[start:start + chunk_size]
+            chunk_hash = hashlib.sha256(chunk).hexdigest()
+            self.put_chunk(chunk_hash, chunk)
+            chunk_hashes.append(chunk_hash)
+        file_id, _ = self.begin(len(data), chunk_size, chunk_hashes)
+        return file_id
+
+    def name(self, filename, file_id):
+        """Point a filename at a stored file."""
+        self.names[filename] = file_id
+        with open(self.names_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps({"filename": filename, "file_id": file_id}) + "\n")
+
+    def segments(self, file_id, offset, length):
+        """
+        Yield (chunk_path, offset_in_chunk, count) covering `length` bytes of the file from `offset`,
+        so a byte range can be sent chunk by chunk with sendfile().
+        """
+        manifest = self.manifest(file_id)
+        chunk_size = manifest["chunk_size"]
+        index, position = divmod(offset, chunk_size)
+        while length > 0 and index < len(manifest["chunks"]):
+            count = min(chunk_size - position, length)
+            yield self.chunk_path(manifest["chunks"][index]), position, count
+            length -= count
+            index += 1
+            position = 0
+
+    def read(self, file_id):
+        """Reassemble a whole file in memory."""
+        manifest = self.manifest(file_id)
+        parts = []
+        for chunk_hash in manifest["chunks"]:
+            with open(self.chunk_path(chunk_hash), "rb") as f:
+                parts.append(f.read())
+        return b"".join(parts)
@@ -0,0 +1,111 @@
+"""
+Wire format of the raw TCP chat protocol (old_server.py / old_client.py).
+
+Every message in either direction is one frame:
+
+    +----------------+-----------------+-------------+-----------------+
+    | JSON length u32| payload len u32 | JSON header | binary payload  |
+    +----------------+-----------------+-------------+-----------------+
+
+Lengths are big-endian. The JSON header carries the command (client -> server)
+or the reply type (server -> client); the optional payload carries raw file
+bytes, so uploads and downloads need no separate handshake.
+"""
+import json
+import struct
+
+FRAME_PREFIX = struct.Struct("!II")
+MAX_HEADER_SIZE = 1 << 20     # 1 MiB of JSON per frame
+MAX_PAYLOAD_SIZE = 64 << 20   # 64 MiB of binary payload per frame
+
+
+class FrameError(ValueError):
+    """The byte stream is not a valid sequence of frames; the connection cannot be resynchronized."""
+
+
+def encode_frame(header, payload=b""):
+    """Serialize a header dict and optional payload into one frame."""
+    body = json.dumps(header, separators=(",", ":")).encode()
+    return FRAME_PREFIX.pack(len(body), len(payload)) + body + payload
+
+
+def encode_prefix(header, payload_size):
+    """Serialize a frame's prefix and header only; the caller sends `payload_size` bytes of payload after it."""
+    body = json.dumps(header, separators=(",", ":")).encode()
+    return FRAME_PREFIX.pack(len(body), payload_size) + body
+
+
+def recv_exact(sock, size):
+    """Blocking read of exactly `size` bytes from a socket."""
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        count = sock.recv_into(view[received:])
+        if not count:
+            raise ConnectionError("Connection closed mid-frame")
+        received += count
+    return bytes(buffer)
+
+
+def recv_prefix(sock):
+    """
+    Blocking read of one frame's prefix and header. Returns (header, payload_size) and
+    leaves the payload on the socket so large payloads can be streamed to disk.
+    """
+    header_size, payload_size = FRAME_PREFIX.unpack(recv_exact(sock, FRAME_PREFIX.size))
+    if header_size > MAX_HEADER_SIZE:
+        raise FrameError(f"Frame header too large ({header_size} bytes)")
+    return json.loads(recv_exact(sock, header_size)), payload_size
+
+
+class FrameDecoder:
+    """
+    Incremental decoder: feed it whatever recv() returned and get back every frame
+    completed so far. Handles frames split across reads and many frames per read.
+    """
+
+    def __init__(self, max_header_size=MAX_HEADER_SIZE, max_payload_size=MAX_PAYLOAD_SIZE):
+        self.max_header_size = max_header_size
+        self.max_payload_size = max_payload_size
+        self._buffer = bytearray()
+
+    def feed(self, data):
+        """Consume received bytes and return a list of (header, payload) tuples."""
+        if self._buffer:
+            self._buffer += data
+            source = self._buffer
+        else:
+            # Common case: nothing pending, so parse straight out of the received bytes.
+            source = data
+
+        frames = []
+        view = memoryview(source)
+        position = 0
+        try:
+            while len(source) - position >= FRAME_PREFIX.size:
+                header_size, payload_size = FRAME_PREFIX.unpack_from(source, position)
+                if header_size > self.max_header_size or payload_size > self.max_payload_size:
+                    raise FrameError(f"Frame too large ({header_size} byte header, {payload_size} byte payload)")
+                end = position + FRAME_PREFIX.size + header_size + payload_size
+                if len(source) < end:
+                    break
+                header_start = position + FRAME_PREFIX.size
+                payload_start = header_start + header_size
+                try:
+                    header = json.loads(view[header_start:payload_start].tobytes())
+                except (ValueError, UnicodeDecodeError) as e:
+                    raise FrameError(f"Invalid frame header: {e}")
+                if not isinstance(header, dict):
+                    raise FrameError("Frame header must be a JSON object")
+                frames.append((header, view[payload_start:end].tobytes()))
+                position = end
+        finally:
+            view.release()
+
+        # Keep only the unconsumed tail.
+        if source is self._buffer:
+            del self._buffer[:position]
+        elif position < len(source):
+            self._buffer += data[position:]
+        return frames
@@ -2,26 +2,226 @@ import socket
 import threading
 import json
 import os
+import queue
+import hashlib
+
+from framing import FrameDecoder, encode_frame, encode_prefix, recv_exact, recv_prefix
 
 HOST = '127.0.0.1'
 PORT = 12345
 
+# Directory where downloaded files are saved
+DOWNLOAD_DIR = "downloads"
+# Parallel downloads: number of transfer connections, and the smallest byte range worth its own request
+DOWNLOAD_CONNECTIONS = 4
+MIN_RANGE_SIZE = 1024 * 1024
+RECV_BUFFER_SIZE = 1024 * 1024
+# Uploads are sent in chunks of this size over this many transfer connections
+CHUNK_SIZE = 1024 * 1024
+UPLOAD_CONNECTIONS = 4
+
 
 def receive_messages(sock):
     """
-    Continuously receive messages from the server and print them.
+    Continuously receive frames from the server and print or save them.
     """
+    decoder = FrameDecoder()
     while True:
         try:
-            data = sock.recv(4096)
+            data = sock.recv(65536)
             if not data:
                 break
-            print(data.decode())
+            for header, payload in decoder.feed(data):
+                if header.get("type") == "file":
+                    os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+                    path = os.path.join(DOWNLOAD_DIR, os.path.basename(header["filename"]))
+                    with open(path, "wb") as f:
+                        f.write(payload)
+                    print(f"Downloaded file '{header['filename']}' to {path}.")
+                else:
+                    print(header.get("text", ""))
         except Exception as e:
             print("Error receiving data:", e)
             break
 
 
+def open_transfer_connection(username):
+    """
+    Open a connection used only for file transfer; it gets no chat broadcasts,
+    so file payloads can be streamed without interleaving.
+    """
+    sock = socket.create_connection((HOST, PORT))
+    sock.sendall(encode_frame({"command": "login", "username": username, "transfer": True}))
+    while True:
+        header, payload_size = recv_prefix(sock)
+        recv_exact(sock, payload_size)
+        if header.get("type") == "ready":
+            return sock
+
+
+def stat_file(sock, filename):
+    """Return the size of a file on the server, or None if it does not exist."""
+    sock.sendall(encode_frame({"command": "stat", "filename": filename}))
+    header, payload_size = recv_prefix(sock)
+    recv_exact(sock, payload_size)
+    if header.get("type") != "stat":
+        print(f"{filename}: {header.get('text', '').strip()}")
+        return None
+    return header["filesize"]
+
+
+def download_range(sock, filename, path, offset, length, buffer):
+    """Fetch one byte range of a file and write it in place into the local copy."""
+    sock.sendall(encode_frame({"command": "download", "filename": filename, "offset": offset, "length": length}))
+    header, payload_size = recv_prefix(sock)
+    if header.get("type") != "file":
+        recv_exact(sock, payload_size)
+        raise IOError(header.get("text", "download failed").strip())
+    view = memoryview(buffer)
+    with open(path, "r+b") as f:
+        f.seek(offset)
+        remaining = payload_size
+        while remaining:
+            count = sock.recv_into(view, min(remaining, len(view)))
+            if not count:
+                raise ConnectionError("Connection closed during download")
+            f.write(view[:count])
+            remaining -= count
+
+
+def download_files(username, filenames, connections=DOWNLOAD_CONNECTIONS):
+    """
+    Download several files at once over parallel transfer connections. Large files
+    are split into byte ranges so a single file is also fetched in parallel.
+    """
+    os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+    socks = [open_transfer_connection(username) for _ in range(connections)]
+    jobs = queue.Queue()
+    downloads = []
+    for filename in filenames:
+        filesize = stat_file(socks[0], filename)
+        if filesize is None:
+            continue
+        path = os.path.join(DOWNLOAD_DIR, os.path.basename(filename))
+        with open(path, "wb") as f:
+            f.truncate(filesize)
+        downloads.append(path)
+        if not filesize:
+            continue
+        parts = max(1, min(connections, filesize // MIN_RANGE_SIZE))
+        part_size = -(-filesize // parts)
+        for offset in range(0, filesize, part_size):
+            jobs.put((filename, path, offset, min(part_size, filesize - offset)))
+
+    errors = []
+
+    def worker(sock):
+        buffer = bytearray(RECV_BUFFER_SIZE)
+        while True:
+            try:
+                job = jobs.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                download_range(sock, *job, buffer)
+            except Exception as e:
+                errors.append(f"{job[0]} [{job[2]}:{job[2] + job[3]}]: {e}")
+                return
+
+    threads = [threading.Thread(target=worker, args=(sock,)) for sock in socks]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for sock in socks:
+        sock.close()
+
+    for error in errors:
+        print("Download error:", error)
+    if not errors:
+        for path in downloads:
+            print(f"Downloaded to {path}.")
+
+
+def request(sock, message):
+    """Send a command on a transfer connection and return the reply header."""
+    sock.sendall(encode_frame(message))
+    header, payload_size = recv_prefix(sock)
+    recv_exact(sock, payload_size)
+    return header
+
+
+def hash_chunks(path, chunk_size=CHUNK_SIZE):
+    """SHA-256 of each chunk of a file, read into one reused buffer."""
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    hashes = []
+    with open(path, "rb") as f:
+        while True:
+            count = f.readinto(buffer)
+            if not count:
+                break
+            hashes.append(hashlib.sha256(view[:count]).hexdigest())
+    return hashes
+
+
+def upload_chunks(username, path, chunk_hashes, connections=UPLOAD_CONNECTIONS):
+    """
+    Register a file with the server and send the chunks it does not have yet.
+    Returns the file's object id, or None if the upload was interrupted; running
+    it again resumes where it stopped.
+    """
+    size = os.path.getsize(path)
+    socks = [open_transfer_connection(username) for _ in range(connections)]
+    try:
+        reply = request(socks[0], {"command": "upload_begin", "size": size, "chunk_size": CHUNK_SIZE, "chunks": chunk_hashes})
+        if reply.get("type") != "upload":
+            print("Upload rejected:", reply.get("text", "").strip())
+            return None
+        print(f"Sending {len(reply['missing'])} of {len(chunk_hashes)} chunks.")
+        jobs = queue.Queue()
+        for index in reply["missing"]:
+            jobs.put(index)
+        errors = []
+
+        def worker(sock):
+            buffer = bytearray(CHUNK_SIZE)
+            view = memoryview(buffer)
+            with open(path, "rb") as f:
+                while True:
+                    try:
+                        index = jobs.get_nowait()
+                    except queue.Empty:
+                        return
+                    try:
+                        f.seek(index * CHUNK_SIZE)
+                        count = f.readinto(buffer)
+                        sock.sendall(encode_prefix({"command": "upload_chunk", "hash": chunk_hashes[index]}, count))
+                        sock.sendall(view[:count])
+                        header, payload_size = recv_prefix(sock)
+                        recv_exact(sock, payload_size)
+                        if not header.get("ok"):
+                            raise IOError(header.get("text", "chunk rejected").strip())
+                    except Exception as e:
+                        errors.append(f"chunk {index}: {e}")
+                        return
+
+        threads = [threading.Thread(target=worker, args=(sock,)) for sock in socks]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            for error in errors:
+                print("Upload error:", error)
+            print("Upload interrupted; run the same upload command again to resume.")
+            return None
+        return reply["file_id"]
+    finally:
+        for sock in socks:
+            sock.close()
+
+
 def main():
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     sock.connect((HOST, PORT))
@@ -31,7 +231,7 @@ def main():
 
     # Wait for server prompt for username and then send it
     username = input("Enter your username: ")
-    sock.sendall(username.encode())
+    sock.sendall(encode_frame({"command": "login", "username": username}))
 
     print("Commands should be entered as valid JSON. Examples:")
     print('  Send a message: {"command": "message", "content": "Hello everyone!"}')
@@ -39,6 +239,7 @@ def main():
     print('  Join a room:   {"command": "join_room", "room": "room1"}')
     print('  Upload a file: {"command": "upload", "filename": "path\to\file.txt"}')
     print('  Download a file: {"command": "download", "filename": "test.txt"}')
+    print('  Download several: {"command": "download", "filenames": ["a.txt", "b.bin"]}')
 
     while True:
         user_input = input()
@@ -50,29 +251,24 @@ def main():
 
         command = message.get("command")
         if command == "upload":
-            # For file upload, add file size info and then send file data.
+            # Send the file's missing chunks over transfer connections, then publish it in the room.
             filename = message.get("filename")
             if not filename or not os.path.exists(filename):
                 print("File not found.")
                 continue
-            filesize = os.path.getsize(filename)
-            message["filesize"] = filesize
-            sock.sendall(json.dumps(message).encode())
-            # Wait for the server to be ready
-            ack = sock.recv(1024).decode()
-            if ack == "READY":
-                with open(filename, "rb") as f:
-                    while True:
-                        chunk = f.read(4096)
-                        if not chunk:
-                            break
-                        sock.sendall(chunk)
-                print(f"Uploaded file '{filename}'.")
-            else:
-                print("Server did not acknowledge file upload.")
+            chunk_hashes = hash_chunks(filename)
+            file_id = upload_chunks(username, filename, chunk_hashes)
+            if file_id is None:
+                continue
+            sock.sendall(encode_frame({"command": "upload", "filename": os.path.basename(filename), "object": file_id}))
+            print(f"Uploaded file '{filename}'.")
+        elif command == "download":
+            # Files are fetched over separate transfer connections in the background
+            filenames = message.get("filenames") or [message.get("filename")]
+            threading.Thread(target=download_files, args=(username, [f for f in filenames if f]), daemon=True).start()
         else:
             # For other commands, simply send the JSON message
-            sock.sendall(json.dumps(message).encode())
+            sock.sendall(encode_frame(message))
 
 
 if __name__ == "__main__":
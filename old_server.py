@@ -1,212 +1,451 @@
-import socket
-import threading
-import json
+import asyncio
 import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from content_store import ContentStore, is_hash
+from framing import FrameDecoder, FrameError, encode_frame, encode_prefix
+
+# Make the shared `common` package (server/common) importable when run from this directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "server"))
+from common.history_store import DEFAULT_CODEC, HistoryStore
+from common.recent_cache import RecentMessageCache
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
 
 HOST = '127.0.0.1'
 PORT = 12345
+# Length of the kernel's pending-connection queue passed to listen().
+# The effective value is also capped by net.core.somaxconn on Linux.
+BACKLOG = int(os.environ.get("CHAT_LISTEN_BACKLOG", "4096"))
+# Bytes requested per read; one read can carry many pipelined frames
+READ_SIZE = 256 * 1024
+# A client with more than this many bytes of broadcasts still unsent is too slow to keep up and is disconnected
+WRITE_BUFFER_LIMIT = int(os.environ.get("CHAT_WRITE_BUFFER_LIMIT", str(4 * 1024 * 1024)))
 
-clients = {}         # username -> client_socket
+# All state is owned by the event loop thread, so no lock is needed around it.
+clients = {}         # username -> asyncio.StreamWriter
 client_rooms = {}    # username -> current room name
 rooms = {"global": set()}  # room name -> set of usernames
-chat_history = {"global": []}  # room name -> list of message strings
-lock = threading.Lock()
 
 # Directory for storing uploaded files
 UPLOAD_DIR = "uploads"
 if not os.path.exists(UPLOAD_DIR):
     os.makedirs(UPLOAD_DIR)
 
-# Directory for storing chat history files
+# Uploads are stored content-addressed (deduplicated chunks) under uploads/objects
+store = ContentStore(os.path.join(UPLOAD_DIR, "objects"))
+# Chunk size used for files sent inline with a single upload command, and the largest chunk accepted
+CHUNK_SIZE = 1024 * 1024
+MAX_CHUNK_SIZE = 8 * 1024 * 1024
+
+# Directory for storing chat history. Each room's history is kept by a HistoryStore (common/history_store.py)
+# under history/rooms: sealed into a new segment every HISTORY_SEGMENT_BYTES (or HISTORY_SEGMENT_SECONDS
+# when set), and sealed segments compressed with HISTORY_CODEC (zstd when installed, else gzip).
 HISTORY_DIR = "history"
-if not os.path.exists(HISTORY_DIR):
-    os.makedirs(HISTORY_DIR)
+HISTORY_SEGMENT_BYTES = int(os.environ.get("HISTORY_SEGMENT_BYTES", str(8 * 1024 * 1024)))
+HISTORY_SEGMENT_SECONDS = float(os.environ.get("HISTORY_SEGMENT_SECONDS", "0"))
+HISTORY_CODEC = os.environ.get("HISTORY_CODEC", DEFAULT_CODEC)
+history_store = HistoryStore(
+    os.path.join(HISTORY_DIR, "rooms"),
+    segment_bytes=HISTORY_SEGMENT_BYTES,
+    segment_seconds=HISTORY_SEGMENT_SECONDS,
+    codec=HISTORY_CODEC,
+)
+# Plain-text history files of earlier versions, history/<room>_history.txt, imported into the store on startup
+LEGACY_HISTORY_SUFFIX = "_history.txt"
+
+# Recent history sent on join is served from memory: the last RECENT_HISTORY_SIZE
+# lines per room, with cold rooms evicted once the cache holds RECENT_CACHE_BYTES.
+RECENT_HISTORY_SIZE = int(os.environ.get("RECENT_HISTORY_SIZE", "100"))
+RECENT_CACHE_BYTES = int(os.environ.get("RECENT_CACHE_BYTES", str(64 * 1024 * 1024)))
+recent_cache = RecentMessageCache(RECENT_HISTORY_SIZE, RECENT_CACHE_BYTES)
+# History is written and read by this one thread, in the order the lines were sent,
+# so a slow disk never blocks the event loop
+history_thread = ThreadPoolExecutor(max_workers=1, thread_name_prefix="history")
+
+
+def text_frame(text):
+    return encode_frame({"type": "text", "text": text})
 
 
 def broadcast(message, room):
     """
     Broadcast a message to all clients in the specified room.
+    The frame is built once and queued on every client's transport without waiting.
+    A client that has fallen WRITE_BUFFER_LIMIT bytes behind is disconnected instead,
+    so one stalled reader cannot grow the server's memory without bound.
     """
     if room not in rooms:
         return
+    frame = text_frame(message)
     for user in rooms[room]:
-        client = clients.get(user)
-        if client:
-            try:
-                client.sendall(message.encode())
-            except Exception as e:
-                print(f"Error sending message to {user}: {e}")
+        writer = clients.get(user)
+        if writer is None or writer.is_closing():
+            continue
+        if writer.transport.get_write_buffer_size() > WRITE_BUFFER_LIMIT:
+            # Dropped without flushing; handle_client removes the user once the connection is lost
+            print(f"Disconnecting {user}: more than {WRITE_BUFFER_LIMIT} bytes of messages unsent")
+            writer.transport.abort()
+            continue
+        try:
+            writer.write(frame)
+        except Exception as e:
+            print(f"Error sending message to {user}: {e}")
+
+
+def import_legacy_history():
+    """Move the plain-text history files of earlier versions into the store, where they become rooms' first segment."""
+    for name in os.listdir(HISTORY_DIR):
+        if not name.endswith(LEGACY_HISTORY_SUFFIX):
+            continue
+        room = name[:-len(LEGACY_HISTORY_SUFFIX)]
+        path = os.path.join(HISTORY_DIR, name)
+        if history_store.exists(room):
+            print(f"Not importing {path}: room '{room}' already has history")
+            continue
+        os.replace(path, history_store.data_path(room))
+        print(f"Imported {path} into the history store")
+
+
+def write_history(room, line):
+    """Append a line to the room's history. Runs on the history thread."""
+    try:
+        history_store.append(room, line)
+    except Exception as e:
+        print(f"Error saving history of {room}: {e}")
+
+
+def append_history(room, line):
+    """Record a line in the room's cached recent lines and queue it for the room's on-disk history."""
+    history_thread.submit(write_history, room, line)
+    recent_cache.append(room, line)
+
+
+def read_last_lines(room, count):
+    """The room's last `count` lines from the store: one index lookup, whatever the size of its history."""
+    if not count or not history_store.exists(room):
+        return []
+    return [envelope.text for envelope in history_store.read_page(room, limit=count)]
+
+
+async def recent_history(room):
+    """The room's most recent lines: from memory, or loaded from its history file on a miss."""
+    entries = recent_cache.recent(room)
+    if entries is None:
+        # Read on the history thread: after the lines already queued for the room are written,
+        # while the lines sent from now on are recorded by the cache and merged into the load
+        recent_cache.begin_load(room)
+        try:
+            lines = await asyncio.wrap_future(
+                history_thread.submit(read_last_lines, room, recent_cache.per_room)
+            )
+            recent_cache.load(room, [(None, line) for line in lines])
+        finally:
+            recent_cache.end_load(room)
+        entries = recent_cache.recent(room) or []
+    return [line for _, line in entries]
+
+
+async def send(writer, text):
+    writer.write(text_frame(text))
+    await writer.drain()
+
+
+async def read_frames(reader, decoder):
+    """
+    Yield frames as they arrive. A single read may complete several pipelined
+    frames or only part of one; the decoder takes care of both.
+    """
+    while True:
+        data = await reader.read(READ_SIZE)
+        if not data:
+            return
+        for frame in decoder.feed(data):
+            yield frame
+
+
+async def login(writer, frames):
+    """
+    Run the username handshake. Returns (username, is_transfer), or (None, False) if the client went away.
+    Transfer connections only move files: they skip the room machinery and never receive
+    broadcasts, so their usernames need not be unique.
+    """
+    await send(writer, "Please enter your username: ")
+    async for message, _ in frames:
+        username = str(message.get("username", "")).strip() if message.get("command") == "login" else ""
+        transfer = bool(message.get("transfer"))
+        if username and (transfer or username not in clients):
+            return username, transfer
+        await send(writer, "Username taken or invalid. Enter another username: ")
+    return None, False
+
+
+def resolve_download(message):
+    """
+    Map a download/stat request to (filename, file_id, size), or None if the file does not exist.
+    Files are looked up by object id or by their latest uploaded name; file_id is None
+    for files stored flat in UPLOAD_DIR before content addressing.
+    """
+    filename = os.path.basename(message.get("filename") or "")
+    file_id = message.get("object") or store.names.get(filename)
+    if file_id and store.is_complete(file_id):
+        return filename or file_id, file_id, store.manifest(file_id)["size"]
+    file_path = os.path.join(UPLOAD_DIR, filename)
+    if filename and os.path.isfile(file_path):
+        return filename, None, os.path.getsize(file_path)
+    return None
+
+
+def file_segments(filename, file_id, offset, length):
+    """(path, offset, count) pieces making up a byte range of a stored file; none for an empty range."""
+    if file_id is None:
+        return [(os.path.join(UPLOAD_DIR, filename), offset, length)] if length > 0 else []
+    return list(store.segments(file_id, offset, length))
+
+
+def read_segments(segments):
+    parts = []
+    for path, offset, count in segments:
+        with open(path, "rb") as f:
+            f.seek(offset)
+            parts.append(f.read(count))
+    return b"".join(parts)
+
+
+async def handle_upload_command(writer, message, payload):
+    """
+    Chunked, resumable upload: `upload_begin` announces a file's chunk hashes and gets
+    back the chunks the store lacks, then each missing chunk is sent with `upload_chunk`.
+    Beginning the same file again after a broken connection only asks for what is still
+    missing, and chunks already stored by anyone are never sent at all.
+    """
+    command = message.get("command")
+    if command == "upload_begin":
+        size = message.get("size")
+        chunk_size = message.get("chunk_size")
+        chunks = message.get("chunks")
+        if (
+            not isinstance(size, int) or size < 0
+            or not isinstance(chunk_size, int) or not 0 < chunk_size <= MAX_CHUNK_SIZE
+            or not isinstance(chunks, list) or not all(is_hash(h) for h in chunks)
+            or len(chunks) != -(-size // chunk_size)
+        ):
+            await send(writer, "Invalid upload description.\n")
+            return
+        file_id, missing = await asyncio.to_thread(store.begin, size, chunk_size, chunks)
+        writer.write(encode_frame({"type": "upload", "file_id": file_id, "missing": missing}))
+    else:
+        chunk_hash = message.get("hash")
+        if not is_hash(chunk_hash) or len(payload) > MAX_CHUNK_SIZE:
+            await send(writer, "Invalid chunk.\n")
+            return
+        ok = await asyncio.to_thread(store.put_chunk, chunk_hash, payload)
+        writer.write(encode_frame({"type": "chunk", "hash": chunk_hash, "ok": ok}))
+    await writer.drain()
+
+
+async def handle_transfer_command(writer, message, payload):
+    """
+    Process one command on a transfer connection.
+    Downloads may name a byte range; the range is written with sendfile(), straight
+    from the page cache to the socket, after a frame prefix announcing its length.
+    """
+    command = message.get("command")
+    if command in ("upload_begin", "upload_chunk"):
+        await handle_upload_command(writer, message, payload)
+        return
+    if command not in ("stat", "download"):
+        await send(writer, "Transfer connections only support stat, download, upload_begin and upload_chunk.\n")
+        return
+    found = resolve_download(message)
+    if found is None:
+        await send(writer, "File not found.\n")
+        return
+    filename, file_id, filesize = found
+    if command == "stat":
+        writer.write(encode_frame({"type": "stat", "filename": filename, "object": file_id, "filesize": filesize}))
+        await writer.drain()
+        return
+
+    try:
+        offset = min(max(int(message.get("offset", 0)), 0), filesize)
+        length = max(0, min(int(message.get("length", filesize - offset)), filesize - offset))
+    except (TypeError, ValueError):
+        await send(writer, "Invalid byte range.\n")
+        return
+    header = {"type": "file", "filename": filename, "filesize": filesize, "offset": offset, "length": length}
+    writer.write(encode_prefix(header, length))
+    await writer.drain()
+    loop = asyncio.get_running_loop()
+    for path, segment_offset, count in file_segments(filename, file_id, offset, length):
+        if count <= 0:
+            # sendfile() refuses to send nothing
+            continue
+        with open(path, "rb") as f:
+            await loop.sendfile(writer.transport, f, segment_offset, count)
 
 
-def handle_client(client_socket, address):
-    global clients, client_rooms, rooms, chat_history
+async def handle_command(username, writer, message, payload):
+    """Process one command frame from a logged-in client."""
+    command = message.get("command")
+    if command == "message":
+        content = message.get("content", "")
+        room = client_rooms.get(username, "global")
+        msg_line = f"{username}: {content}"
+        append_history(room, msg_line)
+        broadcast(msg_line, room)
+    elif command == "create_room":
+        # Create and join a private room
+        room = message.get("room")
+        if not room:
+            await send(writer, "No room name provided.\n")
+            return
+        if room not in rooms:
+            rooms[room] = set()
+            # Remove user from previous room and join new one
+            old_room = client_rooms.get(username, "global")
+            rooms[old_room].discard(username)
+            client_rooms[username] = room
+            rooms[room].add(username)
+            await send(writer, f"Room '{room}' created and joined.\n")
+        else:
+            await send(writer, f"Room '{room}' already exists.\n")
+    elif command == "join_room":
+        # Join an existing room
+        room = message.get("room")
+        if not room:
+            await send(writer, "No room name provided.\n")
+            return
+        if room in rooms:
+            # Remove user from the old room
+            old_room = client_rooms.get(username, "global")
+            rooms[old_room].discard(username)
+            # Join the new room
+            client_rooms[username] = room
+            rooms[room].add(username)
+            await send(writer, f"Joined room '{room}'.\n")
+            # Send room's chat history
+            history = "\n".join(await recent_history(room))
+            if history:
+                await send(writer, f"Chat History for {room}:\n{history}\n")
+        else:
+            await send(writer, f"Room '{room}' does not exist.\n")
+    elif command in ("upload_begin", "upload_chunk"):
+        await handle_upload_command(writer, message, payload)
+    elif command == "upload":
+        # Publish an upload under a filename: either a file whose chunks were sent with
+        # upload_begin/upload_chunk ("object"), or small file contents inline as the payload.
+        room = client_rooms.get(username, "global")
+        filename = os.path.basename(message.get("filename") or "")
+        if not filename:
+            await send(writer, "Filename not provided.\n")
+            return
+        file_id = message.get("object")
+        if file_id is None:
+            file_id = await asyncio.to_thread(store.put_file, payload, CHUNK_SIZE)
+        elif not await asyncio.to_thread(store.is_complete, file_id):
+            await send(writer, f"Upload of '{filename}' is incomplete; resume it with upload_begin.\n")
+            return
+        store.name(filename, file_id)
+        size = store.manifest(file_id)["size"]
+        info = f"{username} uploaded file: {filename} ({size} bytes, object {file_id})"
+        append_history(room, info)
+        broadcast(info, room)
+    elif command == "download":
+        # Send a whole file as the payload of one "file" frame. Broadcasts share this
+        # connection, so the frame is written in one piece; parallel and ranged
+        # downloads go through transfer connections instead.
+        found = resolve_download(message)
+        if found is None:
+            await send(writer, "File not found.\n")
+            return
+        filename, file_id, filesize = found
+        data = await asyncio.to_thread(read_segments, file_segments(filename, file_id, 0, filesize))
+        header = {"type": "file", "filename": filename, "filesize": len(data), "offset": 0, "length": len(data)}
+        writer.write(encode_frame(header, data))
+        await writer.drain()
+    else:
+        await send(writer, "Unknown command.\n")
+
+
+async def handle_client(reader, writer):
+    address = writer.get_extra_info("peername")
     username = None
+    frames = read_frames(reader, FrameDecoder())
     try:
         # Ask for username
-        client_socket.sendall("Please enter your username: ".encode())
-        username = client_socket.recv(1024).decode().strip()
-        with lock:
-            while not username or username in clients:
-                client_socket.sendall("Username taken or invalid. Enter another username: ".encode())
-                username = client_socket.recv(1024).decode().strip()
-            clients[username] = client_socket
-            # Join the global chat room by default
-            client_rooms[username] = "global"
-            rooms["global"].add(username)
-            if "global" not in chat_history:
-                chat_history["global"] = []
-
-        client_socket.sendall(f"Welcome {username}! You are in the global chat room.\n".encode())
+        username, transfer = await login(writer, frames)
+        if username is None:
+            return
+        if transfer:
+            writer.write(encode_frame({"type": "ready"}))
+            async for message, payload in frames:
+                await handle_transfer_command(writer, message, payload)
+            return
+        clients[username] = writer
+        # Join the global chat room by default
+        client_rooms[username] = "global"
+        rooms["global"].add(username)
+
+        await send(writer, f"Welcome {username}! You are in the global chat room.\n")
         # Send chat history for the global room
-        history = "\n".join(chat_history["global"])
+        history = "\n".join(await recent_history("global"))
         if history:
-            client_socket.sendall(f"Chat History:\n{history}\n".encode())
+            await send(writer, f"Chat History:\n{history}\n")
 
         # Main loop for client messages
-        while True:
-            data = client_socket.recv(4096)
-            if not data:
-                break
-            try:
-                message = json.loads(data.decode())
-            except json.JSONDecodeError:
-                client_socket.sendall("Invalid JSON format.\n".encode())
-                continue
-
-            # Process message by command
-            command = message.get("command")
-            if command == "message":
-                content = message.get("content", "")
-                room = client_rooms.get(username, "global")
-                msg_line = f"{username}: {content}"
-                with lock:
-                    chat_history.setdefault(room, []).append(msg_line)
-                    # Append to a file for persistence (one file per room in the history folder)
-                    history_path = os.path.join(HISTORY_DIR, f"{room}_history.txt")
-                    with open(history_path, "a") as f:
-                        f.write(msg_line + "\n")
-                broadcast(msg_line, room)
-            elif command == "create_room":
-                # Create and join a private room
-                room = message.get("room")
-                if not room:
-                    client_socket.sendall("No room name provided.\n".encode())
-                    continue
-                with lock:
-                    if room not in rooms:
-                        rooms[room] = set()
-                        chat_history[room] = []
-                        # Remove user from previous room and join new one
-                        old_room = client_rooms.get(username, "global")
-                        if username in rooms[old_room]:
-                            rooms[old_room].remove(username)
-                        client_rooms[username] = room
-                        rooms[room].add(username)
-                        client_socket.sendall(f"Room '{room}' created and joined.\n".encode())
-                    else:
-                        client_socket.sendall(f"Room '{room}' already exists.\n".encode())
-            elif command == "join_room":
-                # Join an existing room
-                room = message.get("room")
-                if not room:
-                    client_socket.sendall("No room name provided.\n".encode())
-                    continue
-                with lock:
-                    if room in rooms:
-                        # Remove user from the old room
-                        old_room = client_rooms.get(username, "global")
-                        if username in rooms[old_room]:
-                            rooms[old_room].remove(username)
-                        # Join the new room
-                        client_rooms[username] = room
-                        rooms[room].add(username)
-                        client_socket.sendall(f"Joined room '{room}'.\n".encode())
-                        # Send room's chat history
-                        history = "\n".join(chat_history.get(room, []))
-                        if history:
-                            client_socket.sendall(f"Chat History for {room}:\n{history}\n".encode())
-                    else:
-                        client_socket.sendall(f"Room '{room}' does not exist.\n".encode())
-            elif command == "upload":
-                # Handle file upload
-                room = client_rooms.get(username, "global")
-                filename = message.get("filename")
-                filesize = message.get("filesize")
-                if not filename or not filesize:
-                    client_socket.sendall("Filename or filesize not provided.\n".encode())
-                    continue
-                # Signal client to start sending file data
-                client_socket.sendall("READY".encode())
-                received = 0
-                file_path = os.path.join(UPLOAD_DIR, filename)
-                with open(file_path, "wb") as f:
-                    while received < filesize:
-                        chunk = client_socket.recv(min(4096, filesize - received))
-                        if not chunk:
-                            break
-                        f.write(chunk)
-                        received += len(chunk)
-                info = f"{username} uploaded file: {filename}"
-                with lock:
-                    chat_history.setdefault(room, []).append(info)
-                    history_path = os.path.join(HISTORY_DIR, f"{room}_history.txt")
-                    with open(history_path, "a") as f:
-                        f.write(info + "\n")
-                broadcast(info, room)
-            elif command == "download":
-                # Send a file to the client
-                filename = message.get("filename")
-                if not filename:
-                    client_socket.sendall("Filename not provided.\n".encode())
-                    continue
-                file_path = os.path.join(UPLOAD_DIR, filename)
-                if os.path.exists(file_path):
-                    filesize = os.path.getsize(file_path)
-                    # Send file size information first
-                    client_socket.sendall(json.dumps({"filesize": filesize}).encode())
-                    ack = client_socket.recv(1024)  # expecting ack "READY"
-                    with open(file_path, "rb") as f:
-                        while True:
-                            chunk = f.read(4096)
-                            if not chunk:
-                                break
-                            client_socket.sendall(chunk)
-                else:
-                    client_socket.sendall("File not found.\n".encode())
-            else:
-                client_socket.sendall("Unknown command.\n".encode())
+        async for message, payload in frames:
+            await handle_command(username, writer, message, payload)
+    except FrameError as e:
+        # The stream is out of sync; report it and drop the connection
+        print(f"Protocol error from client {address}: {e}")
+        try:
+            await send(writer, f"Protocol error: {e}\n")
+        except Exception:
+            pass
     except Exception as e:
         print(f"Error with client {address}: {e}")
     finally:
-        with lock:
-            if username in clients:
-                del clients[username]
-            room = client_rooms.get(username, "global")
-            if room in rooms and username in rooms[room]:
-                rooms[room].remove(username)
-            if username in client_rooms:
-                del client_rooms[username]
-        client_socket.close()
+        if username is not None and clients.get(username) is writer:
+            del clients[username]
+            room = client_rooms.pop(username, "global")
+            if room in rooms:
+                rooms[room].discard(username)
+        writer.close()
         print(f"Connection with {address} closed.")
 
 
-def start_server():
-    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server_socket.bind((HOST, PORT))
-    server_socket.listen(5)
-    print(f"Server listening on {HOST}:{PORT}")
+def raise_open_file_limit():
+    """Lift the soft open-file limit to the hard limit so tens of thousands of sockets fit."""
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError) as e:
+            print(f"Could not raise open file limit: {e}")
+
+
+async def start_server(host=HOST, port=PORT, backlog=BACKLOG):
+    raise_open_file_limit()
+    import_legacy_history()
+    server = await asyncio.start_server(handle_client, host, port, backlog=backlog)
+    print(f"Server listening on {host}:{port} (backlog {backlog})")
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
     try:
-        while True:
-            client_sock, addr = server_socket.accept()
-            print(f"New connection from {addr}")
-            client_thread = threading.Thread(target=handle_client, args=(client_sock, addr))
-            client_thread.daemon = True
-            client_thread.start()
+        asyncio.run(start_server())
     except KeyboardInterrupt:
         print("Server shutting down.")
     finally:
-        server_socket.close()
-
-
-if __name__ == "__main__":
-    start_server()
+        # Write the lines still queued, then close the history files
+        history_thread.shutdown(wait=True)
+        history_store.close()
@@ -0,0 +1,88 @@
+"""
+Auth service: issues the signed tokens chat clients connect with.
+
+A client asks for a token once (POST /token) and passes it to the chat servers
+as ?token=<token> (or an "Authorization: Bearer" header) when it opens a
+WebSocket. The chat servers hold the same AUTH_KEYS and verify tokens in
+memory (see common/tokens.py), so they never call this service: it is only on
+the login path, not on the connect or message path.
+
+    AUTH_KEYS=k1:<secret> AUTH_USERS=alice:<hash> uvicorn auth_service:app --port 5002
+    # every chat server (app.py, chat_service.py) runs with the same AUTH_KEYS
+
+A token is only issued for a username listed in AUTH_USERS, with its password.
+Hashes are made with `python -m common.tokens` from server/. Handing out tokens
+for any free-form username, as the chat servers did before tokens, has to be
+turned on explicitly with AUTH_OPEN_SIGNUP=1; the usernames listed in
+AUTH_USERS still need their password.
+"""
+import asyncio
+import logging
+import os
+import sys
+from typing import Optional
+
+from fastapi import FastAPI, HTTPException
+from fastapi.middleware.cors import CORSMiddleware
+from pydantic import BaseModel, Field
+
+# Make the shared `common` package (server/common) importable when run from this directory
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from common.serializer import JSONResponse
+from common.tokens import MAX_USERNAME, TOKEN_TTL, TokenSigner, check_password, parse_keys, parse_users
+
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO"), format="%(asctime)s - %(levelname)s - %(message)s")
+logger = logging.getLogger(__name__)
+
+# "<id>:<secret>" pairs separated by commas; the first signs new tokens, the chat servers accept all of them
+AUTH_KEYS = parse_keys(os.environ.get("AUTH_KEYS", ""))
+# How long a token is valid, in seconds
+AUTH_TOKEN_TTL = float(os.environ.get("AUTH_TOKEN_TTL", str(TOKEN_TTL)))
+signer = TokenSigner(AUTH_KEYS, ttl=AUTH_TOKEN_TTL)
+# Users who can log in: "<username>:<hash>" pairs separated by commas, hashes made by common/tokens.py
+AUTH_USERS = parse_users(os.environ.get("AUTH_USERS", ""))
+# Issue tokens without a password for any username not in AUTH_USERS; off unless set to 1
+AUTH_OPEN_SIGNUP = os.environ.get("AUTH_OPEN_SIGNUP", "0") == "1"
+if not AUTH_USERS and not AUTH_OPEN_SIGNUP:
+    logger.warning("No AUTH_USERS and AUTH_OPEN_SIGNUP is off: every token request will be refused")
+
+app = FastAPI(default_response_class=JSONResponse)
+
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
+
+class TokenRequest(BaseModel):
+    username: str = Field(min_length=1, max_length=MAX_USERNAME)
+    password: Optional[str] = Field(None, max_length=1024)
+
+
+@app.post("/token")
+async def issue_token(request: TokenRequest):
+    """Issues a token for the username once its password checks out; chat servers attribute the
+    client's messages to it."""
+    username = request.username.strip()
+    if not username or not username.isprintable():
+        raise HTTPException(status_code=400, detail="Invalid username")
+    password_hash = AUTH_USERS.get(username)
+    if password_hash is not None:
+        # PBKDF2 is deliberately slow, so it runs off the event loop
+        if request.password is None or not await asyncio.to_thread(check_password, request.password, password_hash):
+            logger.warning(f"Token refused for '{username}': wrong password")
+            raise HTTPException(status_code=401, detail="Invalid username or password")
+    elif not AUTH_OPEN_SIGNUP:
+        logger.warning(f"Token refused for '{username}': unknown user")
+        raise HTTPException(status_code=401, detail="Invalid username or password")
+    token, expires_at = signer.issue(username)
+    logger.info(f"Token issued for '{username}'")
+    return {"username": username, "token": token, "token_type": "bearer", "expires_at": expires_at}
+
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(app, host="0.0.0.0", port=5002)
@@ -0,0 +1,200 @@
+"""
+Chat gateway: terminates the clients' WebSockets and fans messages out, nothing else.
+
+    clients <-> chat_service.py (any number of processes, behind a load balancer)
+                   | new messages               ^ numbered messages on the room's channel
+                   v chat:ingest:<shard>        |
+                history_consumer.py: appends to history, then publishes
+    history_service/app.py (HISTORY_MODE=cluster): rooms, history pages and presence over HTTP
+
+A gateway never writes to disk. A message a client sends goes to the ingest
+channel of its room's shard; the history consumer owning that shard appends
+it to history and publishes it, with its sequence number, on the room's
+channel, from which every gateway with clients in the room delivers it. The
+only disk access is a read of CHAT_HISTORY_DIR (the consumer's directory,
+shared read-only) when a reconnecting client missed more than the room's tail
+kept in memory. Fan-out capacity therefore scales with the number of gateways,
+independently of history I/O; see "Running the services" in the README for
+the capacity of one gateway process.
+
+    # from server/history_service
+    python history_consumer.py
+    HISTORY_MODE=cluster CHAT_GATEWAY_URL=ws://localhost:5001 uvicorn app:app --port 5000
+    # from server/chat_service
+    CHAT_HISTORY_DIR=../history_service/chat_history uvicorn chat_service:app --port 5001 --workers 4
+
+Clients use the same protocol as with the history service:
+/ws/<room>?token=<token from the auth service>&after=<last seq seen>,
+or ?username=<name> instead of the token when AUTH_KEYS is not set.
+"""
+import logging
+import os
+import sys
+from contextlib import asynccontextmanager
+from typing import Optional
+
+import redis.asyncio as redis
+from fastapi import FastAPI, Query, WebSocket
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import Response
+
+# Make the shared `common` package (server/common) importable when run from this directory
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from common.broker import PUBLISH_BATCH, create_broker
+from common.cluster import ingest_channel
+from common.envelope import Envelope
+from common.gateway import Gateway
+from common.history_store import HistoryStore
+from common.metrics import CONTENT_TYPE, Registry
+from common.presence import PresenceTracker
+from common.ratelimit import RateLimiter
+from common.recent_cache import RecentMessageCache
+from common.serializer import JSONResponse
+from common.tokens import TokenVerifier, parse_keys
+
+# Per-message logs are DEBUG (LOG_LEVEL=DEBUG), /metrics covers message traffic
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO"), format="%(asctime)s - %(levelname)s - %(message)s")
+logger = logging.getLogger(__name__)
+
+# Redis connection settings (REDIS_URL takes precedence)
+REDIS_HOST = os.environ.get("REDIS_HOST", "localhost")
+REDIS_PORT = int(os.environ.get("REDIS_PORT", "6379"))
+REDIS_URL = os.environ.get("REDIS_URL", f"redis://{REDIS_HOST}:{REDIS_PORT}")
+# Messages travel as binary envelopes, so payloads are left as bytes
+redis_client = redis.from_url(REDIS_URL)
+
+# Message bus shared with the history consumers and the other gateways: "batching" or "redis"
+CHAT_BROKER = os.environ.get("CHAT_BROKER", "batching")
+BROKER_MAX_BATCH = int(os.environ.get("BROKER_MAX_BATCH", str(PUBLISH_BATCH)))
+BROKER_LINGER_MS = float(os.environ.get("BROKER_LINGER_MS", "1"))
+broker = create_broker(CHAT_BROKER, redis_client, max_batch=BROKER_MAX_BATCH, linger=BROKER_LINGER_MS / 1000)
+if not broker.shared:
+    raise ValueError(f"CHAT_BROKER '{CHAT_BROKER}' cannot reach the history consumers, the gateway needs Redis")
+# Number of ingest channels the rooms are hashed into; must match the history consumers
+INGEST_SHARDS = int(os.environ.get("INGEST_SHARDS", "1"))
+
+# The history consumers' directory, only read to replay missed messages that are no longer in memory
+CHAT_HISTORY_DIR = os.environ.get(
+    "CHAT_HISTORY_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "history_service", "chat_history"),
+)
+history_store = HistoryStore(CHAT_HISTORY_DIR, read_only=True)
+
+# The newest HISTORY_PAGE_SIZE messages of every room with clients here are kept in memory, up to RECENT_CACHE_BYTES
+HISTORY_PAGE_SIZE = int(os.environ.get("HISTORY_PAGE_SIZE", "100"))
+RECENT_CACHE_BYTES = int(os.environ.get("RECENT_CACHE_BYTES", str(64 * 1024 * 1024)))
+recent_cache = RecentMessageCache(HISTORY_PAGE_SIZE, RECENT_CACHE_BYTES)
+# Most messages replayed to a reconnecting client; it pages /history?after= for the rest
+RESUME_MAX_MESSAGES = int(os.environ.get("RESUME_MAX_MESSAGES", "1000"))
+
+# Joins and leaves are announced in one digest per room every PRESENCE_INTERVAL seconds;
+# the roster is shared through Redis with every other gateway
+PRESENCE_INTERVAL = float(os.environ.get("PRESENCE_INTERVAL", "1.0"))
+presence = PresenceTracker(broker.publish, interval=PRESENCE_INTERVAL, redis_client=redis_client)
+
+# Incoming messages are checked before they are parsed: at most MAX_MESSAGE_BYTES each, and
+# token buckets of <rate> messages/s with bursts of <burst> per connection and per room (0 = unlimited).
+# Room buckets are per gateway, so a room's total rate is up to ROOM_MESSAGE_RATE times its gateways.
+rate_limiter = RateLimiter(
+    connection_rate=float(os.environ.get("CONNECTION_MESSAGE_RATE", "5")),
+    connection_burst=float(os.environ.get("CONNECTION_MESSAGE_BURST", "20")),
+    room_rate=float(os.environ.get("ROOM_MESSAGE_RATE", "200")),
+    room_burst=float(os.environ.get("ROOM_MESSAGE_BURST", "400")),
+    max_message_bytes=int(os.environ.get("MAX_MESSAGE_BYTES", str(16 * 1024))),
+)
+
+# Per-client outgoing queue size and what to do when a client falls that far behind
+FANOUT_QUEUE_SIZE = int(os.environ.get("FANOUT_QUEUE_SIZE", "256"))
+FANOUT_OVERFLOW_POLICY = os.environ.get("FANOUT_OVERFLOW_POLICY", "drop_oldest")
+
+# With AUTH_KEYS (the auth service's "<id>:<secret>,..." keys), WebSocket clients need a token from
+# server/auth_service, checked once when they connect; without it, ?username= is taken on trust
+AUTH_KEYS = parse_keys(os.environ.get("AUTH_KEYS", ""))
+token_verifier = TokenVerifier(AUTH_KEYS) if AUTH_KEYS else None
+# Most WebSockets one username may hold open on this gateway process, across rooms; off (0) unless set
+MAX_USER_CONNECTIONS = int(os.environ.get("MAX_USER_CONNECTIONS", "0"))
+
+
+async def publish_message(room: str, message: Envelope):
+    """Hands a new message to its room's history consumer, which saves it and then publishes it to the room."""
+    try:
+        await broker.publish(ingest_channel(room, INGEST_SHARDS), message.encode())
+    except Exception as e:
+        logger.error(f"Error publishing to {broker.name} broker: {e}")
+
+
+gateway = Gateway(
+    broker,
+    history_store,
+    publish_message,
+    recent_cache,
+    presence,
+    rate_limiter,
+    fanout_queue_size=FANOUT_QUEUE_SIZE,
+    fanout_policy=FANOUT_OVERFLOW_POLICY,
+    follow_channels=True,
+    resume_max_messages=RESUME_MAX_MESSAGES,
+    verifier=token_verifier,
+    max_user_connections=MAX_USER_CONNECTIONS,
+)
+
+# Prometheus metrics served on /metrics
+metrics = Registry()
+gateway.register_metrics(metrics)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    broker.start()
+    presence.start()
+    yield
+    await presence.close()
+    await broker.close()
+    await redis_client.aclose()
+
+# Responses are rendered with the fastest JSON library installed (see common/serializer.py)
+app = FastAPI(lifespan=lifespan, default_response_class=JSONResponse)
+
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
+
+@app.websocket("/ws/{room}")
+async def websocket_endpoint(
+    websocket: WebSocket,
+    room: str,
+    after: Optional[int] = Query(None, ge=0),
+    username: Optional[str] = Query(None, min_length=1),
+    token: Optional[str] = Query(None),
+):
+    """A client's session in a room; with `after`, the messages it missed since that seq are replayed first."""
+    await gateway.serve(websocket, room, after, username, token)
+
+
+@app.get("/presence/{room}")
+async def get_presence(room: str):
+    """Who is connected to the room, through any gateway."""
+    members = await presence.members(room)
+    return {"chat_room": room, "count": len(members), "members": members}
+
+
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus metrics of this gateway process."""
+    return Response(metrics.render(), media_type=CONTENT_TYPE)
+
+
+@app.get("/stats")
+async def get_stats():
+    """Internal counters of this gateway process."""
+    return {"rooms": len(gateway.registry.rooms), "connections": len(gateway.registry), **gateway.stats()}
+
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(app, host="0.0.0.0", port=5001)
@@ -0,0 +1 @@
+"""Building blocks shared by the chat servers (history storage, fan-out, messaging)."""
@@ -0,0 +1,262 @@
+"""
+Message bus between the WebSocket servers of a room, selected with CHAT_BROKER.
+
+- "inprocess": channels live in this process and publishing calls the
+  subscriber's handler directly. No network hop and no Redis, for a
+  single-node deployment (one process serves every client) and for running
+  the servers without any services.
+- "redis": Redis pub/sub, one PUBLISH round trip per message; every process
+  subscribes through a single multiplexed connection (see PubSubRouter).
+- "batching": Redis pub/sub with the publishes of concurrent senders
+  pipelined into one round trip, in the order they were published. A batch
+  is sent `linger` seconds after its first message (sooner once it holds
+  `max_batch` messages), so a burst costs one round trip per batch instead of
+  one per message and no message waits more than `linger` for its batch.
+
+All backends deliver a channel's messages in publish order to the handler
+registered for it, as the bytes that were published.
+"""
+import asyncio
+import logging
+from typing import Dict, List, Optional, Tuple
+
+import redis.asyncio as redis
+
+from .pubsub_router import MessageHandler, PubSubRouter
+
+logger = logging.getLogger(__name__)
+
+BROKERS = ("inprocess", "redis", "batching")
+# Most publishes sent to Redis in one pipeline by the batching broker
+PUBLISH_BATCH = 500
+# Longest a publish waits for others to share its pipeline, in seconds
+PUBLISH_LINGER = 0.001
+
+
+class BrokerStats:
+    def __init__(self):
+        self.published = 0
+        self.batches = 0
+        self.publish_errors = 0
+
+    def snapshot(self) -> dict:
+        return dict(vars(self))
+
+
+class Broker:
+    """Publish/subscribe of encoded envelopes by channel (a room name or an ingest channel)."""
+
+    name = ""
+    # Whether other processes see what is published (needed in cluster mode)
+    shared = False
+
+    def __init__(self):
+        self.stats = BrokerStats()
+
+    @property
+    def channels(self) -> int:
+        """Channels subscribed by this process."""
+        raise NotImplementedError
+
+    def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def publish(self, channel: str, message: bytes):
+        raise NotImplementedError
+
+    async def subscribe(self, channel: str, handler: MessageHandler):
+        """Route messages published on `channel` to `handler` (replacing any previous handler)."""
+        raise NotImplementedError
+
+    async def unsubscribe(self, channel: str):
+        raise NotImplementedError
+
+
+class InProcessBroker(Broker):
+    """Channels of this process only: publishing awaits the subscriber's handler, if any."""
+
+    name = "inprocess"
+
+    def __init__(self):
+        super().__init__()
+        self._handlers: Dict[str, MessageHandler] = {}
+
+    @property
+    def channels(self) -> int:
+        return len(self._handlers)
+
+    async def close(self):
+        self._handlers.clear()
+
+    async def publish(self, channel: str, message: bytes):
+        self.stats.published += 1
+        handler = self._handlers.get(channel)
+        if handler is None:
+            return
+        try:
+            await handler(message)
+        except Exception as e:
+            # As with Redis, a failing subscriber is not the publisher's error
+            logger.error(f"Error dispatching message on channel {channel}: {e}")
+
+    async def subscribe(self, channel: str, handler: MessageHandler):
+        self._handlers[channel] = handler
+
+    async def unsubscribe(self, channel: str):
+        self._handlers.pop(channel, None)
+
+
+class RedisBroker(Broker):
+    """Redis pub/sub: PUBLISH per message, all subscriptions multiplexed over one connection."""
+
+    name = "redis"
+    shared = True
+
+    def __init__(self, redis_client: redis.Redis):
+        super().__init__()
+        self.redis_client = redis_client
+        self.router = PubSubRouter(redis_client)
+
+    @property
+    def channels(self) -> int:
+        return self.router.channels
+
+    def start(self):
+        self.router.start()
+
+    async def close(self):
+        await self.router.close()
+
+    async def publish(self, channel: str, message: bytes):
+        try:
+            await self.redis_client.publish(channel, message)
+        except Exception:
+            self.stats.publish_errors += 1
+            raise
+        self.stats.published += 1
+
+    async def subscribe(self, channel: str, handler: MessageHandler):
+        await self.router.subscribe(channel, handler)
+
+    async def unsubscribe(self, channel: str):
+        await self.router.unsubscribe(channel)
+
+
+class BatchingRedisBroker(RedisBroker):
+    """Redis pub/sub with publishes collected for up to `linger` seconds (or `max_batch` messages) into one pipeline.
+
+    Publishes queued while a pipeline is in flight go out together in the
+    next one. A single task sends the pipelines one after the other, so
+    messages reach Redis, and every room's subscribers, in the order they
+    were published. publish() returns once its pipeline has been executed,
+    and raises if it failed.
+    """
+
+    name = "batching"
+
+    def __init__(self, redis_client: redis.Redis, max_batch: int = PUBLISH_BATCH, linger: float = PUBLISH_LINGER):
+        super().__init__(redis_client)
+        self.max_batch = max(1, max_batch)
+        self.linger = linger
+        # (channel, message, future, loop time it was queued)
+        self._queue: "asyncio.Queue[Tuple[str, bytes, asyncio.Future, float]]" = asyncio.Queue()
+        # Set once enough messages are queued to fill a batch, ending its linger early
+        self._full = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        super().start()
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            # Send what is already queued before stopping
+            await self._queue.join()
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await super().close()
+
+    async def publish(self, channel: str, message: bytes):
+        await self.submit(channel, message)
+
+    def submit(self, channel: str, message: bytes) -> asyncio.Future:
+        """Queue a message without waiting; the returned future resolves once its pipeline has been sent.
+
+        Messages are sent in the order they are submitted. Failures are logged here, so the future may be dropped.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        future.add_done_callback(_retrieve)
+        self._queue.put_nowait((channel, message, future, loop.time()))
+        # The sender task holds the batch's first message while it lingers
+        if self._queue.qsize() + 1 >= self.max_batch:
+            self._full.set()
+        return future
+
+    async def _run(self):
+        while True:
+            batch: List[Tuple[str, bytes, asyncio.Future, float]] = [await self._queue.get()]
+            # Counted from when the first message was queued, which includes any wait for the previous pipeline
+            remaining = batch[0][3] + self.linger - asyncio.get_running_loop().time()
+            if remaining > 0 and self._queue.qsize() + 1 < self.max_batch:
+                self._full.clear()
+                try:
+                    await asyncio.wait_for(self._full.wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+            while len(batch) < self.max_batch and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            try:
+                pipe = self.redis_client.pipeline(transaction=False)
+                for channel, message, _, _ in batch:
+                    pipe.publish(channel, message)
+                await pipe.execute()
+                self.stats.published += len(batch)
+                self.stats.batches += 1
+                for _, _, future, _ in batch:
+                    if not future.done():
+                        future.set_result(None)
+            except Exception as e:
+                self.stats.publish_errors += len(batch)
+                logger.error(f"Error publishing {len(batch)} messages to Redis: {e}")
+                for _, _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+
+def _retrieve(future: asyncio.Future):
+    # Marks the exception as retrieved: failed batches are already logged by the broker
+    if not future.cancelled():
+        future.exception()
+
+
+def create_broker(
+    name: str,
+    redis_client: Optional[redis.Redis] = None,
+    max_batch: int = PUBLISH_BATCH,
+    linger: float = PUBLISH_LINGER,
+) -> Broker:
+    """The broker called `name` (one of BROKERS); the Redis backends need `redis_client`.
+
+    `max_batch` and `linger` only apply to the batching broker.
+    """
+    if name == "inprocess":
+        return InProcessBroker()
+    if name not in BROKERS:
+        raise ValueError(f"Unknown CHAT_BROKER '{name}', expected one of {', '.join(BROKERS)}")
+    if redis_client is None:
+        raise ValueError(f"CHAT_BROKER '{name}' needs a Redis client")
+    if name == "batching":
+        return BatchingRedisBroker(redis_client, max_batch=max_batch, linger=linger)
+    return RedisBroker(redis_client)
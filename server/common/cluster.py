@@ -0,0 +1,65 @@
+import time
+import zlib
+from typing import Iterable, List
+
+import redis.asyncio as redis
+
+from .serializer import dumps
+
+# Hash of every room in the cluster: room name -> JSON metadata
+ROOMS_KEY = "chat:rooms"
+# Workers publish new messages (envelopes without a seq) to "chat:ingest:<shard>";
+# each shard is consumed by exactly one history consumer
+INGEST_CHANNEL_PREFIX = "chat:ingest:"
+
+
+def ingest_shard(room: str, shards: int) -> int:
+    """The ingest shard of a room. Stable across processes and machines (unlike hash())."""
+    return zlib.crc32(room.encode("utf-8")) % shards
+
+
+def shard_channel(shard: int) -> str:
+    return f"{INGEST_CHANNEL_PREFIX}{shard}"
+
+
+def ingest_channel(room: str, shards: int) -> str:
+    return shard_channel(ingest_shard(room, shards))
+
+
+def parse_shards(value: str, shards: int) -> List[int]:
+    """Shards listed as "0,2,5" (or empty for all of them)."""
+    if not value.strip():
+        return list(range(shards))
+    owned = sorted({int(part) for part in value.split(",") if part.strip()})
+    for shard in owned:
+        if not 0 <= shard < shards:
+            raise ValueError(f"Shard {shard} is out of range for {shards} ingest shards")
+    return owned
+
+
+class RoomDirectory:
+    """Room metadata shared by every worker of a cluster, kept in a Redis hash.
+
+    HSETNX makes creation atomic, so two workers racing to create the same
+    room cannot both succeed (which the os.path.exists check in local mode allows).
+    """
+
+    def __init__(self, redis_client: redis.Redis, key: str = ROOMS_KEY):
+        self.redis_client = redis_client
+        self.key = key
+
+    async def create(self, room: str, created_by: str) -> bool:
+        """Register a room. Returns False if it already exists."""
+        metadata = dumps({"created_by": created_by, "created_at": time.time()})
+        return bool(await self.redis_client.hsetnx(self.key, room, metadata))
+
+    async def exists(self, room: str) -> bool:
+        return bool(await self.redis_client.hexists(self.key, room))
+
+    async def adopt(self, rooms: Iterable[str]) -> int:
+        """Register rooms that already have a history on disk. Returns how many were new."""
+        pipe = self.redis_client.pipeline(transaction=False)
+        metadata = dumps({"created_by": None, "created_at": None})
+        for room in rooms:
+            pipe.hsetnx(self.key, room, metadata)
+        return sum(bool(added) for added in await pipe.execute())
@@ -0,0 +1,167 @@
+"""
+Binary envelope carrying a chat message from publish to history file to WebSocket.
+
+    +------+------+---------+-------------+----------+------------+----------+------+--------+------+
+    | 0xFE | kind | seq u64 | time ms u64 | room u16 | sender u16 | body u32 | room | sender | body |
+    +------+------+---------+-------------+----------+------------+----------+------+--------+------+
+
+Integers are big-endian and strings UTF-8. The fixed header carries the string
+lengths, so records are self-delimiting: they can be stored or sent back to
+back and decoded without scanning. 0xFE never starts UTF-8 text, which is how a
+history file tells envelopes apart from the plain-text lines written before.
+
+`seq` is the message's position in its room (1-based, gap-free, assigned by the
+room's writer); 0 means "not persisted", e.g. a notice sent to one client or
+a presence digest.
+"""
+import json
+import struct
+import time
+from typing import List, Optional, Tuple
+
+HEADER = struct.Struct("!BBQQHHI")
+MAGIC = 0xFE
+# Longest room name and sender the header can describe, in UTF-8 bytes (u16 lengths)
+MAX_NAME_BYTES = 0xFFFF
+
+# Kinds
+MESSAGE = 1  # something a user said
+EVENT = 2    # a notice from the server (room created, errors)
+PRESENCE = 3  # who joined and left since the last digest, as JSON; never persisted (see presence.py)
+KINDS = (MESSAGE, EVENT, PRESENCE)
+
+
+class EnvelopeError(ValueError):
+    """The bytes are not a complete, valid envelope."""
+
+
+def fits_name(value: str) -> bool:
+    """Whether a room name or sender fits in an envelope."""
+    return len(value) <= MAX_NAME_BYTES // 4 or len(value.encode("utf-8")) <= MAX_NAME_BYTES
+
+
+def now_ms() -> int:
+    return int(time.time() * 1000)
+
+
+class Envelope:
+    __slots__ = ("kind", "room", "seq", "sender", "timestamp", "body")
+
+    def __init__(
+        self,
+        kind: int,
+        room: str,
+        body: str,
+        sender: str = "",
+        seq: int = 0,
+        timestamp: Optional[int] = None,
+    ):
+        self.kind = kind
+        self.room = room
+        self.body = body
+        self.sender = sender
+        self.seq = seq
+        self.timestamp = now_ms() if timestamp is None else timestamp
+
+    @property
+    def text(self) -> str:
+        """How the message reads as a line of chat."""
+        if self.kind == MESSAGE and self.sender:
+            return f"{self.sender}: {self.body}"
+        if self.kind == PRESENCE:
+            return presence_text(self.body)
+        return self.body
+
+    def encode(self) -> bytes:
+        room = self.room.encode("utf-8")
+        sender = self.sender.encode("utf-8")
+        body = self.body.encode("utf-8")
+        return HEADER.pack(MAGIC, self.kind, self.seq, self.timestamp, len(room), len(sender), len(body)) + room + sender + body
+
+    def __len__(self) -> int:
+        """Approximate encoded size; exact for ASCII text."""
+        return HEADER.size + len(self.room) + len(self.sender) + len(self.body)
+
+    def to_dict(self) -> dict:
+        return {
+            "seq": self.seq,
+            "kind": self.kind,
+            "sender": self.sender,
+            "timestamp": self.timestamp,
+            "body": self.body,
+            "message": self.text,
+        }
+
+    def __repr__(self) -> str:
+        return f"Envelope(kind={self.kind}, room={self.room!r}, seq={self.seq}, sender={self.sender!r}, body={self.body!r})"
+
+
+def presence_text(body: str) -> str:
+    """A presence digest as a line of chat, e.g. "🔵 alice, bob joined · 🔴 carol left (12 online)"."""
+    try:
+        digest = json.loads(body)
+    except ValueError:
+        return body
+    parts = []
+    for change, icon in (("joined", "🔵"), ("left", "🔴")):
+        names = digest.get(change)
+        if names:
+            more = digest.get(f"more_{change}", 0)
+            parts.append(f"{icon} {', '.join(names)}{f' and {more} more' if more else ''} {change}")
+    return f"{' · '.join(parts)} ({digest.get('count', 0)} online)"
+
+
+def is_envelope(data: bytes, offset: int = 0) -> bool:
+    return len(data) > offset and data[offset] == MAGIC
+
+
+def record_size(data: bytes, offset: int = 0) -> Optional[int]:
+    """Total size of the envelope starting at `offset`, or None if its header is incomplete."""
+    if len(data) - offset < HEADER.size:
+        return None
+    magic, _, _, _, room_len, sender_len, body_len = HEADER.unpack_from(data, offset)
+    if magic != MAGIC:
+        raise EnvelopeError("Not an envelope")
+    return HEADER.size + room_len + sender_len + body_len
+
+
+def peek_seq(data: bytes, offset: int = 0) -> int:
+    """The seq of the envelope starting at `offset`, read from its header without decoding the strings."""
+    if len(data) - offset < HEADER.size:
+        raise EnvelopeError("Truncated envelope header")
+    if data[offset] != MAGIC:
+        raise EnvelopeError("Not an envelope")
+    return HEADER.unpack_from(data, offset)[2]
+
+
+def decode(data: bytes, offset: int = 0) -> Tuple[Envelope, int]:
+    """Decode the envelope starting at `offset`. Returns it with the offset just past it."""
+    if len(data) - offset < HEADER.size:
+        raise EnvelopeError("Truncated envelope header")
+    magic, kind, seq, timestamp, room_len, sender_len, body_len = HEADER.unpack_from(data, offset)
+    if magic != MAGIC:
+        raise EnvelopeError("Not an envelope")
+    start = offset + HEADER.size
+    end = start + room_len + sender_len + body_len
+    if len(data) < end:
+        raise EnvelopeError("Truncated envelope")
+    view = memoryview(data)
+    try:
+        room = str(view[start:start + room_len], "utf-8")
+        sender = str(view[start + room_len:start + room_len + sender_len], "utf-8")
+        body = str(view[start + room_len + sender_len:end], "utf-8")
+    except UnicodeDecodeError as e:
+        raise EnvelopeError(f"Invalid envelope text: {e}")
+    finally:
+        view.release()
+    return Envelope(kind, room, body, sender, seq, timestamp), end
+
+
+def decode_all(data: bytes) -> List[Envelope]:
+    """Decode envelopes sent back to back, e.g. a coalesced WebSocket frame."""
+    envelopes = []
+    offset = 0
+    while offset < len(data):
+        envelope, offset = decode(data, offset)
+        envelopes.append(envelope)
+    return envelopes
@@ -0,0 +1,201 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, Iterable, List, Optional, Union
+
+from fastapi import WebSocket
+
+logger = logging.getLogger(__name__)
+
+# What happens to a client whose outgoing queue is full:
+# drop_oldest: discard its oldest queued message to make room
+# coalesce:    merge everything queued (plus the new message) into a single message
+# disconnect:  close the client; it can reconnect and reload history
+OVERFLOW_POLICIES = ("drop_oldest", "coalesce", "disconnect")
+
+# WebSocket close code "Try Again Later", sent to clients dropped for falling behind
+CLOSE_TOO_SLOW = 1013
+
+
+class Frame:
+    """An outgoing message serialized once and shared by every recipient.
+
+    The ASGI send event is built a single time. Bytes payloads (encoded
+    envelopes) go out as binary frames, so the server only has to frame and
+    write the same bytes for each socket; strings go out as text frames.
+    A broadcast frame also counts the recipients it still has to reach, to
+    report how long delivery to the whole room took.
+    """
+
+    __slots__ = ("payload", "event", "created", "pending")
+
+    def __init__(self, payload: Union[str, bytes]):
+        self.payload = payload
+        self.created = 0.0
+        self.pending = 0
+        if isinstance(payload, bytes):
+            self.event = {"type": "websocket.send", "bytes": payload}
+        else:
+            self.event = {"type": "websocket.send", "text": payload}
+
+
+def join_lines(frames: List[Frame]) -> Frame:
+    """Default coalescing: text messages one per line, binary payloads (self-delimiting envelopes) back to back."""
+    if all(isinstance(frame.payload, str) for frame in frames):
+        return Frame("\n".join(frame.payload for frame in frames))
+    return Frame(b"".join(frame.event.get("bytes") or frame.payload.encode("utf-8") for frame in frames))
+
+
+class FanOutStats:
+    def __init__(self):
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.disconnected = 0
+        self.send_errors = 0
+
+    def snapshot(self) -> dict:
+        return dict(vars(self))
+
+
+class ClientWriter:
+    """Bounded outgoing queue of one WebSocket, drained by its own writer task."""
+
+    def __init__(self, websocket: WebSocket, fanout: "FanOut"):
+        self.websocket = websocket
+        self.fanout = fanout
+        self.queue: Deque[Frame] = deque()
+        self.closed = False
+        self._ready = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    def enqueue(self, frame: Frame):
+        """Queue a frame without waiting, applying the overflow policy if the queue is full."""
+        if self.closed:
+            return
+        fanout = self.fanout
+        if len(self.queue) >= fanout.max_queue:
+            if fanout.policy == "drop_oldest":
+                self.queue.popleft()
+                fanout.stats.dropped += 1
+            elif fanout.policy == "coalesce":
+                fanout.stats.coalesced += len(self.queue)
+                merged = fanout.coalesce(list(self.queue) + [frame])
+                self.queue.clear()
+                self.queue.append(merged)
+                self._ready.set()
+                return
+            else:
+                fanout.stats.disconnected += 1
+                self.close()
+                asyncio.create_task(self._close_websocket())
+                return
+        self.queue.append(frame)
+        self._ready.set()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.queue.clear()
+            self._task.cancel()
+
+    async def _close_websocket(self):
+        try:
+            await self.websocket.close(code=CLOSE_TOO_SLOW)
+        except Exception:
+            pass
+
+    async def _run(self):
+        queue = self.queue
+        while True:
+            await self._ready.wait()
+            self._ready.clear()
+            while queue:
+                frame = queue.popleft()
+                try:
+                    await self.websocket.send(frame.event)
+                    self.fanout.stats.sent += 1
+                    if frame.pending:
+                        frame.pending -= 1
+                        if not frame.pending:
+                            self.fanout.on_delivered(time.monotonic() - frame.created)
+                except Exception as e:
+                    self.fanout.stats.send_errors += 1
+                    logger.error(f"Failed to send message to a client: {e}")
+                    self.close()
+                    return
+
+
+class FanOut:
+    """Delivers messages to many WebSockets without letting a slow client hold up the others.
+
+    Each registered WebSocket gets a ClientWriter; broadcasting only appends to
+    the writers' queues, so delivery to every client proceeds concurrently and a
+    stalled client only ever fills its own bounded queue. `on_delivered` is
+    called with the seconds from a broadcast to its last recipient's socket
+    write (frames dropped or coalesced on the way are not reported).
+    """
+
+    def __init__(
+        self,
+        max_queue: int = 256,
+        policy: str = "drop_oldest",
+        coalesce: Callable[[List[Frame]], Frame] = join_lines,
+        on_delivered: Optional[Callable[[float], None]] = None,
+    ):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy '{policy}', expected one of {OVERFLOW_POLICIES}")
+        self.max_queue = max_queue
+        self.policy = policy
+        self.coalesce = coalesce
+        self.on_delivered = on_delivered
+        self.stats = FanOutStats()
+        self.writers: Dict[WebSocket, ClientWriter] = {}
+
+    @property
+    def queued(self) -> int:
+        return sum(len(writer.queue) for writer in self.writers.values())
+
+    def register(self, websocket: WebSocket) -> ClientWriter:
+        writer = self.writers.get(websocket)
+        if writer is None:
+            writer = self.writers[websocket] = ClientWriter(websocket, self)
+        return writer
+
+    def unregister(self, websocket: WebSocket):
+        writer = self.writers.pop(websocket, None)
+        if writer is not None:
+            writer.close()
+
+    def frame(self, message: Union[str, bytes, Frame]) -> Frame:
+        if isinstance(message, Frame):
+            return message
+        return Frame(message)
+
+    def send(self, websocket: WebSocket, message: Union[str, bytes, Frame]):
+        """Queue a message for a single client, in order with its broadcasts."""
+        writer = self.writers.get(websocket)
+        if writer is not None:
+            writer.enqueue(self.frame(message))
+
+    def broadcast(self, websockets: Iterable[WebSocket], message: Union[str, bytes, Frame]):
+        """Queue a message for every given client. Never waits on a client.
+
+        The message is turned into a single Frame up front and the same object
+        is queued for every recipient.
+        """
+        frame = self.frame(message)
+        writers = self.writers
+        if self.on_delivered is None:
+            for websocket in websockets:
+                writer = writers.get(websocket)
+                if writer is not None:
+                    writer.enqueue(frame)
+            return
+
+        recipients = [writers[websocket] for websocket in websockets if websocket in writers]
+        frame.created = time.monotonic()
+        frame.pending = len(recipients)
+        for writer in recipients:
+            writer.enqueue(frame)
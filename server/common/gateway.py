@@ -0,0 +1,360 @@
+"""
+WebSocket sessions of chat clients, shared by the history service and the chat gateway.
+
+A Gateway terminates the WebSockets of one process: it keeps the rooms'
+connections, subscribes a room's channel on the broker while the room has
+clients here, fans every message published there out to them, replays what a
+reconnecting client missed, announces presence and rate-limits what clients
+send. With a token verifier, a client proves who it is once, when it connects;
+the messages it sends are then attributed to that username. New messages are
+handed to `submit`, which decides how they are saved and published (appended
+to history here, or sent to a history consumer).
+"""
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, List, Optional
+
+from fastapi import WebSocket, WebSocketDisconnect
+from fastapi.requests import HTTPConnection
+
+from .broker import Broker
+from .envelope import EVENT, MESSAGE, Envelope, EnvelopeError, decode, fits_name, peek_seq
+from .fanout import FanOut
+from .history_store import HistoryStore
+from .metrics import Counter, Histogram, Registry
+from .presence import PresenceTracker
+from .ratelimit import CLOSE_TOO_BIG, TOO_LARGE, RateLimiter, message_size
+from .recent_cache import RecentMessageCache
+from .registry import Connection, ConnectionRegistry
+from .serializer import loads
+from .tokens import TokenError, TokenVerifier
+
+logger = logging.getLogger(__name__)
+
+# WebSocket close code "Policy Violation", sent to clients whose token is missing or invalid
+CLOSE_POLICY_VIOLATION = 1008
+
+# Replayed envelopes are sent back to back in binary frames of about this size
+RESUME_FRAME_BYTES = 64 * 1024
+
+# Called with a room and a new chat message to save and publish it
+Submit = Callable[[str, Envelope], Awaitable[None]]
+
+
+class ResumeStats:
+    def __init__(self):
+        self.resumed = 0
+        self.from_cache = 0
+        self.replayed_messages = 0
+        self.replayed_bytes = 0
+
+    def snapshot(self) -> dict:
+        return dict(vars(self))
+
+
+class Gateway:
+    """The WebSocket clients of one process and the rooms they are in.
+
+    With `follow_channels`, messages are saved by another process (a history
+    consumer): the cached tail of a room is then kept current from its channel
+    while it has clients here, and dropped when the last one leaves.
+    """
+
+    def __init__(
+        self,
+        broker: Broker,
+        history_store: HistoryStore,
+        submit: Submit,
+        recent_cache: RecentMessageCache,
+        presence: PresenceTracker,
+        rate_limiter: RateLimiter,
+        fanout_queue_size: int = 256,
+        fanout_policy: str = "drop_oldest",
+        follow_channels: bool = False,
+        resume_max_messages: int = 1000,
+        verifier: Optional[TokenVerifier] = None,
+        max_user_connections: int = 0,
+    ):
+        self.broker = broker
+        self.history_store = history_store
+        self.submit = submit
+        self.recent_cache = recent_cache
+        self.presence = presence
+        self.rate_limiter = rate_limiter
+        self.follow_channels = follow_channels
+        self.resume_max_messages = resume_max_messages
+        self.verifier = verifier
+        # Most WebSockets a username may hold open on this process, across rooms (0 = unlimited)
+        self.max_user_connections = max_user_connections
+        self.resume_stats = ResumeStats()
+
+        self.receive_to_publish_seconds = Histogram(
+            "chat_receive_to_publish_seconds",
+            "From a chat message being received on a WebSocket to its publish to the broker (after the history append in local mode)",
+        )
+        self.publish_to_deliver_seconds = Histogram(
+            "chat_publish_to_deliver_seconds",
+            "From a message arriving on its room's channel to the socket write to the room's last client on this process",
+        )
+        self.fanout_seconds = Histogram(
+            "chat_fanout_seconds",
+            "Time to queue a message for every client of its room on this process",
+        )
+        self.messages_received = Counter("chat_messages_received_total", "Chat messages accepted from WebSockets")
+
+        # Outgoing messages are queued per client; a client whose queue overflows is handled by the policy.
+        # Clients receive every message as the encoded envelope published to the broker, forwarded untouched.
+        self.fanout = FanOut(
+            max_queue=fanout_queue_size,
+            policy=fanout_policy,
+            on_delivered=self.publish_to_deliver_seconds.observe,
+        )
+        # WebSocket connections of this process per chat room. A resuming client stays pending, with
+        # live messages held for it, until its missed messages have been replayed.
+        self.registry = ConnectionRegistry()
+
+    def register_metrics(self, metrics: Registry):
+        """Add the gateway's metrics to a process's registry."""
+        for metric in (
+            self.receive_to_publish_seconds,
+            self.publish_to_deliver_seconds,
+            self.fanout_seconds,
+            self.messages_received,
+        ):
+            metrics.register(metric)
+        fanout, registry, broker, rate_limiter = self.fanout, self.registry, self.broker, self.rate_limiter
+        metrics.gauge("chat_connections", "WebSocket clients connected to this process", lambda: len(fanout.writers))
+        metrics.gauge("chat_rooms", "Rooms with clients on this process", lambda: len(registry.rooms))
+        metrics.gauge("chat_pubsub_channels", "Channels subscribed by this process", lambda: broker.channels)
+        metrics.counter("chat_broker_published_total", "Messages published to the broker by this process", lambda: broker.stats.published)
+        metrics.counter("chat_broker_batches_total", "Pipelines sent by the batching broker", lambda: broker.stats.batches)
+        metrics.gauge("chat_fanout_queued", "Messages waiting in the outgoing queues of all clients", lambda: fanout.queued)
+        metrics.gauge("chat_presence_rooms", "Rooms with members tracked by this process", lambda: self.presence.rooms)
+        metrics.counter("chat_fanout_sent_total", "Messages written to client sockets", lambda: fanout.stats.sent)
+        metrics.counter("chat_fanout_dropped_total", "Messages dropped for clients that fell behind", lambda: fanout.stats.dropped)
+        metrics.counter("chat_fanout_disconnected_total", "Clients disconnected for falling behind", lambda: fanout.stats.disconnected)
+        metrics.counter(
+            "chat_rate_limited_total",
+            "Messages rejected by the size and rate limits",
+            lambda: sum(count for name, count in rate_limiter.stats.snapshot().items() if name != "accepted"),
+        )
+        if self.verifier is not None:
+            verifier = self.verifier
+            metrics.counter(
+                "chat_auth_rejected_total",
+                "WebSocket connections refused for a missing or invalid token",
+                lambda: sum(count for name, count in verifier.stats.snapshot().items() if name != "verified"),
+            )
+        metrics.counter("chat_resumes_total", "WebSocket connections resumed after a seq", lambda: self.resume_stats.resumed)
+
+    def stats(self) -> dict:
+        """Counters for a /stats endpoint."""
+        return {
+            "broker": {**self.broker.stats.snapshot(), "backend": self.broker.name, "channels": self.broker.channels},
+            "fanout": {**self.fanout.stats.snapshot(), "clients": len(self.fanout.writers), "queued": self.fanout.queued},
+            "recent_cache": self.recent_cache.stats(),
+            "resume": self.resume_stats.snapshot(),
+            "presence": {**self.presence.stats.snapshot(), "rooms": self.presence.rooms},
+            "rate_limit": self.rate_limiter.stats.snapshot(),
+            "auth": self.verifier.stats.snapshot() if self.verifier is not None else None,
+        }
+
+    # ====== Sessions ======
+
+    async def serve(
+        self,
+        websocket: WebSocket,
+        room: str,
+        after: Optional[int] = None,
+        username: Optional[str] = None,
+        token: Optional[str] = None,
+    ):
+        """Run one client's session until it disconnects.
+
+        With `after`, the seq of the last message the client saw, the messages it missed are replayed first.
+        The client's username comes from its token (?token= or an "Authorization: Bearer" header) when
+        the gateway has a verifier, and is taken on trust from `username` otherwise. A client with a
+        username is listed in the room's presence and may send messages; without one it only reads.
+        A username already holding `max_user_connections` WebSockets on this process is refused.
+        """
+        if self.verifier is not None:
+            try:
+                username = self.verifier.verify(token or bearer_token(websocket))
+            except TokenError as e:
+                logger.warning(f"WebSocket refused for room {room}: {e.reason} token")
+                # Closing before the handshake is accepted answers it with HTTP 403
+                await websocket.close(code=CLOSE_POLICY_VIOLATION)
+                return
+        if not fits_name(room) or (username and not fits_name(username)):
+            logger.warning("WebSocket refused: room name or username too long")
+            await websocket.close(code=CLOSE_POLICY_VIOLATION)
+            return
+        if username and self.max_user_connections:
+            if len(self.registry.connections_of(username)) >= self.max_user_connections:
+                logger.warning(f"WebSocket refused for room {room}: {username} already has {self.max_user_connections} connections")
+                await websocket.close(code=CLOSE_POLICY_VIOLATION)
+                return
+        await websocket.accept()
+        logger.info(f"WebSocket connected for room: {room}")
+
+        # Register the client and subscribe to the room's channel if this is its first client here
+        connection, first = self.registry.connect(room, websocket, username, live=after is None)
+        self.fanout.register(websocket)
+        if username:
+            self.presence.join(room, username)
+
+        try:
+            if first:
+                await self.broker.subscribe(room, lambda message: self.deliver(room, message))
+            if after is not None:
+                await self.resume(connection, after)
+
+            bucket = self.rate_limiter.connection()
+            # Whether the client was told it is sending too fast since its last accepted message
+            throttled = False
+            while True:
+                message = await websocket.receive()
+                if message["type"] == "websocket.disconnect":
+                    raise WebSocketDisconnect(message.get("code", 1000))
+
+                rejected = self.rate_limiter.check(room, bucket, message_size(message))
+                if rejected == TOO_LARGE:
+                    await websocket.close(code=CLOSE_TOO_BIG, reason="Message too large")
+                    break
+                if rejected:
+                    if not throttled:
+                        throttled = True
+                        notice = Envelope(EVENT, room, "❌ Too many messages, slow down. Messages are being dropped.")
+                        self.fanout.send(websocket, notice.encode())
+                    continue
+                throttled = False
+                received = time.monotonic()
+
+                if not username:
+                    notice = Envelope(EVENT, room, "❌ Connect with a username to send messages.")
+                    self.fanout.send(websocket, notice.encode())
+                    continue
+                # The sender is whoever the connection was opened as; any "username" sent along is ignored
+                try:
+                    data = loads(message.get("text") or message.get("bytes"))
+                except (ValueError, TypeError):
+                    # Not JSON (or an empty frame): answered like any other malformed message
+                    data = None
+                message_content = data.get("message") if isinstance(data, dict) else None
+                if not message_content or not isinstance(message_content, str):
+                    notice = Envelope(EVENT, room, "❌ Invalid message format. Use {'message': '<text>'}")
+                    self.fanout.send(websocket, notice.encode())
+                    continue
+
+                await self.submit(room, Envelope(MESSAGE, room, message_content, username))
+                self.messages_received.inc()
+                self.receive_to_publish_seconds.observe(time.monotonic() - received)
+
+        except WebSocketDisconnect:
+            logger.warning(f"WebSocket disconnected for room: {room}")
+        except Exception as e:
+            logger.error(f"WebSocket error: {e}")
+            await websocket.close()
+        finally:
+            if username:
+                self.presence.leave(room, username)
+            await self.remove(connection)
+
+    async def remove(self, connection: Connection):
+        """Removes a client from its room and unsubscribes the room's channel once no clients remain."""
+        self.fanout.unregister(connection.websocket)
+        if self.registry.disconnect(connection):
+            room = connection.room.name
+            self.rate_limiter.forget(room)
+            await self.broker.unsubscribe(room)
+            if self.follow_channels:
+                # No longer kept current from the room's channel
+                self.recent_cache.discard(room)
+
+    async def deliver(self, room: str, message: bytes):
+        """Queues an encoded envelope received from the broker for all clients of the room connected to this process."""
+        if self.follow_channels:
+            # The room's history consumer wrote it; keep this process's cached tail current
+            try:
+                envelope, _ = decode(message)
+                if envelope.seq:
+                    self.recent_cache.append(room, envelope, envelope.seq)
+            except EnvelopeError as e:
+                logger.error(f"Invalid envelope on channel {room}: {e}")
+        logger.debug("New message in %s (%d bytes)", room, len(message))
+        clients = self.registry.room(room)
+        if clients is None:
+            return
+        for connection in clients.pending.values():
+            connection.held.append(message)
+        started = time.monotonic()
+        self.fanout.broadcast(clients.live, message)
+        self.fanout_seconds.observe(time.monotonic() - started)
+
+    # ====== Resume ======
+
+    async def resume(self, connection: Connection, after: int):
+        """Replays the messages a reconnecting client missed since seq `after`, then switches it to live delivery.
+
+        The room's channel is subscribed before the history is read, and live messages arriving meanwhile are
+        held back, so the client sees every message exactly once and in order: held messages already covered
+        by the replay are dropped, and a gap before one (published before the subscription took effect) is
+        filled from the history store.
+        """
+        room = connection.room.name
+        websocket = connection.websocket
+        held = connection.held
+        last = self.replay(websocket, await self.missed_messages(room, after), after)
+        while held:
+            message = held.popleft()
+            try:
+                seq = peek_seq(message)
+            except EnvelopeError:
+                seq = 0
+            if seq and seq <= last:
+                continue
+            if seq > last + 1:
+                gap = await asyncio.to_thread(self.history_store.read_range, room, last + 1, seq)
+                last = self.replay(websocket, gap, last)
+            self.fanout.send(websocket, message)
+            last = max(last, seq)
+        # Nothing is held and nothing awaited since, so no live message can fall between replay and delivery
+        self.registry.go_live(connection)
+        self.resume_stats.resumed += 1
+        logger.info(f"WebSocket resumed for room {room} from seq {after} to {last}")
+
+    async def missed_messages(self, room: str, after: int) -> List[Envelope]:
+        """The newest `resume_max_messages` messages with seq > `after`, from memory when the cached tail covers them."""
+        entries = self.recent_cache.recent(room)
+        if entries and entries[0][0] is not None and entries[0][0] <= after + 1:
+            self.resume_stats.from_cache += 1
+            return [envelope for seq, envelope in entries if seq > after]
+        return await asyncio.to_thread(self.history_store.read_tail, room, after, self.resume_max_messages)
+
+    def replay(self, websocket: WebSocket, envelopes: List[Envelope], last: int) -> int:
+        """Queues the envelopes newer than seq `last` for one client, packed into as few frames as possible.
+        Returns the seq of the last one sent."""
+        chunk = bytearray()
+        for envelope in envelopes:
+            if envelope.seq <= last:
+                continue
+            chunk += envelope.encode()
+            last = envelope.seq
+            self.resume_stats.replayed_messages += 1
+            if len(chunk) >= RESUME_FRAME_BYTES:
+                self.fanout.send(websocket, bytes(chunk))
+                self.resume_stats.replayed_bytes += len(chunk)
+                chunk.clear()
+        if chunk:
+            self.fanout.send(websocket, bytes(chunk))
+            self.resume_stats.replayed_bytes += len(chunk)
+        return last
+
+
+def bearer_token(connection: HTTPConnection) -> Optional[str]:
+    """The token of an "Authorization: Bearer <token>" header (of a request or a WebSocket handshake), if any."""
+    scheme, _, token = connection.headers.get("authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not token.strip():
+        return None
+    return token.strip()
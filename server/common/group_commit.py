@@ -0,0 +1,184 @@
+import asyncio
+import logging
+import time
+from typing import Dict, List, Optional, Set, Tuple, Union
+
+from .envelope import Envelope
+from .history_store import HistoryStore
+
+logger = logging.getLogger(__name__)
+
+# none:     write batches, never fsync (the OS decides when data reaches disk)
+# batch:    fsync after every batch, appends resolve once their batch is durable
+# interval: fsync dirty rooms at most every `fsync_interval` seconds
+DURABILITY_MODES = ("none", "batch", "interval")
+
+
+class WriterStats:
+    """Batch-size and flush-latency counters for a GroupCommitWriter."""
+
+    def __init__(self):
+        self.batches = 0
+        self.messages = 0
+        self.max_batch = 0
+        self.fsyncs = 0
+        self.flush_seconds_total = 0.0
+        self.flush_seconds_max = 0.0
+
+    def record(self, batch_size: int, flush_seconds: float):
+        self.batches += 1
+        self.messages += batch_size
+        self.max_batch = max(self.max_batch, batch_size)
+        self.flush_seconds_total += flush_seconds
+        self.flush_seconds_max = max(self.flush_seconds_max, flush_seconds)
+
+    def snapshot(self) -> dict:
+        return {
+            "batches": self.batches,
+            "messages": self.messages,
+            "avg_batch_size": self.messages / self.batches if self.batches else 0.0,
+            "max_batch_size": self.max_batch,
+            "fsyncs": self.fsyncs,
+            "avg_flush_ms": 1000 * self.flush_seconds_total / self.batches if self.batches else 0.0,
+            "max_flush_ms": 1000 * self.flush_seconds_max,
+        }
+
+
+class GroupCommitWriter:
+    """Appends messages to a HistoryStore off the event loop, grouping concurrent appends into one write.
+
+    Messages queued while a flush is running are written together by the next
+    flush, so under load the number of writes (and fsyncs) per message drops
+    instead of every message paying for its own open/write/close.
+    """
+
+    def __init__(
+        self,
+        store: HistoryStore,
+        durability: str = "interval",
+        fsync_interval: float = 1.0,
+        max_batch: int = 1000,
+    ):
+        if durability not in DURABILITY_MODES:
+            raise ValueError(f"Unknown durability mode '{durability}', expected one of {DURABILITY_MODES}")
+        self.store = store
+        self.durability = durability
+        self.fsync_interval = fsync_interval
+        self.max_batch = max_batch
+        self.stats = WriterStats()
+        self._queue: "asyncio.Queue[Tuple[str, Envelope, asyncio.Future]]" = asyncio.Queue()
+        self._task: Optional[asyncio.Task] = None
+        self._dirty: Set[str] = set()
+        self._last_fsync = time.monotonic()
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        """Flush everything queued so far, then stop the writer."""
+        if self._task is not None:
+            await self._queue.join()
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._dirty:
+            await asyncio.to_thread(self._sync)
+        self.store.close()
+
+    async def append(self, room: str, message: Envelope) -> int:
+        """Queue a message for the room's history and wait until it is written. Returns its sequence number (also set on the envelope)."""
+        return await self.submit(room, message)
+
+    def submit(self, room: str, message: Envelope) -> asyncio.Future:
+        """Queue a message without waiting; the returned future resolves to its sequence number once written.
+
+        Futures resolve in submission order, so callers can pipeline many messages and still act on them in order.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((room, message, future))
+        return future
+
+    async def _run(self):
+        while True:
+            timeout = None
+            if self.durability == "interval" and self._dirty:
+                timeout = max(self._last_fsync + self.fsync_interval - time.monotonic(), 0)
+            try:
+                first = await asyncio.wait_for(self._queue.get(), timeout)
+            except asyncio.TimeoutError:
+                await asyncio.to_thread(self._sync)
+                continue
+
+            # Everything that queued up behind the previous flush goes out in this one.
+            batch = [first]
+            while len(batch) < self.max_batch and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+
+            try:
+                results = await asyncio.to_thread(self._flush, batch)
+            except Exception as e:
+                logger.error(f"Error flushing {len(batch)} history messages: {e}")
+                results = [e] * len(batch)
+            try:
+                for (_, _, future), result in zip(batch, results):
+                    if future.done():
+                        continue
+                    if isinstance(result, Exception):
+                        future.set_exception(result)
+                    else:
+                        future.set_result(result)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _flush(self, batch: List[Tuple[str, Envelope, asyncio.Future]]) -> List[Union[int, Exception]]:
+        """Write a batch (one append per room) and return each message's sequence number, or the error that
+        kept its room from being written. Rooms fail independently. Runs in a worker thread."""
+        started = time.perf_counter()
+
+        by_room: Dict[str, List[Envelope]] = {}
+        for room, message, _ in batch:
+            by_room.setdefault(room, []).append(message)
+        # Each room's next sequence number, or the error its append raised
+        next_seqs: Dict[str, Union[int, Exception]] = {}
+        for room, messages in by_room.items():
+            try:
+                next_seqs[room] = self.store.append_many(room, messages) - len(messages) + 1
+            except Exception as e:
+                logger.error(f"Error writing {len(messages)} messages to history of {room}: {e}")
+                next_seqs[room] = e
+            else:
+                self._dirty.add(room)
+
+        # Hand out sequence numbers in batch order; each room's messages were written contiguously.
+        results: List[Union[int, Exception]] = []
+        for room, _, _ in batch:
+            result = next_seqs[room]
+            results.append(result)
+            if not isinstance(result, Exception):
+                next_seqs[room] = result + 1
+
+        if self.durability == "batch" or (
+            self.durability == "interval" and time.monotonic() - self._last_fsync >= self.fsync_interval
+        ):
+            self._sync()
+
+        self.stats.record(len(batch), time.perf_counter() - started)
+        return results
+
+    def _sync(self):
+        if self.durability == "none":
+            self._dirty.clear()
+            return
+        rooms, self._dirty = self._dirty, set()
+        self.store.sync(rooms)
+        self.stats.fsyncs += 1
+        self._last_fsync = time.monotonic()
@@ -0,0 +1,592 @@
+import gzip
+import json
+import logging
+import os
+import queue
+import struct
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from functools import lru_cache
+from typing import BinaryIO, Callable, Dict, Iterable, List, Optional, Tuple, Union
+
+from .envelope import HEADER, MESSAGE, Envelope, decode, is_envelope, record_size
+
+logger = logging.getLogger(__name__)
+
+# Each index entry is the end offset (exclusive) of one record in the data file.
+# Message `seq` (1-based) therefore spans [entry[seq - 2], entry[seq - 1]).
+INDEX_ENTRY = struct.Struct("<Q")
+
+DATA_SUFFIX = ".txt"
+INDEX_SUFFIX = ".idx"
+
+# Sealed segments of a room live in "<room>.segments/", named after their first sequence number
+SEGMENTS_SUFFIX = ".segments"
+MANIFEST_NAME = "manifest.json"
+SEQ_DIGITS = 12
+# Compressed segments are made of independently compressed blocks of about BLOCK_BYTES,
+# cut at record boundaries. The block table holds the uncompressed and compressed start
+# offset of every block, followed by an entry with both total sizes.
+BLOCK_BYTES = 64 * 1024
+BLOCK_ENTRY = struct.Struct("<QQ")
+BLOCKS_SUFFIX = ".blk"
+
+
+def _zstd_codec() -> Optional[Tuple[Callable[[bytes], bytes], Callable[[bytes], bytes]]]:
+    try:
+        from compression import zstd  # Python 3.14+
+        return zstd.compress, zstd.decompress
+    except ImportError:
+        pass
+    try:
+        import zstandard
+    except ImportError:
+        return None
+    # Compressor objects are not thread-safe; they are cheap to create per block
+    return (
+        lambda data: zstandard.ZstdCompressor(level=3).compress(data),
+        lambda data: zstandard.ZstdDecompressor().decompress(data),
+    )
+
+
+# codec -> (compress, decompress, file suffix). Concatenated blocks are a valid stream of the
+# codec, so a sealed segment can be read with zcat / zstdcat like a plain history file.
+CODECS: Dict[str, Tuple[Callable[[bytes], bytes], Callable[[bytes], bytes], str]] = {
+    "gzip": (lambda data: gzip.compress(data, compresslevel=6, mtime=0), gzip.decompress, ".gz"),
+}
+_zstd = _zstd_codec()
+if _zstd is not None:
+    CODECS["zstd"] = (*_zstd, ".zst")
+DEFAULT_CODEC = "zstd" if "zstd" in CODECS else "gzip"
+
+
+class Segment:
+    """A run of consecutive messages of a room stored in one data file.
+
+    ``path`` is the file name without suffix, relative to the store directory.
+    The last segment of a room is the active one (``last`` is None) and is
+    appended to; sealed segments never change, apart from being compressed
+    (``codec`` set, ``size`` in bytes) once.
+    """
+
+    __slots__ = ("first", "last", "path", "codec", "size", "opened_at", "sealed_at")
+
+    def __init__(
+        self,
+        first: int,
+        path: str,
+        last: Optional[int] = None,
+        codec: Optional[str] = None,
+        size: Optional[int] = None,
+        opened_at: Optional[float] = None,
+        sealed_at: Optional[float] = None,
+    ):
+        self.first = first
+        self.path = path
+        self.last = last
+        self.codec = codec
+        self.size = size
+        self.opened_at = opened_at
+        self.sealed_at = sealed_at
+
+    def replace(self, **changes) -> "Segment":
+        """A copy with some fields changed; segments are shared with readers and never modified in place."""
+        return Segment(**{**self.to_dict(), **changes})
+
+    def to_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__ if getattr(self, name) is not None}
+
+    def __repr__(self) -> str:
+        return f"Segment({self.first}..{self.last or ''}, {self.path!r}, codec={self.codec})"
+
+
+class HistoryStore:
+    """Append-only chat history per room with an offset index for O(page) reads.
+
+    ``<room>.txt`` holds one record per message: a binary envelope, or a line
+    of text for messages written before envelopes existed. ``<room>.idx``
+    holds a fixed-width end offset per record, so any page of messages can be
+    located with two seeks regardless of how large the room is. The store
+    assigns each envelope its sequence number as it is appended.
+
+    History is split into segments. Once the active segment reaches
+    `segment_bytes` (or is `segment_seconds` old) it is sealed and appends go
+    to a new segment ``<room>.segments/<first seq>.txt``. A background thread
+    then compresses the sealed segment with `codec` in independent blocks, so
+    reading an old page only decompresses the blocks it overlaps.
+    ``<room>.segments/manifest.json`` maps message ranges to segments; a room
+    without one is a single active segment ``<room>.txt``. Sealed segments are
+    immutable, so backups only need to copy new files and the manifest.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        read_only: bool = False,
+        max_open_rooms: int = 256,
+        segment_bytes: int = 8 * 1024 * 1024,
+        segment_seconds: float = 0,
+        codec: str = DEFAULT_CODEC,
+    ):
+        if codec not in CODECS:
+            raise ValueError(f"Unknown history codec '{codec}', expected one of {', '.join(CODECS)}")
+        self.directory = directory
+        self.read_only = read_only
+        self.max_open_rooms = max_open_rooms
+        self.segment_bytes = segment_bytes
+        self.segment_seconds = segment_seconds
+        self.codec = codec
+        self._lock = threading.Lock()
+        # Rooms whose index has been verified against the data file, with their message count.
+        self._counts: Dict[str, int] = {}
+        # Append handles (data, index) kept open for recently written rooms, least recently used first.
+        self._files: "OrderedDict[str, Tuple[BinaryIO, BinaryIO]]" = OrderedDict()
+        # room -> (manifest file signature, segments); writers own the manifest and never re-check it.
+        self._layouts: Dict[str, Tuple[Optional[tuple], List[Segment]]] = {}
+        # Sealed segments waiting to be compressed, as (room, first seq)
+        self._sealed: "queue.Queue[Optional[Tuple[str, int]]]" = queue.Queue()
+        self._compressor: Optional[threading.Thread] = None
+        self._closing = False
+        if not read_only:
+            os.makedirs(directory, exist_ok=True)
+
+    # ====== Paths ======
+
+    def data_path(self, room: str) -> str:
+        return os.path.join(self.directory, f"{room}{DATA_SUFFIX}")
+
+    def index_path(self, room: str) -> str:
+        return os.path.join(self.directory, f"{room}{INDEX_SUFFIX}")
+
+    def segments_dir(self, room: str) -> str:
+        return os.path.join(self.directory, f"{room}{SEGMENTS_SUFFIX}")
+
+    def manifest_path(self, room: str) -> str:
+        return os.path.join(self.segments_dir(room), MANIFEST_NAME)
+
+    def _file(self, path: str, suffix: str) -> str:
+        return os.path.join(self.directory, *path.split("/")) + suffix
+
+    # ====== Rooms ======
+
+    def exists(self, room: str) -> bool:
+        return os.path.exists(self.data_path(room)) or os.path.isdir(self.segments_dir(room))
+
+    def rooms(self) -> List[str]:
+        """Names of all rooms with a history in the directory."""
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        rooms = set()
+        for name in names:
+            for suffix in (DATA_SUFFIX, SEGMENTS_SUFFIX):
+                if name.endswith(suffix):
+                    rooms.add(name[:-len(suffix)])
+        return sorted(rooms)
+
+    def create(self, room: str) -> bool:
+        """Create an empty history for a room. Returns False if it already exists."""
+        if os.path.isdir(self.segments_dir(room)):
+            return False
+        try:
+            open(self.data_path(room), "x").close()
+        except FileExistsError:
+            return False
+        open(self.index_path(room), "wb").close()
+        with self._lock:
+            self._counts[room] = 0
+        return True
+
+    def count(self, room: str) -> int:
+        """Number of messages stored for a room."""
+        if not self.read_only:
+            with self._lock:
+                return self._ensure_index(room)
+        active = self.segments(room)[-1]
+        try:
+            return active.first - 1 + os.path.getsize(self._file(active.path, INDEX_SUFFIX)) // INDEX_ENTRY.size
+        except FileNotFoundError:
+            return active.first - 1
+
+    def segments(self, room: str) -> List[Segment]:
+        """The room's segments, oldest first; the last one is active."""
+        cached = self._layouts.get(room)
+        if cached is not None and not self.read_only:
+            return cached[1]
+        path = self.manifest_path(room)
+        try:
+            stat = os.stat(path)
+            signature = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        except FileNotFoundError:
+            signature = None
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+
+        if signature is None:
+            segments = [Segment(1, room, opened_at=time.time())]
+        else:
+            with open(path) as f:
+                segments = [Segment(**entry) for entry in json.load(f)["segments"]]
+        self._layouts[room] = (signature, segments)
+        return segments
+
+    def _save_segments(self, room: str, segments: List[Segment]):
+        """Atomically replace the room's manifest."""
+        path = self.manifest_path(room)
+        with open(path + ".tmp", "w") as f:
+            json.dump({"segments": [segment.to_dict() for segment in segments]}, f, indent=1)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+        self._layouts[room] = (None, segments)
+
+    # ====== Writes ======
+
+    def append(self, room: str, message: Union[Envelope, str]) -> int:
+        """Append a single message and return its sequence number."""
+        return self.append_many(room, [message])
+
+    def append_many(self, room: str, messages: Iterable[Union[Envelope, str]]) -> int:
+        """Append messages in order with one write per file. Returns the last sequence number.
+
+        Envelopes get their ``seq`` set to their position in the room; plain strings are written as text lines.
+        """
+        if self.read_only:
+            raise PermissionError("History store is read-only")
+        with self._lock:
+            count = self._ensure_index(room)
+            segment = self.segments(room)[-1]
+            data_file, index_file = self._open_for_append(room, segment)
+            # Index entries are offsets within the segment's own data file
+            offset = data_file.tell()
+
+            data = bytearray()
+            index = bytearray()
+            for message in messages:
+                count += 1
+                if isinstance(message, Envelope):
+                    message.seq = count
+                    data += message.encode()
+                else:
+                    data += message.encode("utf-8") + b"\n"
+                index += INDEX_ENTRY.pack(offset + len(data))
+            if not data:
+                return count
+
+            # Data goes first so a concurrent reader never sees an index entry past the data.
+            data_file.write(data)
+            index_file.write(index)
+            self._counts[room] = count
+
+            if (self.segment_bytes > 0 and offset + len(data) >= self.segment_bytes) or (
+                self.segment_seconds > 0 and time.time() - segment.opened_at >= self.segment_seconds
+            ):
+                self._seal(room, count)
+            return count
+
+    def sync(self, rooms: Optional[Iterable[str]] = None):
+        """fsync the open files of the given rooms (all open rooms by default)."""
+        with self._lock:
+            for room in list(self._files) if rooms is None else rooms:
+                files = self._files.get(room)
+                if files:
+                    for f in files:
+                        os.fsync(f.fileno())
+
+    def close(self):
+        """Close all append handles and stop compressing; unfinished segments are compressed after a restart."""
+        if self._compressor is not None:
+            self._closing = True
+            self._sealed.put(None)
+            self._compressor.join()
+            self._compressor = None
+        with self._lock:
+            while self._files:
+                _, files = self._files.popitem()
+                for f in files:
+                    f.close()
+
+    def _open_for_append(self, room: str, segment: Segment) -> Tuple[BinaryIO, BinaryIO]:
+        files = self._files.get(room)
+        if files is not None:
+            self._files.move_to_end(room)
+            return files
+        if len(self._files) >= self.max_open_rooms:
+            _, evicted = self._files.popitem(last=False)
+            for f in evicted:
+                f.close()
+        # Unbuffered so every append reaches the file with a single write() call.
+        files = (
+            open(self._file(segment.path, DATA_SUFFIX), "ab", buffering=0),
+            open(self._file(segment.path, INDEX_SUFFIX), "ab", buffering=0),
+        )
+        self._files[room] = files
+        return files
+
+    # ====== Segments ======
+
+    def _seal(self, room: str, count: int):
+        """Close the active segment at message `count` and start a new one (under the lock)."""
+        files = self._files.pop(room, None)
+        if files is not None:
+            for f in files:
+                os.fsync(f.fileno())
+                f.close()
+
+        now = time.time()
+        segments = self.segments(room)
+        sealed = segments[-1].replace(last=count, sealed_at=now)
+        active = Segment(count + 1, f"{room}{SEGMENTS_SUFFIX}/{count + 1:0{SEQ_DIGITS}d}", opened_at=now)
+        os.makedirs(self.segments_dir(room), exist_ok=True)
+        for suffix in (DATA_SUFFIX, INDEX_SUFFIX):
+            open(self._file(active.path, suffix), "wb").close()
+        self._save_segments(room, segments[:-1] + [sealed, active])
+        logger.info(f"Sealed history segment {sealed.first}-{sealed.last} of room '{room}'")
+        self._compress_later(room, sealed)
+
+    def _compress_later(self, room: str, segment: Segment):
+        if self._compressor is None:
+            self._closing = False
+            self._compressor = threading.Thread(target=self._run_compressor, name="history-compressor", daemon=True)
+            self._compressor.start()
+        self._sealed.put((room, segment.first))
+
+    def _run_compressor(self):
+        while True:
+            item = self._sealed.get()
+            if item is None or self._closing:
+                return
+            try:
+                self._compress(*item)
+            except Exception as e:
+                logger.error(f"Error compressing history segment {item[1]} of room '{item[0]}': {e}")
+
+    def _compress(self, room: str, first: int):
+        """Replace a sealed segment's data file with a compressed copy, then switch the manifest over to it."""
+        segment = next((s for s in self.segments(room) if s.first == first), None)
+        if segment is None or segment.last is None or segment.codec is not None:
+            return
+        compress, _, suffix = CODECS[self.codec]
+        path = f"{room}{SEGMENTS_SUFFIX}/{first:0{SEQ_DIGITS}d}"
+        data_path = self._file(segment.path, DATA_SUFFIX)
+        index_path = self._file(segment.path, INDEX_SUFFIX)
+        with open(index_path, "rb") as f:
+            raw_index = f.read()
+        ends = [end for (end,) in INDEX_ENTRY.iter_unpack(raw_index)]
+
+        # Block boundaries: the first record end at least BLOCK_BYTES after the previous boundary
+        boundaries = [0]
+        for end in ends:
+            if end - boundaries[-1] >= BLOCK_BYTES:
+                boundaries.append(end)
+        if ends and boundaries[-1] != ends[-1]:
+            boundaries.append(ends[-1])
+
+        table = bytearray()
+        written = 0
+        with open(data_path, "rb") as data, open(self._file(path, suffix) + ".tmp", "wb") as out:
+            for start, end in zip(boundaries, boundaries[1:]):
+                table += BLOCK_ENTRY.pack(start, written)
+                written += out.write(compress(data.read(end - start)))
+            table += BLOCK_ENTRY.pack(boundaries[-1], written)
+            out.flush()
+            os.fsync(out.fileno())
+        for name, content in ((BLOCKS_SUFFIX, table), (INDEX_SUFFIX, raw_index)):
+            if name == INDEX_SUFFIX and self._file(path, name) == index_path:
+                continue
+            with open(self._file(path, name) + ".tmp", "wb") as f:
+                f.write(content)
+                os.fsync(f.fileno())
+            os.replace(self._file(path, name) + ".tmp", self._file(path, name))
+        os.replace(self._file(path, suffix) + ".tmp", self._file(path, suffix))
+
+        with self._lock:
+            segments = [
+                s.replace(path=path, codec=self.codec, size=written) if s.first == first else s
+                for s in self.segments(room)
+            ]
+            self._save_segments(room, segments)
+        # Readers that loaded the previous manifest retry when the raw files are gone
+        os.remove(data_path)
+        if index_path != self._file(path, INDEX_SUFFIX):
+            os.remove(index_path)
+        logger.info(
+            f"Compressed history segment {segment.first}-{segment.last} of room '{room}' "
+            f"with {self.codec}: {boundaries[-1]} -> {written} bytes"
+        )
+
+    # ====== Reads ======
+
+    def read_page(self, room: str, before: Optional[int] = None, limit: int = 50) -> List[Envelope]:
+        """Return up to `limit` messages with seq < `before`, oldest first.
+
+        Without `before` the newest messages are returned.
+        """
+        count = self.count(room)
+        end = count if before is None else min(max(before - 1, 0), count)
+        start = max(end - limit, 0)
+        return self.read_range(room, start + 1, end + 1)
+
+    def read_after(self, room: str, after: int, limit: int = 50) -> List[Envelope]:
+        """Return up to `limit` messages with seq > `after`, oldest first."""
+        count = self.count(room)
+        start = min(max(after, 0), count)
+        return self.read_range(room, start + 1, min(start + limit, count) + 1)
+
+    def read_tail(self, room: str, after: int, limit: int) -> List[Envelope]:
+        """Return the newest `limit` messages with seq > `after`, oldest first."""
+        count = self.count(room)
+        start = max(after, count - limit, 0)
+        return self.read_range(room, start + 1, count + 1)
+
+    def read_range(self, room: str, first: int, stop: int) -> List[Envelope]:
+        """Return messages with first <= seq < stop."""
+        if stop <= first:
+            return []
+        for attempt in range(3):
+            segments = self.segments(room)
+            try:
+                page = []
+                for segment in segments[max(bisect_right(segments, first, key=lambda s: s.first) - 1, 0):]:
+                    if segment.first >= stop:
+                        break
+                    end = stop if segment.last is None else min(stop, segment.last + 1)
+                    page += self._read_segment(room, segment, max(first, segment.first), end)
+                return page
+            except FileNotFoundError:
+                # Retried if a segment was compressed (and its raw files removed) since the manifest was read
+                if attempt == 2 or self.segments(room) is segments:
+                    raise
+
+    def _read_segment(self, room: str, segment: Segment, first: int, stop: int) -> List[Envelope]:
+        if stop <= first:
+            return []
+        # Positions within the segment, 1-based like seq
+        base = segment.first - 1
+        local_first, local_stop = first - base, stop - base
+
+        # Read the end offset of the message before `first` along with the page's own entries.
+        with open(self._file(segment.path, INDEX_SUFFIX), "rb") as f:
+            if local_first > 1:
+                f.seek((local_first - 2) * INDEX_ENTRY.size)
+                raw = f.read((local_stop - local_first + 1) * INDEX_ENTRY.size)
+            else:
+                raw = INDEX_ENTRY.pack(0) + f.read((local_stop - 1) * INDEX_ENTRY.size)
+        ends = [entry[0] for entry in INDEX_ENTRY.iter_unpack(raw)]
+        if len(ends) < 2:
+            return []
+
+        if segment.codec is None:
+            with open(self._file(segment.path, DATA_SUFFIX), "rb") as f:
+                f.seek(ends[0])
+                chunk = f.read(ends[-1] - ends[0])
+        else:
+            chunk = self._read_compressed(segment, ends[0], ends[-1])
+
+        page = []
+        for i in range(1, len(ends)):
+            start = ends[i - 1] - ends[0]
+            seq = first + i - 1
+            if is_envelope(chunk, start):
+                envelope, _ = decode(chunk, start)
+                envelope.seq = seq
+            else:
+                line = chunk[start:ends[i] - ends[0]].decode("utf-8").rstrip("\r\n")
+                envelope = Envelope(MESSAGE, room, line, seq=seq, timestamp=0)
+            page.append(envelope)
+        return page
+
+    def _read_compressed(self, segment: Segment, start: int, end: int) -> bytes:
+        """Bytes [start, end) of a compressed segment's original data, decompressing only the blocks they span."""
+        _, decompress, suffix = CODECS[segment.codec]
+        starts, offsets = _block_table(self._file(segment.path, BLOCKS_SUFFIX))
+        first = bisect_right(starts, start) - 1
+        last = bisect_left(starts, end)
+        with open(self._file(segment.path, suffix), "rb") as f:
+            f.seek(offsets[first])
+            raw = f.read(offsets[last] - offsets[first])
+        data = b"".join(
+            decompress(raw[offsets[i] - offsets[first]:offsets[i + 1] - offsets[first]]) for i in range(first, last)
+        )
+        return data[start - starts[first]:end - starts[first]]
+
+    # ====== Index maintenance ======
+
+    def _ensure_index(self, room: str) -> int:
+        """Make sure the index covers the active segment's data file and return the message count."""
+        count = self._counts.get(room)
+        if count is not None:
+            return count
+
+        segments = self.segments(room)
+        active = segments[-1]
+        data_path = self._file(active.path, DATA_SUFFIX)
+        index_path = self._file(active.path, INDEX_SUFFIX)
+        if not os.path.exists(data_path):
+            return 0
+        data_size = os.path.getsize(data_path)
+
+        with open(index_path, "ab+") as f:
+            f.seek(0)
+            raw = f.read()
+            # Drop a torn entry and any entries pointing past the data (interrupted write).
+            count = len(raw) // INDEX_ENTRY.size
+            while count and INDEX_ENTRY.unpack_from(raw, (count - 1) * INDEX_ENTRY.size)[0] > data_size:
+                count -= 1
+            indexed = INDEX_ENTRY.unpack_from(raw, (count - 1) * INDEX_ENTRY.size)[0] if count else 0
+            f.truncate(count * INDEX_ENTRY.size)
+
+            # Index whatever the data file has beyond the last entry (e.g. histories written before the index existed).
+            if indexed < data_size:
+                entries = bytearray()
+                with open(data_path, "rb") as data:
+                    data.seek(indexed)
+                    offset = indexed
+                    for end in _scan_records(data, indexed):
+                        offset = end
+                        entries += INDEX_ENTRY.pack(offset)
+                        count += 1
+                f.seek(0, os.SEEK_END)
+                f.write(entries)
+                if offset < data_size:
+                    # A partial trailing record from an interrupted write; drop it so the next append starts cleanly.
+                    with open(data_path, "r+b") as data:
+                        data.truncate(offset)
+
+        count += active.first - 1
+        self._counts[room] = count
+        # Segments sealed but not compressed before a restart
+        for segment in segments[:-1]:
+            if segment.codec is None:
+                self._compress_later(room, segment)
+        return count
+
+
+@lru_cache(maxsize=1024)
+def _block_table(path: str) -> Tuple[List[int], List[int]]:
+    """Uncompressed and compressed start offsets of a compressed segment's blocks (immutable once written)."""
+    with open(path, "rb") as f:
+        entries = list(BLOCK_ENTRY.iter_unpack(f.read()))
+    return [entry[0] for entry in entries], [entry[1] for entry in entries]
+
+
+def _scan_records(f: BinaryIO, offset: int):
+    """Yield the end offset of every complete record, reading `f` from its current position (`offset`)."""
+    while True:
+        first = f.peek(1)[:1]
+        if not first:
+            return
+        if is_envelope(first):
+            size = record_size(f.read(HEADER.size))
+            if size is None or len(f.read(size - HEADER.size)) < size - HEADER.size:
+                return
+        else:
+            line = f.readline()
+            if not line.endswith(b"\n"):
+                return
+            size = len(line)
+        offset += size
+        yield offset
@@ -0,0 +1,135 @@
+"""
+Counters, gauges and histograms exposed in the Prometheus text format.
+
+Dependency-free and cheap enough for the per-message path: a counter is an
+integer increment and a histogram observation a bisect into its buckets.
+Gauges and counters can also read a value from a callback when scraped, which
+is how existing stats objects (fan-out, writer, rate limiter) are exported
+without counting twice.
+
+    registry = Registry()
+    latency = registry.histogram("chat_publish_seconds", "Time to publish a message")
+    latency.observe(0.002)
+    registry.gauge("chat_rooms", "Rooms with clients", lambda: len(rooms))
+    text = registry.render()
+"""
+import math
+from bisect import bisect_left
+from typing import Callable, List, Optional, Sequence
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Upper bounds in seconds, from 100 µs to 10 s
+LATENCY_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+
+def _format(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    """A value that only goes up; read from `fn` when given."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, description: str, fn: Optional[Callable[[], float]] = None):
+        super().__init__(name, description)
+        self.value = 0
+        self.fn = fn
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def samples(self) -> List[str]:
+        return [f"{self.name} {_format(self.fn() if self.fn else self.value)}"]
+
+
+class Gauge(Metric):
+    """A value that goes up and down; read from `fn` when given."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, description: str, fn: Optional[Callable[[], float]] = None):
+        super().__init__(name, description)
+        self.value = 0
+        self.fn = fn
+
+    def set(self, value: float):
+        self.value = value
+
+    def samples(self) -> List[str]:
+        return [f"{self.name} {_format(self.fn() if self.fn else self.value)}"]
+
+
+class Histogram(Metric):
+    """Distribution of observed values over fixed buckets."""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, description: str, buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, description)
+        self.buckets = tuple(sorted(buckets))
+        # One count per bucket (not cumulative) plus the +Inf overflow
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self) -> List[str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (math.inf,), self.counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{_format(bound)}"}} {cumulative}')
+        lines.append(f"{self.name}_sum {_format(self.sum)}")
+        lines.append(f"{self.name}_count {self.count}")
+        return lines
+
+
+class Registry:
+    """The metrics of one process, rendered together for a scrape."""
+
+    def __init__(self):
+        self.metrics: List[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        if any(existing.name == metric.name for existing in self.metrics):
+            raise ValueError(f"Metric '{metric.name}' is already registered")
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, description: str, fn: Optional[Callable[[], float]] = None) -> Counter:
+        return self.register(Counter(name, description, fn))
+
+    def gauge(self, name: str, description: str, fn: Optional[Callable[[], float]] = None) -> Gauge:
+        return self.register(Gauge(name, description, fn))
+
+    def histogram(self, name: str, description: str, buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, description, buckets))
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self.metrics) + "\n"
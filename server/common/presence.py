@@ -0,0 +1,223 @@
+"""
+Who is connected to each room, announced in periodic digests.
+
+Joining and leaving only update counters in memory. Every `interval` seconds
+each room whose membership changed gets a single PRESENCE envelope listing who
+joined and who left since the previous digest, so a burst of N joins costs
+every member one message instead of N, and a client that drops and reconnects
+within an interval produces no digest at all. Digests are published straight
+to the room's channel and are never written to history.
+
+With a Redis client the roster is shared by every process serving the room:
+each process keeps its own members of a room in one field of the hash
+"chat:presence:<room>", rewritten whenever they change and refreshed every
+`refresh_interval` seconds. Fields not refreshed for three intervals (left by
+a process that crashed) are ignored.
+"""
+import asyncio
+import logging
+import time
+import uuid
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Set
+
+import redis.asyncio as redis
+
+from .envelope import PRESENCE, Envelope
+from .serializer import dumps, dumps_str, loads
+
+logger = logging.getLogger(__name__)
+
+PRESENCE_KEY_PREFIX = "chat:presence:"
+# Names listed per side of a digest; beyond that they are only counted
+MAX_DIGEST_NAMES = 50
+
+# Called with a room and an encoded PRESENCE envelope to deliver to the room's members
+Publish = Callable[[str, bytes], Awaitable]
+
+
+class PresenceStats:
+    def __init__(self):
+        self.joins = 0
+        self.leaves = 0
+        self.digests = 0
+        self.flush_errors = 0
+
+    def snapshot(self) -> dict:
+        return dict(vars(self))
+
+
+class PresenceTracker:
+    """Per-room rosters of usernames, with membership changes batched into digests."""
+
+    def __init__(
+        self,
+        publish: Publish,
+        interval: float = 1.0,
+        redis_client: Optional[redis.Redis] = None,
+        key_prefix: str = PRESENCE_KEY_PREFIX,
+        refresh_interval: float = 30.0,
+        max_names: int = MAX_DIGEST_NAMES,
+    ):
+        self.publish = publish
+        self.interval = interval
+        self.redis_client = redis_client
+        self.key_prefix = key_prefix
+        self.refresh_interval = refresh_interval
+        self.max_names = max_names
+        # This process's field in the shared rosters
+        self.process_id = uuid.uuid4().hex
+        self.stats = PresenceStats()
+        # room -> username -> connections to this process
+        self._members: Dict[str, Dict[str, int]] = {}
+        # room -> this process's members as of its last digest
+        self._announced: Dict[str, Set[str]] = {}
+        self._changed: Set[str] = set()
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def rooms(self) -> int:
+        return len(self._members)
+
+    def key(self, room: str) -> str:
+        return f"{self.key_prefix}{room}"
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        """Stop sending digests and withdraw this process's members from the shared rosters."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self.redis_client is not None and self._announced:
+            try:
+                pipe = self.redis_client.pipeline(transaction=False)
+                for room in self._announced:
+                    pipe.hdel(self.key(room), self.process_id)
+                await pipe.execute()
+            except Exception as e:
+                logger.error(f"Error removing presence of {len(self._announced)} rooms: {e}")
+
+    # ====== Membership ======
+
+    def join(self, room: str, username: str):
+        """Count one more connection of `username` to `room`."""
+        members = self._members.setdefault(room, {})
+        members[username] = members.get(username, 0) + 1
+        self._changed.add(room)
+        self.stats.joins += 1
+
+    def leave(self, room: str, username: str):
+        """Count one connection of `username` to `room` less; the user leaves with the last one."""
+        members = self._members.get(room)
+        if not members or username not in members:
+            return
+        members[username] -= 1
+        if not members[username]:
+            del members[username]
+            if not members:
+                del self._members[room]
+        self._changed.add(room)
+        self.stats.leaves += 1
+
+    async def members(self, room: str) -> List[str]:
+        """Everyone connected to the room, across all processes when the roster is shared."""
+        if self.redis_client is None:
+            return sorted(self._members.get(room, ()))
+        fields = await self.redis_client.hgetall(self.key(room))
+        return sorted(self._others(fields) | set(self._members.get(room, ())))
+
+    async def count(self, room: str) -> int:
+        if self.redis_client is None:
+            return len(self._members.get(room, ()))
+        return len(await self.members(room))
+
+    # ====== Digests ======
+
+    async def _run(self):
+        last_refresh = time.monotonic()
+        while True:
+            await asyncio.sleep(self.interval)
+            refresh = time.monotonic() - last_refresh >= self.refresh_interval
+            try:
+                await self.flush(refresh)
+                if refresh:
+                    last_refresh = time.monotonic()
+            except Exception as e:
+                self.stats.flush_errors += 1
+                logger.error(f"Error sending presence digests: {e}")
+
+    async def flush(self, refresh: bool = False):
+        """Send a digest to every room whose membership changed since the last one.
+
+        With `refresh`, this process's entries in the shared rosters of all its rooms are rewritten too.
+        The digests are published concurrently, so a batching broker sends them in shared pipelines.
+        """
+        changed, self._changed = self._changed, set()
+        try:
+            others = await self._share(set(self._announced) | changed if refresh else changed)
+            digests = [(room, self._digest(room, others.get(room, set()))) for room in changed]
+            await asyncio.gather(*(self.publish(room, digest) for room, digest in digests if digest is not None))
+        except Exception:
+            # Retried on the next flush
+            self._changed |= changed
+            raise
+
+    async def _share(self, rooms: Iterable[str]) -> Dict[str, Set[str]]:
+        """Publish this process's members of `rooms` to the shared rosters and return everyone else's."""
+        rooms = list(rooms)
+        if self.redis_client is None or not rooms:
+            return {}
+        now = time.time()
+        pipe = self.redis_client.pipeline(transaction=False)
+        for room in rooms:
+            members = self._members.get(room)
+            if members:
+                pipe.hset(self.key(room), self.process_id, dumps({"members": list(members), "at": now}))
+            else:
+                pipe.hdel(self.key(room), self.process_id)
+            pipe.hgetall(self.key(room))
+        replies = await pipe.execute()
+        return {room: self._others(fields) for room, fields in zip(rooms, replies[1::2])}
+
+    def _others(self, fields: dict) -> Set[str]:
+        """Members listed in a shared roster by other live processes."""
+        names: Set[str] = set()
+        oldest = time.time() - 3 * self.refresh_interval
+        for field, value in fields.items():
+            if (field.decode() if isinstance(field, bytes) else field) == self.process_id:
+                continue
+            try:
+                entry = loads(value)
+            except ValueError:
+                continue
+            if entry.get("at", 0) >= oldest:
+                names.update(entry.get("members", ()))
+        return names
+
+    def _digest(self, room: str, others: Set[str]) -> Optional[bytes]:
+        """The room's encoded digest of who joined and left since the last one, or None if nobody did."""
+        current = set(self._members.get(room, ()))
+        announced = self._announced.get(room, set())
+        if current:
+            self._announced[room] = current
+        else:
+            self._announced.pop(room, None)
+
+        # Users also connected through another process neither joined nor left the room
+        joined = sorted(current - announced - others)
+        left = sorted(announced - current - others)
+        if not joined and not left:
+            return None
+        digest = {"joined": joined[:self.max_names], "left": left[:self.max_names], "count": len(current | others)}
+        if len(joined) > self.max_names:
+            digest["more_joined"] = len(joined) - self.max_names
+        if len(left) > self.max_names:
+            digest["more_left"] = len(left) - self.max_names
+        self.stats.digests += 1
+        return Envelope(PRESENCE, room, dumps_str(digest)).encode()
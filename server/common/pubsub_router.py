@@ -0,0 +1,92 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, Optional, Union
+
+import redis.asyncio as redis
+
+logger = logging.getLogger(__name__)
+
+# Called with the message payload for every message published on the handler's channel
+# (bytes unless the client was created with decode_responses=True)
+MessageHandler = Callable[[Union[str, bytes]], Awaitable[None]]
+
+
+class PubSubRouter:
+    """Multiplexes every room of the process over a single Redis pub/sub connection.
+
+    Channels are subscribed when a room gets its first local client and
+    unsubscribed when it empties; one reader task dispatches each incoming
+    message to the handler registered for its channel.
+    """
+
+    def __init__(self, redis_client: redis.Redis, reconnect_delay: float = 1.0):
+        self.redis_client = redis_client
+        self.reconnect_delay = reconnect_delay
+        self._pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+        self._handlers: Dict[str, MessageHandler] = {}
+        self._subscribed = asyncio.Event()
+        # Serializes (un)subscribe commands so concurrent first joins cannot open a second connection
+        self._commands = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def channels(self) -> int:
+        return len(self._handlers)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self._handlers.clear()
+        await self._pubsub.aclose()
+
+    async def subscribe(self, channel: str, handler: MessageHandler):
+        """Route messages published on `channel` to `handler`, subscribing on the shared connection if needed."""
+        is_new = channel not in self._handlers
+        self._handlers[channel] = handler
+        if is_new:
+            async with self._commands:
+                await self._pubsub.subscribe(channel)
+            self._subscribed.set()
+
+    async def unsubscribe(self, channel: str):
+        if self._handlers.pop(channel, None) is not None:
+            async with self._commands:
+                await self._pubsub.unsubscribe(channel)
+
+    async def _run(self):
+        while True:
+            try:
+                if not self._pubsub.subscribed:
+                    # Nothing to read until the first room subscribes
+                    self._subscribed.clear()
+                    await self._subscribed.wait()
+                message = await self._pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # The connection re-subscribes to all current channels when it reconnects
+                logger.error(f"Redis pub/sub connection error: {e}")
+                await asyncio.sleep(self.reconnect_delay)
+                continue
+
+            if not message or message["type"] != "message":
+                continue
+            channel = message["channel"]
+            if isinstance(channel, bytes):
+                channel = channel.decode("utf-8")
+            handler = self._handlers.get(channel)
+            if handler is None:
+                continue
+            try:
+                await handler(message["data"])
+            except Exception as e:
+                logger.error(f"Error dispatching message on channel {channel}: {e}")
@@ -0,0 +1,153 @@
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+
+# WebSocket close code "Message Too Big", sent to clients exceeding the maximum message size
+CLOSE_TOO_BIG = 1009
+
+# Why a message was rejected
+TOO_LARGE = "too_large"
+CONNECTION_LIMITED = "connection_limited"
+ROOM_LIMITED = "room_limited"
+
+
+def message_size(message: dict) -> int:
+    """Size in bytes of a raw ASGI websocket.receive message, without decoding or parsing it."""
+    data = message.get("bytes")
+    if data is not None:
+        return len(data)
+    text = message.get("text") or ""
+    # A character takes 1-4 bytes in UTF-8; only encode when the bound is inconclusive
+    return len(text) if text.isascii() else len(text.encode("utf-8"))
+
+
+class TokenBucket:
+    """Allows `rate` events per second on average, in bursts of up to `burst`."""
+
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self, now: Optional[float] = None) -> bool:
+        """Consume one token if available."""
+        now = time.monotonic() if now is None else now
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def refund(self):
+        self.tokens = min(self.burst, self.tokens + 1)
+
+    def full(self, now: float) -> bool:
+        """Whether the bucket has refilled to `burst`, i.e. is no different from a new one."""
+        return self.tokens + (now - self.updated) * self.rate >= self.burst
+
+
+class RateLimitStats:
+    def __init__(self):
+        self.accepted = 0
+        self.too_large = 0
+        self.connection_limited = 0
+        self.room_limited = 0
+
+    def snapshot(self) -> dict:
+        return dict(vars(self))
+
+
+class RateLimiter:
+    """Message size limit plus token buckets per connection and per room.
+
+    Checks only look at the size of the raw frame and the clock, so a client
+    flooding the server is turned away before its messages are parsed,
+    written to history or published. A rate of 0 disables that bucket. Room
+    buckets are per process: with several workers a room's total allowance
+    is multiplied by the number of workers serving it. A room's bucket
+    outlives its last connection until it has refilled, so leaving and
+    rejoining does not reset the room's allowance.
+    """
+
+    def __init__(
+        self,
+        connection_rate: float,
+        connection_burst: float,
+        room_rate: float,
+        room_burst: float,
+        max_message_bytes: int,
+    ):
+        self.connection_rate = connection_rate
+        self.connection_burst = connection_burst
+        self.room_rate = room_rate
+        self.room_burst = room_burst
+        self.max_message_bytes = max_message_bytes
+        self.stats = RateLimitStats()
+        self._rooms: Dict[str, TokenBucket] = {}
+        # Rooms left without connections while their bucket was still refilling -> when, oldest first
+        self._idle: "OrderedDict[str, float]" = OrderedDict()
+
+    def connection(self) -> Optional[TokenBucket]:
+        """A bucket for a new connection (None when connections are unlimited)."""
+        if self.connection_rate <= 0:
+            return None
+        return TokenBucket(self.connection_rate, self.connection_burst)
+
+    def check(self, room: str, bucket: Optional[TokenBucket], size: int) -> Optional[str]:
+        """Admit one message of `size` bytes from a connection of `room`. Returns None, or why it was rejected."""
+        stats = self.stats
+        if size > self.max_message_bytes:
+            stats.too_large += 1
+            return TOO_LARGE
+        now = time.monotonic()
+        if bucket is not None and not bucket.take(now):
+            stats.connection_limited += 1
+            return CONNECTION_LIMITED
+        if self.room_rate > 0:
+            room_bucket = self._rooms.get(room)
+            if room_bucket is None:
+                room_bucket = self._rooms[room] = TokenBucket(self.room_rate, self.room_burst)
+            if not room_bucket.take(now):
+                # The connection's token was not used after all
+                if bucket is not None:
+                    bucket.refund()
+                stats.room_limited += 1
+                return ROOM_LIMITED
+        stats.accepted += 1
+        return None
+
+    def forget(self, room: str, now: Optional[float] = None):
+        """Let go of the bucket of a room that has no connections left, once it has refilled.
+
+        A full bucket is dropped right away. One still refilling is kept, so clients reconnecting
+        to the room do not get a fresh burst, and dropped by a later call once `room_burst /
+        room_rate` seconds have passed, unless the room was used again meanwhile.
+        """
+        now = time.monotonic() if now is None else now
+        # Every bucket idle since before `expired` has refilled by now
+        expired = now - self.room_burst / self.room_rate if self.room_rate > 0 else now
+        idle = self._idle
+        while idle:
+            name, since = next(iter(idle.items()))
+            if since > expired:
+                break
+            del idle[name]
+            bucket = self._rooms.get(name)
+            # Untouched since the room emptied means refilled. A room that got connections again may be
+            # draining its bucket; it is forgotten again when it empties.
+            if bucket is not None and (bucket.updated <= since or bucket.full(now)):
+                del self._rooms[name]
+
+        bucket = self._rooms.get(room)
+        if bucket is None:
+            return
+        if bucket.full(now):
+            del self._rooms[room]
+            idle.pop(room, None)
+        else:
+            idle[room] = now
+            idle.move_to_end(room)
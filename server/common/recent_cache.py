@@ -0,0 +1,151 @@
+from collections import OrderedDict, deque
+from typing import Deque, Dict, Iterable, List, Optional, Tuple
+
+# Rough per-message bookkeeping cost (tuple, deque slot, str header) added to the text length
+ENTRY_OVERHEAD = 96
+
+# (seq, message); seq is None for servers that do not number their messages
+Entry = Tuple[Optional[int], str]
+
+
+class _RoomBuffer:
+    __slots__ = ("entries", "size")
+
+    def __init__(self, capacity: int):
+        self.entries: Deque[Entry] = deque(maxlen=capacity)
+        self.size = 0
+
+
+def entry_size(message: str) -> int:
+    return len(message) + ENTRY_OVERHEAD
+
+
+class RecentMessageCache:
+    """The last N messages of each room in memory, bounded by a global byte budget.
+
+    Each room is a ring buffer of its newest messages. When the total size goes
+    over budget, whole rooms are evicted least-recently-used first; an evicted
+    room is simply reloaded from disk the next time somebody joins it.
+
+    A cached room always holds a contiguous tail of the room's history:
+    messages are only appended to rooms that are already cached, and a gap in
+    sequence numbers drops the room instead of serving an incomplete tail.
+    Loads that read the disk concurrently with new appends are bracketed by
+    begin_load() / end_load(), and the messages appended meanwhile are merged in.
+    """
+
+    def __init__(self, per_room: int = 100, max_bytes: int = 64 * 1024 * 1024):
+        self.per_room = per_room
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._rooms: "OrderedDict[str, _RoomBuffer]" = OrderedDict()
+        # room -> [loads in progress, entries appended since the first of them began]
+        self._loading: Dict[str, list] = {}
+
+    def __contains__(self, room: str) -> bool:
+        return room in self._rooms
+
+    @property
+    def rooms(self) -> int:
+        return len(self._rooms)
+
+    def stats(self) -> dict:
+        return {
+            "rooms": self.rooms,
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def recent(self, room: str, limit: Optional[int] = None) -> Optional[List[Entry]]:
+        """The newest `limit` messages of a room, oldest first, or None if the room is not cached."""
+        buffer = self._rooms.get(room)
+        if buffer is None or (limit is not None and limit > self.per_room):
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._rooms.move_to_end(room)
+        entries = list(buffer.entries)
+        return entries if limit is None else entries[-limit:] if limit else []
+
+    def begin_load(self, room: str):
+        """Start recording the room's appends, before reading its tail from disk off the event loop."""
+        loading = self._loading.get(room)
+        if loading is None:
+            loading = self._loading[room] = [0, []]
+        loading[0] += 1
+
+    def end_load(self, room: str):
+        loading = self._loading.get(room)
+        if loading is not None:
+            loading[0] -= 1
+            if loading[0] <= 0:
+                del self._loading[room]
+
+    def load(self, room: str, entries: Iterable[Entry]):
+        """Cache a room from its newest messages as read from disk (oldest first)."""
+        if room in self._rooms and room in self._loading:
+            # A concurrent load got there first and has been kept current since.
+            return
+        self.discard(room)
+        buffer = self._rooms[room] = _RoomBuffer(self.per_room)
+        for entry in entries:
+            self._push(buffer, entry)
+        loading = self._loading.get(room)
+        if loading is not None:
+            for seq, message in loading[1]:
+                if not self._append(room, buffer, message, seq):
+                    break
+        self._evict()
+
+    def append(self, room: str, message: str, seq: Optional[int] = None):
+        """Add a new message to a cached room; rooms that are not cached are left to load from disk."""
+        loading = self._loading.get(room)
+        if loading is not None:
+            loading[1].append((seq, message))
+        buffer = self._rooms.get(room)
+        if buffer is None:
+            return
+        self._append(room, buffer, message, seq)
+        self._evict()
+
+    def discard(self, room: str):
+        buffer = self._rooms.pop(room, None)
+        if buffer is not None:
+            self.size -= buffer.size
+
+    def _append(self, room: str, buffer: _RoomBuffer, message: str, seq: Optional[int]) -> bool:
+        """Add a message to a cached room's buffer; False if that dropped the room."""
+        if seq is not None and buffer.entries:
+            last_seq = buffer.entries[-1][0]
+            if last_seq is not None:
+                if seq <= last_seq:
+                    return True
+                if seq != last_seq + 1:
+                    # Missed a message; reload from disk rather than serve a hole.
+                    self.discard(room)
+                    return False
+        self._push(buffer, (seq, message))
+        return True
+
+    def _push(self, buffer: _RoomBuffer, entry: Entry):
+        if len(buffer.entries) == buffer.entries.maxlen:
+            dropped = entry_size(buffer.entries[0][1])
+            buffer.size -= dropped
+            self.size -= dropped
+        added = entry_size(entry[1])
+        buffer.entries.append(entry)
+        buffer.size += added
+        self.size += added
+
+    def _evict(self):
+        # Keep at least the most recently used room, even if it alone is over budget.
+        while self.size > self.max_bytes and len(self._rooms) > 1:
+            _, buffer = self._rooms.popitem(last=False)
+            self.size -= buffer.size
+            self.evictions += 1
@@ -0,0 +1,131 @@
+from collections import deque
+from typing import Deque, Dict, Iterator, List, Optional, Tuple
+
+from fastapi import WebSocket
+
+
+class Connection:
+    """One WebSocket client of a room.
+
+    A connection is either live (it receives the room's broadcasts) or pending,
+    e.g. while the messages it missed are being replayed; live messages for a
+    pending connection are collected in ``held`` until it goes live.
+    """
+
+    __slots__ = ("websocket", "room", "username", "held")
+
+    def __init__(self, websocket: WebSocket, room: "Room", username: Optional[str]):
+        self.websocket = websocket
+        self.room = room
+        self.username = username
+        self.held: Optional[Deque[bytes]] = None
+
+    @property
+    def live(self) -> bool:
+        return self.websocket in self.room.live
+
+    def __repr__(self) -> str:
+        return f"Connection(room={self.room.name!r}, username={self.username!r}, live={self.live})"
+
+
+class Room:
+    """The connections of one room on this process, keyed by WebSocket for O(1) removal.
+
+    ``live`` iterates over the WebSockets that receive broadcasts, in the order they joined.
+    """
+
+    __slots__ = ("name", "live", "pending")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.live: Dict[WebSocket, Connection] = {}
+        self.pending: Dict[WebSocket, Connection] = {}
+
+    def __len__(self) -> int:
+        return len(self.live) + len(self.pending)
+
+    def __iter__(self) -> Iterator[Connection]:
+        yield from self.live.values()
+        yield from self.pending.values()
+
+    def __repr__(self) -> str:
+        return f"Room({self.name!r}, live={len(self.live)}, pending={len(self.pending)})"
+
+
+class ConnectionRegistry:
+    """Rooms and connections of this process with O(1) connect, disconnect and lookup by user.
+
+    A room exists while it has at least one connection; callers use the
+    return values of connect/disconnect to (un)subscribe its channel.
+    """
+
+    def __init__(self):
+        self.rooms: Dict[str, Room] = {}
+        # username -> their connections in any room, as an insertion-ordered set
+        self._users: Dict[str, Dict[Connection, None]] = {}
+        self._count = 0
+
+    def __len__(self) -> int:
+        """Number of connections."""
+        return self._count
+
+    def room(self, name: str) -> Optional[Room]:
+        return self.rooms.get(name)
+
+    def connect(
+        self,
+        room_name: str,
+        websocket: WebSocket,
+        username: Optional[str] = None,
+        live: bool = True,
+    ) -> Tuple[Connection, bool]:
+        """Add a connection to a room. Returns it and whether the room was created for it."""
+        room = self.rooms.get(room_name)
+        created = room is None
+        if created:
+            room = self.rooms[room_name] = Room(room_name)
+        connection = Connection(websocket, room, username)
+        if live:
+            room.live[websocket] = connection
+        else:
+            connection.held = deque()
+            room.pending[websocket] = connection
+        if username is not None:
+            self._users.setdefault(username, {})[connection] = None
+        self._count += 1
+        return connection, created
+
+    def go_live(self, connection: Connection):
+        """Switch a pending connection to receiving broadcasts."""
+        room = connection.room
+        if room.pending.pop(connection.websocket, None) is connection:
+            connection.held = None
+            room.live[connection.websocket] = connection
+
+    def disconnect(self, connection: Connection) -> bool:
+        """Remove a connection. Returns True if its room is now empty (and removed)."""
+        room = connection.room
+        websocket = connection.websocket
+        if room.live.get(websocket) is connection:
+            del room.live[websocket]
+        elif room.pending.get(websocket) is connection:
+            del room.pending[websocket]
+        else:
+            return False
+        self._count -= 1
+
+        if connection.username is not None:
+            connections = self._users.get(connection.username)
+            if connections is not None:
+                connections.pop(connection, None)
+                if not connections:
+                    del self._users[connection.username]
+
+        if not room.live and not room.pending and self.rooms.get(room.name) is room:
+            del self.rooms[room.name]
+            return True
+        return False
+
+    def connections_of(self, username: str) -> List[Connection]:
+        """All connections of a user, in any room."""
+        return list(self._users.get(username, ()))
@@ -0,0 +1,289 @@
+"""
+Full-text search over chat history: an inverted index per room, in SQLite FTS5.
+
+Every room gets a `<room>.fts` database in the search directory, holding only
+the index: a contentless FTS5 table whose rowids are the messages' seqs, so it
+costs a fraction of the history's size, and the text of the hits returned is
+read back from the history store. Matching a term is a lookup in the index,
+not a scan of the room, which keeps queries fast on rooms with millions of
+messages. SQLite runs in the process (no search service to operate) and in
+WAL mode, so the process writing a room's index and any number of processes
+searching it work concurrently.
+
+The index is kept current by the process that writes the room's history (the
+history service in local mode, its history consumer in cluster mode): each
+message is handed to a SearchIndexer once its seq is known. The indexer also
+fills in whatever history the index is missing (rooms from before the index,
+messages written while it was down) from the history store, so the index
+never has to be built separately.
+"""
+import asyncio
+import logging
+import os
+import re
+import sqlite3
+import time
+from collections import OrderedDict, deque
+from typing import Deque, Dict, Iterable, List, Optional, Tuple
+from urllib.parse import quote
+
+from .envelope import MESSAGE, Envelope
+from .history_store import HistoryStore
+
+logger = logging.getLogger(__name__)
+
+SEARCH_SUFFIX = ".fts"
+# Messages read from the history store per transaction while filling in a room's index
+BACKFILL_CHUNK = 10000
+# Orders of search results: best match first (BM25, then newest), or newest first
+SORTS = ("relevance", "recent")
+# Relevance is ranked among the newest RANK_WINDOW matches only: scoring every match of a word
+# found in most of a room's million messages would take most of a second, this takes milliseconds
+RANK_WINDOW = 20000
+
+# A query is a list of words, all of which must appear; "word*" matches words starting with "word"
+QUERY_TERM = re.compile(r"\w+\*?")
+
+SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS messages USING fts5(body, content='', tokenize='unicode61 remove_diacritics 2');
+CREATE TABLE IF NOT EXISTS indexed (id INTEGER PRIMARY KEY CHECK (id = 0), through INTEGER NOT NULL);
+"""
+
+
+def match_expression(query: str) -> str:
+    """The FTS5 MATCH expression for a user's query, with every term quoted so nothing in it is taken as syntax."""
+    terms = []
+    for term in QUERY_TERM.findall(query):
+        prefix = term.endswith("*")
+        terms.append('"' + term.rstrip("*") + '"' + ("*" if prefix else ""))
+    if not terms:
+        raise ValueError("The query has no words to search for")
+    return " ".join(terms)
+
+
+class SearchIndex:
+    """The rooms' FTS5 indexes in a directory. A writable index is written by one thread at a time."""
+
+    def __init__(self, directory: str, read_only: bool = False, max_open_rooms: int = 64):
+        self.directory = directory
+        self.read_only = read_only
+        self.max_open_rooms = max_open_rooms
+        # Write connections by room, least recently used first
+        self._databases: "OrderedDict[str, sqlite3.Connection]" = OrderedDict()
+        if not read_only:
+            os.makedirs(directory, exist_ok=True)
+
+    def path(self, room: str) -> str:
+        return os.path.join(self.directory, room + SEARCH_SUFFIX)
+
+    def _database(self, room: str) -> sqlite3.Connection:
+        db = self._databases.get(room)
+        if db is not None:
+            self._databases.move_to_end(room)
+            return db
+        while len(self._databases) >= self.max_open_rooms:
+            _, oldest = self._databases.popitem(last=False)
+            oldest.close()
+        db = sqlite3.connect(self.path(room), isolation_level=None, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        # The index can always be rebuilt from the history, so it is not fsynced on every commit
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.executescript(SCHEMA)
+        self._databases[room] = db
+        return db
+
+    def _reader(self, room: str) -> Optional[sqlite3.Connection]:
+        """A fresh read-only connection (usable from any thread or process), or None if the room has no index yet."""
+        path = self.path(room)
+        if not os.path.exists(path):
+            return None
+        return sqlite3.connect(f"file:{quote(os.path.abspath(path))}?mode=ro", uri=True, check_same_thread=False)
+
+    def indexed_through(self, room: str) -> int:
+        """The seq up to which the room's history is indexed."""
+        if self.read_only:
+            db = self._reader(room)
+            if db is None:
+                return 0
+            try:
+                return self._through(db)
+            finally:
+                db.close()
+        return self._through(self._database(room))
+
+    @staticmethod
+    def _through(db: sqlite3.Connection) -> int:
+        try:
+            row = db.execute("SELECT through FROM indexed WHERE id = 0").fetchone()
+        except sqlite3.OperationalError:  # Created but not initialized yet
+            return 0
+        return row[0] if row else 0
+
+    def add_many(self, room: str, envelopes: Iterable[Envelope], through: int):
+        """Index the room's chat messages among `envelopes`, all newer than what is indexed, in one transaction;
+        the room is then indexed through seq `through`."""
+        db = self._database(room)
+        db.execute("BEGIN")
+        try:
+            db.executemany(
+                "INSERT INTO messages (rowid, body) VALUES (?, ?)",
+                ((envelope.seq, envelope.body) for envelope in envelopes if envelope.kind == MESSAGE and envelope.seq),
+            )
+            db.execute("INSERT OR REPLACE INTO indexed (id, through) VALUES (0, ?)", (through,))
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+
+    def search(
+        self, room: str, query: str, limit: int = 20, offset: int = 0, sort: str = "relevance"
+    ) -> Tuple[List[Tuple[int, float]], int]:
+        """The (seq, score) of the room's messages matching `query`, one page of them in `sort` order,
+        and the seq up to which the room is indexed. Raises ValueError for a query without words."""
+        if sort not in SORTS:
+            raise ValueError(f"Unknown sort '{sort}', expected one of {', '.join(SORTS)}")
+        expression = match_expression(query)
+        db = self._reader(room)
+        if db is None:
+            return [], 0
+        newest = "SELECT rowid, bm25(messages) AS score FROM messages WHERE messages MATCH ? ORDER BY rowid DESC"
+        try:
+            if sort == "relevance":
+                rows = db.execute(
+                    f"SELECT rowid, score FROM ({newest} LIMIT ?) ORDER BY score, rowid DESC LIMIT ? OFFSET ?",
+                    (expression, RANK_WINDOW, limit, offset),
+                ).fetchall()
+            else:
+                rows = db.execute(f"{newest} LIMIT ? OFFSET ?", (expression, limit, offset)).fetchall()
+            through = self._through(db)
+        except sqlite3.OperationalError as e:
+            if "no such table" in str(e):
+                return [], 0
+            raise
+        finally:
+            db.close()
+        # BM25 is negative in SQLite, lower is better
+        return [(seq, -score) for seq, score in rows], through
+
+    def close(self):
+        while self._databases:
+            _, db = self._databases.popitem()
+            db.close()
+
+
+class IndexerStats:
+    def __init__(self):
+        self.indexed = 0
+        self.backfilled = 0
+        self.batches = 0
+        self.errors = 0
+        self.flush_seconds_max = 0.0
+
+    def snapshot(self) -> dict:
+        return dict(vars(self))
+
+
+class SearchIndexer:
+    """Keeps a SearchIndex current with a HistoryStore, off the event loop.
+
+    Messages handed to add() are indexed in batches by one background task, so
+    they cost the writer nothing but a queue insert. A room whose index is
+    behind the first message of a batch is first filled in from the history
+    store. Rooms passed to start() are brought up to date in chunks while no
+    new messages are waiting.
+    """
+
+    def __init__(self, index: SearchIndex, store: HistoryStore, max_batch: int = 5000):
+        self.index = index
+        self.store = store
+        self.max_batch = max_batch
+        self.stats = IndexerStats()
+        self._queue: "asyncio.Queue[Tuple[str, Envelope]]" = asyncio.Queue()
+        self._backfill: Deque[str] = deque()
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def start(self, backfill: Iterable[str] = ()):
+        """Start indexing; the rooms in `backfill` are caught up with their history in the background."""
+        self._backfill.extend(backfill)
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        """Index everything queued so far, then stop."""
+        if self._task is not None:
+            await self._queue.join()
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.index.close()
+
+    def add(self, room: str, envelope: Envelope):
+        """Queue a message written to the room's history (its seq set) for indexing."""
+        self._queue.put_nowait((room, envelope))
+
+    async def _run(self):
+        while True:
+            if self._queue.empty() and self._backfill:
+                room = self._backfill.popleft()
+                try:
+                    if not await asyncio.to_thread(self._catch_up, room, BACKFILL_CHUNK):
+                        self._backfill.append(room)
+                except Exception as e:
+                    self.stats.errors += 1
+                    logger.error(f"Error indexing the history of {room}: {e}")
+                continue
+
+            batch = [await self._queue.get()]
+            while len(batch) < self.max_batch and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            try:
+                await asyncio.to_thread(self._flush, batch)
+            except Exception as e:
+                self.stats.errors += 1
+                logger.error(f"Error indexing {len(batch)} messages: {e}")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _flush(self, batch: List[Tuple[str, Envelope]]):
+        """Index a batch, one transaction per room. Runs in a worker thread."""
+        started = time.perf_counter()
+        by_room: Dict[str, List[Envelope]] = {}
+        for room, envelope in batch:
+            if envelope.seq:
+                by_room.setdefault(room, []).append(envelope)
+        for room, envelopes in by_room.items():
+            through = self.index.indexed_through(room)
+            if envelopes[0].seq > through + 1:
+                self._catch_up(room, until=envelopes[0].seq - 1)
+                through = self.index.indexed_through(room)
+            new = [envelope for envelope in envelopes if envelope.seq > through]
+            if new:
+                self.index.add_many(room, new, new[-1].seq)
+                self.stats.indexed += len(new)
+        self.stats.batches += 1
+        self.stats.flush_seconds_max = max(self.stats.flush_seconds_max, time.perf_counter() - started)
+
+    def _catch_up(self, room: str, limit: Optional[int] = None, until: Optional[int] = None) -> bool:
+        """Index the room's history after what is indexed, up to seq `until` (its end by default), at most
+        `limit` messages. Returns whether the room is caught up. Runs in a worker thread."""
+        through = self.index.indexed_through(room)
+        end = self.store.count(room) if until is None else until
+        if limit is not None:
+            end = min(end, through + limit)
+        while through < end:
+            chunk = self.store.read_range(room, through + 1, min(end, through + BACKFILL_CHUNK) + 1)
+            if not chunk:
+                logger.warning(f"History of {room} ends at seq {through}, before the {end} messages it counts")
+                return True
+            self.index.add_many(room, chunk, chunk[-1].seq)
+            self.stats.backfilled += len(chunk)
+            through = chunk[-1].seq
+        return until is not None or through >= self.store.count(room)
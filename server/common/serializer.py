@@ -0,0 +1,83 @@
+"""
+JSON encoding and decoding through the fastest library installed.
+
+orjson is preferred, then msgspec, then the standard library. All of them
+produce the same compact UTF-8 JSON for the data the chat servers exchange
+(str keys; str, int, float, bool, None, list and dict values), and all raise
+ValueError on invalid input. ``loads`` accepts str or UTF-8 bytes, ``dumps``
+returns UTF-8 bytes. ``BACKEND`` names the one in use; CHAT_JSON=json
+(or msgspec) forces a particular one.
+
+    from common.serializer import dumps, loads
+    loads(b'{"username": "alice", "message": "hi"}')
+"""
+import json
+import os
+from typing import Any, Union
+
+from starlette.responses import JSONResponse as StarletteJSONResponse
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+BACKENDS = ("orjson", "msgspec", "json")
+
+Data = Union[str, bytes, bytearray, memoryview]
+
+
+def _available(name: str) -> bool:
+    return name == "json" or (name == "orjson" and orjson is not None) or (name == "msgspec" and msgspec is not None)
+
+
+BACKEND = os.environ.get("CHAT_JSON") or next(name for name in BACKENDS if _available(name))
+if BACKEND not in BACKENDS:
+    raise ValueError(f"Unknown CHAT_JSON '{BACKEND}', expected one of {BACKENDS}")
+if not _available(BACKEND):
+    raise ImportError(f"CHAT_JSON={BACKEND} but {BACKEND} is not installed")
+
+
+if BACKEND == "orjson":
+    loads = orjson.loads
+    dumps = orjson.dumps
+
+elif BACKEND == "msgspec":
+    _encoder = msgspec.json.Encoder()
+    _decoder = msgspec.json.Decoder()
+
+    def loads(data: Data) -> Any:
+        try:
+            return _decoder.decode(data)
+        except msgspec.DecodeError as e:
+            raise ValueError(str(e)) from None
+
+    dumps = _encoder.encode
+
+else:
+    _encoder = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+
+    def loads(data: Data) -> Any:
+        if isinstance(data, memoryview):
+            data = bytes(data)
+        return json.loads(data)
+
+    def dumps(obj: Any) -> bytes:
+        return _encoder.encode(obj).encode("utf-8")
+
+
+def dumps_str(obj: Any) -> str:
+    """Encode an object as a compact JSON string."""
+    return dumps(obj).decode("utf-8")
+
+
+class JSONResponse(StarletteJSONResponse):
+    """FastAPI/Starlette JSON response rendered with the selected backend (use as default_response_class)."""
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
@@ -0,0 +1,180 @@
+"""
+Signed session tokens: issued by the auth service, verified by the chat servers.
+
+A token is "<payload>.<signature>", both base64url without padding. The
+payload is "<key id>:<expiry (unix seconds)>:<username>" and the signature is
+the HMAC-SHA256 of the encoded payload under the key with that id. Keys are
+shared by configuration (AUTH_KEYS, "<id>:<secret>" pairs separated by commas,
+the first one signing new tokens), so verifying a token is a dictionary lookup
+and one HMAC in memory: no request to the auth service and no Redis.
+Listing a new key first and keeping the old one until its tokens have expired
+rotates keys without logging anybody out.
+
+The auth service checks passwords against salted PBKDF2 hashes listed in
+AUTH_USERS ("<username>:<hash>" pairs separated by commas, each hash made by
+hash_password, or `python -m common.tokens`), so it never holds a password in
+the clear.
+"""
+import base64
+import binascii
+import hashlib
+import hmac
+import os
+import time
+from typing import Dict, Optional, Tuple
+
+# Tokens live this long unless the auth service is configured otherwise, in seconds
+TOKEN_TTL = 24 * 3600
+# Longest username a token may carry
+MAX_USERNAME = 64
+# PBKDF2-SHA256 rounds of new password hashes; a hash records its own, so this can be raised later
+PASSWORD_ITERATIONS = 200000
+
+# Why a token was rejected
+MALFORMED = "malformed"
+UNKNOWN_KEY = "unknown_key"
+BAD_SIGNATURE = "bad_signature"
+EXPIRED = "expired"
+
+
+class TokenError(Exception):
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+def parse_keys(spec: str) -> Dict[str, bytes]:
+    """Keys listed as "<id>:<secret>,<id>:<secret>" (AUTH_KEYS), in order; empty when `spec` is."""
+    keys: Dict[str, bytes] = {}
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        key_id, sep, secret = part.partition(":")
+        if not sep or not key_id or not secret:
+            raise ValueError(f"Invalid auth key '{key_id}', expected <id>:<secret>")
+        keys[key_id] = secret.encode("utf-8")
+    return keys
+
+
+def parse_users(spec: str) -> Dict[str, str]:
+    """Password hashes by username, listed as "<username>:<hash>,<username>:<hash>" (AUTH_USERS)."""
+    users: Dict[str, str] = {}
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        username, sep, password_hash = part.rpartition(":")
+        if not sep or not username or password_hash.count("$") != 3:
+            raise ValueError(f"Invalid auth user '{username or part}', expected <username>:<hash from hash_password>")
+        users[username] = password_hash
+    return users
+
+
+def hash_password(password: str, salt: Optional[bytes] = None, iterations: int = PASSWORD_ITERATIONS) -> str:
+    """A salted hash of `password` to list in AUTH_USERS: "pbkdf2_sha256$<iterations>$<salt>$<digest>"."""
+    salt = os.urandom(16) if salt is None else salt
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt, iterations)
+    return f"pbkdf2_sha256${iterations}${_b64encode(salt)}${_b64encode(digest)}"
+
+
+def check_password(password: str, password_hash: str) -> bool:
+    """Whether `password` matches a hash made by hash_password. Takes tens of milliseconds by design."""
+    try:
+        algorithm, iterations, salt, digest = password_hash.split("$")
+        if algorithm != "pbkdf2_sha256":
+            return False
+        expected = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), _b64decode(salt), int(iterations))
+    except (binascii.Error, ValueError):
+        return False
+    return hmac.compare_digest(_b64encode(expected), digest)
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+def _sign(key: bytes, payload: str) -> str:
+    return _b64encode(hmac.new(key, payload.encode("ascii"), hashlib.sha256).digest())
+
+
+class TokenSigner:
+    """Issues tokens with the first of `keys`."""
+
+    def __init__(self, keys: Dict[str, bytes], ttl: float = TOKEN_TTL):
+        if not keys:
+            raise ValueError("No signing key configured (AUTH_KEYS)")
+        self.key_id, self.key = next(iter(keys.items()))
+        self.ttl = ttl
+
+    def issue(self, username: str, now: Optional[float] = None) -> Tuple[str, int]:
+        """A token for `username` and its expiry (unix seconds)."""
+        if not username or len(username) > MAX_USERNAME:
+            raise ValueError(f"Usernames must be 1 to {MAX_USERNAME} characters")
+        expires = int((time.time() if now is None else now) + self.ttl)
+        payload = _b64encode(f"{self.key_id}:{expires}:{username}".encode("utf-8"))
+        return f"{payload}.{_sign(self.key, payload)}", expires
+
+
+class TokenStats:
+    def __init__(self):
+        self.verified = 0
+        self.malformed = 0
+        self.unknown_key = 0
+        self.bad_signature = 0
+        self.expired = 0
+
+    def snapshot(self) -> dict:
+        return dict(vars(self))
+
+
+class TokenVerifier:
+    """Checks tokens against keys held in memory; verification never does I/O."""
+
+    def __init__(self, keys: Dict[str, bytes], leeway: float = 30.0):
+        if not keys:
+            raise ValueError("No verification key configured (AUTH_KEYS)")
+        self.keys = dict(keys)
+        # Clock skew tolerated between the auth service and this process, in seconds
+        self.leeway = leeway
+        self.stats = TokenStats()
+
+    def verify(self, token: Optional[str], now: Optional[float] = None) -> str:
+        """The username a valid token was issued to. Raises TokenError otherwise."""
+        try:
+            username = self._verify(token, time.time() if now is None else now)
+        except TokenError as e:
+            setattr(self.stats, e.reason, getattr(self.stats, e.reason) + 1)
+            raise
+        self.stats.verified += 1
+        return username
+
+    def _verify(self, token: Optional[str], now: float) -> str:
+        payload, sep, signature = (token or "").partition(".")
+        if not sep or not payload.isascii() or not signature.isascii():
+            raise TokenError(MALFORMED)
+        try:
+            key_id, expires, username = _b64decode(payload).decode("utf-8").split(":", 2)
+            expires = int(expires)
+        except (binascii.Error, UnicodeDecodeError, ValueError):
+            raise TokenError(MALFORMED)
+        key = self.keys.get(key_id)
+        if key is None:
+            raise TokenError(UNKNOWN_KEY)
+        if not hmac.compare_digest(_sign(key, payload), signature):
+            raise TokenError(BAD_SIGNATURE)
+        if expires + self.leeway < now:
+            raise TokenError(EXPIRED)
+        if not username:
+            raise TokenError(MALFORMED)
+        return username
+
+
+if __name__ == "__main__":
+    # python -m common.tokens (from server/) prints the hash to list for a user in AUTH_USERS
+    import getpass
+    print(hash_password(getpass.getpass("Password: ")))
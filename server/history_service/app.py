@@ -1,17 +1,54 @@
 import os
+import sys
 import asyncio
 import redis.asyncio as redis
 import logging
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException
+import time
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, WebSocket, HTTPException, Query, Request
+from fastapi.responses import Response
 from pydantic import BaseModel
 from typing import Dict, List, Optional
+from urllib.parse import quote
 from fastapi.middleware.cors import CORSMiddleware
 
-# Setup logging
-logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+# Make the shared `common` package (server/common) importable when run from this directory
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from common.history_store import DEFAULT_CODEC, HistoryStore
+from common.group_commit import GroupCommitWriter
+from common.broker import PUBLISH_BATCH, create_broker
+from common.recent_cache import RecentMessageCache
+from common.cluster import RoomDirectory, ingest_channel
+from common.envelope import EVENT, Envelope
+from common.presence import PresenceTracker
+from common.ratelimit import RateLimiter
+from common.metrics import CONTENT_TYPE, Registry
+from common.serializer import JSONResponse
+from common.tokens import TokenError, TokenVerifier, parse_keys
+from common.gateway import Gateway, bearer_token
+from common.search_index import SORTS, SearchIndex, SearchIndexer
+
+# Setup logging; per-message logs are DEBUG (LOG_LEVEL=DEBUG), /metrics covers message traffic
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO"), format="%(asctime)s - %(levelname)s - %(message)s")
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if HISTORY_MODE == "local":
+        history_writer.start()
+        # Rooms are indexed in the background up to their current history
+        search_indexer.start(backfill=history_store.rooms())
+    broker.start()
+    presence.start()
+    yield
+    await presence.close()
+    await broker.close()
+    await history_writer.close()
+    await search_indexer.close()
+
+# Responses are rendered with the fastest JSON library installed (see common/serializer.py)
+app = FastAPI(lifespan=lifespan, default_response_class=JSONResponse)
 
 # Allow cross-origin requests (adjust as needed)
 app.add_middleware(
@@ -22,155 +59,361 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Path to store chat history files
-CHAT_HISTORY_DIR = "chat_history"
-os.makedirs(CHAT_HISTORY_DIR, exist_ok=True)
+# "local": this process persists the messages it receives (run a single worker).
+# "cluster": any number of workers on any number of nodes; messages are persisted by
+# history_consumer.py, the single writer of each room, and rooms are registered in Redis.
+HISTORY_MODE = os.environ.get("HISTORY_MODE", "local")
+if HISTORY_MODE not in ("local", "cluster"):
+    raise ValueError(f"Unknown HISTORY_MODE '{HISTORY_MODE}', expected 'local' or 'cluster'")
+# Number of ingest channels the rooms are hashed into; must match the history consumers
+INGEST_SHARDS = int(os.environ.get("INGEST_SHARDS", "1"))
+# Where clients open their WebSockets: this service, or the chat gateways (server/chat_service) in front of it
+CHAT_GATEWAY_URL = os.environ.get("CHAT_GATEWAY_URL", "ws://localhost:5000").rstrip("/")
+
+# Path to store chat history files (read-only here in cluster mode)
+CHAT_HISTORY_DIR = os.environ.get("CHAT_HISTORY_DIR", "chat_history")
+# A room's history is sealed into a new segment every HISTORY_SEGMENT_BYTES (or HISTORY_SEGMENT_SECONDS
+# when set); sealed segments are compressed with HISTORY_CODEC (zstd when installed, else gzip)
+HISTORY_SEGMENT_BYTES = int(os.environ.get("HISTORY_SEGMENT_BYTES", str(8 * 1024 * 1024)))
+HISTORY_SEGMENT_SECONDS = float(os.environ.get("HISTORY_SEGMENT_SECONDS", "0"))
+HISTORY_CODEC = os.environ.get("HISTORY_CODEC", DEFAULT_CODEC)
+history_store = HistoryStore(
+    CHAT_HISTORY_DIR,
+    read_only=HISTORY_MODE == "cluster",
+    segment_bytes=HISTORY_SEGMENT_BYTES,
+    segment_seconds=HISTORY_SEGMENT_SECONDS,
+    codec=HISTORY_CODEC,
+)
+
+# History writes are grouped off the event loop; durability is one of none / batch / interval
+HISTORY_DURABILITY = os.environ.get("HISTORY_DURABILITY", "interval")
+HISTORY_FSYNC_INTERVAL = float(os.environ.get("HISTORY_FSYNC_INTERVAL", "1.0"))
+history_writer = GroupCommitWriter(history_store, durability=HISTORY_DURABILITY, fsync_interval=HISTORY_FSYNC_INTERVAL)
+
+# Number of messages returned on join and the upper bound for a single history page
+HISTORY_PAGE_SIZE = int(os.environ.get("HISTORY_PAGE_SIZE", "100"))
+MAX_HISTORY_PAGE_SIZE = 1000
+
+# Full-text index of every room's history (see common/search_index.py), kept current by whichever
+# process writes the history: this one in local mode, the history consumers in cluster mode
+CHAT_SEARCH_DIR = os.environ.get("CHAT_SEARCH_DIR", "chat_search")
+search_index = SearchIndex(CHAT_SEARCH_DIR, read_only=HISTORY_MODE == "cluster")
+search_indexer = SearchIndexer(search_index, history_store)
+# Hits returned by /search by default, and the most it returns per page and in total
+SEARCH_PAGE_SIZE = 20
+MAX_SEARCH_PAGE_SIZE = 100
+MAX_SEARCH_RESULTS = 10000
+
+# The page sent on join is kept in memory per room; cold rooms are evicted once the cache holds RECENT_CACHE_BYTES
+RECENT_CACHE_BYTES = int(os.environ.get("RECENT_CACHE_BYTES", str(64 * 1024 * 1024)))
+recent_cache = RecentMessageCache(HISTORY_PAGE_SIZE, RECENT_CACHE_BYTES)
+
+# A reconnecting client passes the seq of the last message it saw (/ws/<room>?after=<seq>) and is sent only
+# what it missed. When more than RESUME_MAX_MESSAGES are missing it gets the newest ones; the seq gap
+# tells it where to page /history?after= for the rest.
+RESUME_MAX_MESSAGES = int(os.environ.get("RESUME_MAX_MESSAGES", "1000"))
+
+# Redis connection settings (REDIS_URL takes precedence)
+REDIS_HOST = os.environ.get("REDIS_HOST", "localhost")
+REDIS_PORT = int(os.environ.get("REDIS_PORT", "6379"))
+REDIS_URL = os.environ.get("REDIS_URL", f"redis://{REDIS_HOST}:{REDIS_PORT}")
+
+# Messages travel as binary envelopes, so payloads are left as bytes.
+# The client only connects once used, so local mode with CHAT_BROKER=inprocess runs without Redis.
+redis_client = redis.from_url(REDIS_URL)
+
+# Message bus between the processes serving a room (see common/broker.py): "batching", "redis" or,
+# for a single process in local mode, "inprocess". A room is subscribed while it has clients here.
+CHAT_BROKER = os.environ.get("CHAT_BROKER", "batching")
+# The batching broker pipelines up to BROKER_MAX_BATCH publishes, adding at most BROKER_LINGER_MS to each
+BROKER_MAX_BATCH = int(os.environ.get("BROKER_MAX_BATCH", str(PUBLISH_BATCH)))
+BROKER_LINGER_MS = float(os.environ.get("BROKER_LINGER_MS", "1"))
+broker = create_broker(CHAT_BROKER, redis_client, max_batch=BROKER_MAX_BATCH, linger=BROKER_LINGER_MS / 1000)
+if HISTORY_MODE == "cluster" and not broker.shared:
+    raise ValueError(f"CHAT_BROKER '{CHAT_BROKER}' cannot reach the other workers, cluster mode needs Redis")
+# Rooms shared by all workers in cluster mode
+room_directory = RoomDirectory(redis_client)
+
+# Joins and leaves of WebSocket clients that pass ?username= are announced to the room in one
+# digest per PRESENCE_INTERVAL seconds; the roster is shared through Redis between cluster workers
+PRESENCE_INTERVAL = float(os.environ.get("PRESENCE_INTERVAL", "1.0"))
+presence = PresenceTracker(
+    broker.publish,
+    interval=PRESENCE_INTERVAL,
+    redis_client=redis_client if HISTORY_MODE == "cluster" else None,
+)
 
-# Redis connection settings
-REDIS_HOST = "localhost"
-REDIS_PORT = 6379
+# Incoming messages are checked before they are parsed: at most MAX_MESSAGE_BYTES each, and
+# token buckets of <rate> messages/s with bursts of <burst> per connection and per room (0 = unlimited)
+rate_limiter = RateLimiter(
+    connection_rate=float(os.environ.get("CONNECTION_MESSAGE_RATE", "5")),
+    connection_burst=float(os.environ.get("CONNECTION_MESSAGE_BURST", "20")),
+    room_rate=float(os.environ.get("ROOM_MESSAGE_RATE", "200")),
+    room_burst=float(os.environ.get("ROOM_MESSAGE_BURST", "400")),
+    max_message_bytes=int(os.environ.get("MAX_MESSAGE_BYTES", str(16 * 1024))),
+)
 
-redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, decode_responses=True)
+# Outgoing messages are queued per client; a client whose queue overflows is handled by the policy
+# (drop_oldest / coalesce / disconnect) instead of delaying the rest of the room.
+FANOUT_QUEUE_SIZE = int(os.environ.get("FANOUT_QUEUE_SIZE", "256"))
+FANOUT_OVERFLOW_POLICY = os.environ.get("FANOUT_OVERFLOW_POLICY", "drop_oldest")
+
+# With AUTH_KEYS (the auth service's "<id>:<secret>,..." keys), WebSocket clients need a token from
+# server/auth_service, checked once when they connect, and creating or joining a room needs it as a Bearer header;
+# without it, ?username= and the requests' username are taken on trust
+AUTH_KEYS = parse_keys(os.environ.get("AUTH_KEYS", ""))
+token_verifier = TokenVerifier(AUTH_KEYS) if AUTH_KEYS else None
+# Most WebSockets one username may hold open on this process, across rooms; off (0) unless set
+MAX_USER_CONNECTIONS = int(os.environ.get("MAX_USER_CONNECTIONS", "0"))
+
+# WebSocket clients of this process (see common/gateway.py); new messages go through save_and_broadcast_message
+gateway = Gateway(
+    broker,
+    history_store,
+    lambda chat_room_name, message: save_and_broadcast_message(chat_room_name, message),
+    recent_cache,
+    presence,
+    rate_limiter,
+    fanout_queue_size=FANOUT_QUEUE_SIZE,
+    fanout_policy=FANOUT_OVERFLOW_POLICY,
+    follow_channels=HISTORY_MODE == "cluster",
+    resume_max_messages=RESUME_MAX_MESSAGES,
+    verifier=token_verifier,
+    max_user_connections=MAX_USER_CONNECTIONS,
+)
 
-# Store active WebSocket connections and their Redis listener task per chat room.
-# Structure: { chat_room_name: { "clients": [WebSocket, ...], "redis_task": asyncio.Task } }
-active_connections: Dict[str, Dict[str, Optional[object]]] = {}
+# Prometheus metrics served on /metrics
+metrics = Registry()
+gateway.register_metrics(metrics)
+history_append_seconds = metrics.histogram(
+    "chat_history_append_seconds",
+    "Time for a message to be appended to history by the group-commit writer, including its wait in the queue (local mode)",
+)
+metrics.gauge("chat_history_write_queue", "Messages waiting for the group-commit writer", lambda: history_writer.queue_depth)
+metrics.gauge("chat_search_index_queue", "Messages waiting to be added to the search index", lambda: search_indexer.queue_depth)
 
 # ====== REST API ======
 
+def before_cursor(page: List[Envelope]) -> Optional[int]:
+    """The `before` that fetches the page older than `page`, or None once the beginning of the room is reached."""
+    return page[0].seq if page and page[0].seq > 1 else None
+
 class ChatRoomRequest(BaseModel):
     username: str
     chat_room_name: str
 
+def request_username(request: ChatRoomRequest, http_request: Request) -> str:
+    """Who sent the request: the username of its Bearer token when AUTH_KEYS is set, the body's otherwise."""
+    if token_verifier is None:
+        return request.username
+    try:
+        return token_verifier.verify(bearer_token(http_request))
+    except TokenError as e:
+        logger.warning(f"Request refused: {e.reason} token")
+        raise HTTPException(status_code=401, detail="Invalid or missing token", headers={"WWW-Authenticate": "Bearer"})
+
 @app.post("/create-chat-room")
-async def create_chat_room(request: ChatRoomRequest):
-    """Creates a new chat room and broadcasts an event message."""
-    chat_room_name = request.chat_room_name
-    username = request.username
+async def create_chat_room(request: ChatRoomRequest, http_request: Request):
+    """Creates a new chat room and broadcasts an event message.
 
-    file_path = os.path.join(CHAT_HISTORY_DIR, f"{chat_room_name}.txt")
+    With AUTH_KEYS set the creator is the user of the request's Bearer token, not the body's `username`.
+    """
+    chat_room_name = request.chat_room_name
+    username = request_username(request, http_request)
 
-    if os.path.exists(file_path):
+    # Create empty history for the room
+    if not await create_room(chat_room_name, username):
         logger.warning(f"Chat room '{chat_room_name}' already exists.")
         return {"message": "Chat room already exists"}
 
-    # Create empty file for chat history
-    open(file_path, "w").close()
     logger.info(f"Chat room '{chat_room_name}' created.")
 
     # Broadcast room creation message
-    event_message = f"🟢 {username} created the room '{chat_room_name}'"
+    event_message = Envelope(EVENT, chat_room_name, f"🟢 {username} created the room '{chat_room_name}'", username)
     await save_and_broadcast_message(chat_room_name, event_message)
 
-    websocket_url = f"ws://localhost:5000/ws/{chat_room_name}"
+    websocket_url = f"{CHAT_GATEWAY_URL}/ws/{chat_room_name}?username={quote(username)}"
     return {"chat_room": chat_room_name, "websocket_url": websocket_url}
 
 @app.post("/join-chat-room")
-async def join_chat_room(request: ChatRoomRequest):
-    """A user joins an existing chat room, receives history, and triggers a broadcast event."""
-    chat_room_name = request.chat_room_name
-    username = request.username
+async def join_chat_room(request: ChatRoomRequest, http_request: Request):
+    """A user joins an existing chat room and receives recent history.
 
-    file_path = os.path.join(CHAT_HISTORY_DIR, f"{chat_room_name}.txt")
+    Other members learn about the user from the presence digest once their WebSocket connects.
+    With AUTH_KEYS set the user is the one of the request's Bearer token, as for room creation.
+    """
+    chat_room_name = request.chat_room_name
+    username = request_username(request, http_request)
 
-    if not os.path.exists(file_path):
+    if not await room_exists(chat_room_name):
         logger.warning(f"Chat room '{chat_room_name}' does not exist.")
         raise HTTPException(status_code=404, detail="Chat room not found")
 
-    # Read chat history
-    with open(file_path, "r", encoding="utf-8") as f:
-        history = [line.strip() for line in f.readlines()]
-
-    # Broadcast join message
-    event_message = f"🔵 {username} joined the chat"
-    await save_and_broadcast_message(chat_room_name, event_message)
-
-    websocket_url = f"ws://localhost:5000/ws/{chat_room_name}"
-    return {"chat_room": chat_room_name, "history": history, "websocket_url": websocket_url}
-
-# ====== WebSocket Communication ======
-
-@app.websocket("/ws/{chat_room_name}")
-async def websocket_endpoint(websocket: WebSocket, chat_room_name: str):
-    """Handles WebSocket connections and broadcasts messages using a shared Redis listener per chat room."""
-    await websocket.accept()
-    logger.info(f"WebSocket connected for room: {chat_room_name}")
-
-    # Initialize data for the room if needed
-    if chat_room_name not in active_connections:
-        active_connections[chat_room_name] = {"clients": [], "redis_task": None}
-    active_connections[chat_room_name]["clients"].append(websocket)
-
-    # If no Redis listener is running for this room, start one.
-    if active_connections[chat_room_name]["redis_task"] is None:
-        active_connections[chat_room_name]["redis_task"] = asyncio.create_task(listen_to_redis(chat_room_name))
+    # Send only the latest page of chat history; older pages are served by /history
+    page = await recent_history(chat_room_name)
+    history = [envelope.text for envelope in page]
+    history_before = before_cursor(page)
+    # Connecting with ?after=<last_seq> also delivers whatever is sent between this response and the connection
+    last_seq = page[-1].seq if page else 0
+
+    websocket_url = f"{CHAT_GATEWAY_URL}/ws/{chat_room_name}?username={quote(username)}"
+    return {
+        "chat_room": chat_room_name,
+        "history": history,
+        "history_before": history_before,
+        "last_seq": last_seq,
+        "websocket_url": websocket_url,
+    }
+
+@app.get("/history/{chat_room_name}")
+async def get_history(
+    chat_room_name: str,
+    before: Optional[int] = Query(None, ge=1),
+    after: Optional[int] = Query(None, ge=0),
+    limit: int = Query(HISTORY_PAGE_SIZE, ge=1, le=MAX_HISTORY_PAGE_SIZE),
+):
+    """Returns one page of chat history, oldest first: older than `before` (or the newest page),
+    or, with `after`, the messages that follow that seq, e.g. the ones a reconnecting client missed."""
+    if not await room_exists(chat_room_name):
+        raise HTTPException(status_code=404, detail="Chat room not found")
 
+    if after is not None:
+        page = await asyncio.to_thread(history_store.read_after, chat_room_name, after, limit)
+    else:
+        page = await asyncio.to_thread(history_store.read_page, chat_room_name, before, limit)
+    messages = [envelope.to_dict() for envelope in page]
+    next_before = before_cursor(page)
+    return {"chat_room": chat_room_name, "messages": messages, "next_before": next_before}
+
+@app.get("/search")
+async def search_history(
+    room: str = Query(..., min_length=1),
+    q: str = Query(..., min_length=1, max_length=200),
+    sort: str = Query("relevance", pattern=f"^({'|'.join(SORTS)})$"),
+    offset: int = Query(0, ge=0, le=MAX_SEARCH_RESULTS),
+    limit: int = Query(SEARCH_PAGE_SIZE, ge=1, le=MAX_SEARCH_PAGE_SIZE),
+):
+    """Searches a room's history for the messages containing every word of `q` ("word*" matches a prefix).
+
+    Hits come best match first, or newest first with sort=recent, and carry their seq: /history?after=<seq - 1>
+    shows a hit in context. `next_offset` pages through the rest. `indexed_through` is the seq up to which the
+    room is indexed; messages after it (being indexed right now) are not searched yet.
+    """
+    if not await room_exists(room):
+        raise HTTPException(status_code=404, detail="Chat room not found")
     try:
-        while True:
-            data = await websocket.receive_json()
-            username = data.get("username")
-            message_content = data.get("message")
-
-            if not username or not message_content:
-                await websocket.send_text("❌ Invalid message format. Use {'username': '<name>', 'message': '<text>'}")
-                continue
-
-            full_message = f"{username}: {message_content}"
-            await save_and_broadcast_message(chat_room_name, full_message)
-
-    except WebSocketDisconnect:
-        logger.warning(f"WebSocket disconnected for room: {chat_room_name}")
-        active_connections[chat_room_name]["clients"].remove(websocket)
-        # If no clients remain, cancel the Redis listener and clean up.
-        if not active_connections[chat_room_name]["clients"]:
-            redis_task = active_connections[chat_room_name]["redis_task"]
-            if redis_task:
-                redis_task.cancel()
-            del active_connections[chat_room_name]
-    except Exception as e:
-        logger.error(f"WebSocket error: {e}")
-        await websocket.close()
-
-async def listen_to_redis(chat_room_name: str):
-    """Listens for new messages from Redis for a specific chat room and broadcasts them to all clients."""
-    redis_client_async = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, decode_responses=True)
-    pubsub = redis_client_async.pubsub()
-    await pubsub.subscribe(chat_room_name)
-
+        hits, indexed_through = await asyncio.to_thread(search_index.search, room, q, limit, offset, sort)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    envelopes = await asyncio.to_thread(read_messages, room, [seq for seq, _ in hits])
+    results = [{**envelopes[seq].to_dict(), "score": score} for seq, score in hits if seq in envelopes]
+    next_offset = offset + len(hits) if len(hits) == limit and offset + len(hits) < MAX_SEARCH_RESULTS else None
+    return {"chat_room": room, "query": q, "hits": results, "next_offset": next_offset, "indexed_through": indexed_through}
+
+@app.get("/presence/{chat_room_name}")
+async def get_presence(chat_room_name: str):
+    """Returns who is connected to a chat room."""
+    if not await room_exists(chat_room_name):
+        raise HTTPException(status_code=404, detail="Chat room not found")
+    members = await presence.members(chat_room_name)
+    return {"chat_room": chat_room_name, "count": len(members), "members": members}
+
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus metrics of this process."""
+    return Response(metrics.render(), media_type=CONTENT_TYPE)
+
+@app.get("/stats")
+async def get_stats():
+    """Reports internal counters of the history service."""
+    return {
+        "mode": HISTORY_MODE,
+        "history_writer": {**history_writer.stats.snapshot(), "queue_depth": history_writer.queue_depth},
+        "search_indexer": {**search_indexer.stats.snapshot(), "queue_depth": search_indexer.queue_depth},
+        **gateway.stats(),
+    }
+
+async def create_room(chat_room_name: str, username: str) -> bool:
+    """Registers a new room. Returns False if it already exists."""
+    if HISTORY_MODE == "cluster":
+        return await room_directory.create(chat_room_name, username)
+    return history_store.create(chat_room_name)
+
+async def room_exists(chat_room_name: str) -> bool:
+    if HISTORY_MODE == "cluster":
+        return await room_directory.exists(chat_room_name)
+    return history_store.exists(chat_room_name)
+
+def read_messages(chat_room_name: str, seqs: List[int]) -> Dict[int, Envelope]:
+    """The room's messages with the given seqs, by seq, read through the history's offset index."""
+    messages = {}
+    for seq in seqs:
+        for envelope in history_store.read_range(chat_room_name, seq, seq + 1):
+            messages[envelope.seq] = envelope
+    return messages
+
+async def recent_history(chat_room_name: str) -> List[Envelope]:
+    """The room's latest page of history, from memory or loaded from disk on a miss."""
+    if HISTORY_MODE == "cluster" and gateway.registry.room(chat_room_name) is None:
+        # A worker only sees the messages of rooms it is subscribed to, so only those can be cached
+        return await asyncio.to_thread(history_store.read_page, chat_room_name, None, HISTORY_PAGE_SIZE)
+    entries = recent_cache.recent(chat_room_name)
+    if entries is not None:
+        return [envelope for _, envelope in entries]
+    recent_cache.begin_load(chat_room_name)
     try:
-        async for message in pubsub.listen():
-            if message["type"] == "message":
-                logger.info(f"New message in {chat_room_name}: {message['data']}")
-                # Broadcast to all clients in the room
-                for ws in active_connections.get(chat_room_name, {}).get("clients", []):
-                    try:
-                        await ws.send_text(message["data"])
-                    except Exception as e:
-                        logger.error(f"Failed to send message to a client: {e}")
-    except asyncio.CancelledError:
-        pass
+        page = await asyncio.to_thread(history_store.read_page, chat_room_name, None, HISTORY_PAGE_SIZE)
+        recent_cache.load(chat_room_name, [(envelope.seq, envelope) for envelope in page])
     finally:
-        await pubsub.unsubscribe(chat_room_name)
-        await redis_client_async.aclose()
+        recent_cache.end_load(chat_room_name)
+    return page
 
-async def save_and_broadcast_message(chat_room_name: str, message: str):
-    """Save a message to file and broadcast it via Redis."""
-    file_path = os.path.join(CHAT_HISTORY_DIR, f"{chat_room_name}.txt")
+# ====== WebSocket Communication ======
 
-    # Save to file
+@app.websocket("/ws/{chat_room_name}")
+async def websocket_endpoint(
+    websocket: WebSocket,
+    chat_room_name: str,
+    after: Optional[int] = Query(None, ge=0),
+    username: Optional[str] = Query(None, min_length=1),
+    token: Optional[str] = Query(None),
+):
+    """Handles WebSocket connections and broadcasts messages using the room's shared broker subscription.
+
+    With `after`, the seq of the last message the client saw, the messages it missed are replayed first.
+    The client is identified by its `token` when AUTH_KEYS is set, by `username` otherwise (see Gateway.serve).
+    """
+    await gateway.serve(websocket, chat_room_name, after, username, token)
+
+async def save_and_broadcast_message(chat_room_name: str, message: Envelope):
+    """Save a message to the room's history and broadcast it via the broker."""
+    if HISTORY_MODE == "cluster":
+        # The room's history consumer saves it, then publishes it to the room's channel
+        try:
+            await broker.publish(ingest_channel(chat_room_name, INGEST_SHARDS), message.encode())
+        except Exception as e:
+            logger.error(f"Error publishing to {broker.name} broker: {e}")
+        return
+
+    # Save to history; the writer sets the envelope's seq
     try:
-        with open(file_path, "a", encoding="utf-8") as f:
-            f.write(message + "\n")
-        logger.info(f"Message saved to {file_path}")
+        started = time.monotonic()
+        seq = await history_writer.append(chat_room_name, message)
+        history_append_seconds.observe(time.monotonic() - started)
+        recent_cache.append(chat_room_name, message, seq)
+        search_indexer.add(chat_room_name, message)
+        logger.debug("Message %d saved to history of %s", seq, chat_room_name)
     except Exception as e:
-        logger.error(f"Error writing to file {file_path}: {e}")
+        # Still delivered, but without a seq since it is not in the history
+        logger.error(f"Error saving message to history of {chat_room_name}: {e}")
+        message.seq = 0
 
-    # Publish to Redis
+    # Publish to the room's channel
     try:
-        await redis_client.publish(chat_room_name, message)
-        logger.info(f"Message published to Redis channel {chat_room_name}: {message}")
+        await broker.publish(chat_room_name, message.encode())
+        logger.debug("Message %d published to channel %s", message.seq, chat_room_name)
     except Exception as e:
-        logger.error(f"Error publishing to Redis: {e}")
+        logger.error(f"Error publishing to {broker.name} broker: {e}")
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,178 @@
+"""
+Single writer of chat history for the history service in cluster mode.
+
+With HISTORY_MODE=cluster, any number of app.py workers (uvicorn --workers,
+on any number of machines) accept WebSocket clients but never write history.
+They publish each new message to an ingest channel chosen by hashing its room
+into one of INGEST_SHARDS shards. This consumer owns a set of shards: it
+appends their messages to the history files (assigning sequence numbers) and
+only then publishes the sequenced envelopes to the room's channel, from which
+every worker fans them out to its own clients. Each room therefore has exactly
+one writer, and all workers see a room's messages in history order.
+
+    HISTORY_MODE=cluster uvicorn app:app --host 0.0.0.0 --port 5000 --workers 4
+    # one consumer owning every shard
+    python history_consumer.py
+    # or split the shards between consumers (each shard must have exactly one)
+    INGEST_SHARDS=4 HISTORY_CONSUMER_SHARDS=0,1 python history_consumer.py
+    INGEST_SHARDS=4 HISTORY_CONSUMER_SHARDS=2,3 python history_consumer.py
+
+The consumer also keeps the search index of its rooms (CHAT_SEARCH_DIR)
+current. Workers read history straight from CHAT_HISTORY_DIR and search
+CHAT_SEARCH_DIR, so on several machines both must be shared volumes. Ingest
+goes through Redis pub/sub, which is at-most-once: messages published while no
+consumer owns their shard are lost.
+"""
+import asyncio
+import logging
+import os
+import signal
+import sys
+from typing import List, Optional, Tuple
+
+import redis.asyncio as redis
+
+# Make the shared `common` package (server/common) importable when run from this directory
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from common.cluster import RoomDirectory, ingest_shard, parse_shards, shard_channel
+from common.envelope import Envelope, EnvelopeError, decode
+from common.group_commit import GroupCommitWriter
+from common.history_store import DEFAULT_CODEC, HistoryStore
+from common.broker import PUBLISH_BATCH, BatchingRedisBroker
+from common.search_index import SearchIndex, SearchIndexer
+
+# Per-message logs are DEBUG (LOG_LEVEL=DEBUG)
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO"), format="%(asctime)s - %(levelname)s - %(message)s")
+logger = logging.getLogger(__name__)
+
+# Shared read-only with app.py and the chat gateways
+CHAT_HISTORY_DIR = os.environ.get("CHAT_HISTORY_DIR", "chat_history")
+# Segment sealing and compression, as in app.py
+HISTORY_SEGMENT_BYTES = int(os.environ.get("HISTORY_SEGMENT_BYTES", str(8 * 1024 * 1024)))
+HISTORY_SEGMENT_SECONDS = float(os.environ.get("HISTORY_SEGMENT_SECONDS", "0"))
+HISTORY_CODEC = os.environ.get("HISTORY_CODEC", DEFAULT_CODEC)
+# Full-text index of the rooms, searched by app.py
+CHAT_SEARCH_DIR = os.environ.get("CHAT_SEARCH_DIR", "chat_search")
+HISTORY_DURABILITY = os.environ.get("HISTORY_DURABILITY", "interval")
+HISTORY_FSYNC_INTERVAL = float(os.environ.get("HISTORY_FSYNC_INTERVAL", "1.0"))
+
+REDIS_HOST = os.environ.get("REDIS_HOST", "localhost")
+REDIS_PORT = int(os.environ.get("REDIS_PORT", "6379"))
+REDIS_URL = os.environ.get("REDIS_URL", f"redis://{REDIS_HOST}:{REDIS_PORT}")
+
+# Must match the workers' INGEST_SHARDS
+INGEST_SHARDS = int(os.environ.get("INGEST_SHARDS", "1"))
+# Shards owned by this consumer, e.g. "0,1"; all of them when empty
+HISTORY_CONSUMER_SHARDS = os.environ.get("HISTORY_CONSUMER_SHARDS", "")
+# Persisted messages are published to room channels in pipelines of up to BROKER_MAX_BATCH,
+# each sent at most BROKER_LINGER_MS after its first message was written (as for the workers)
+BROKER_MAX_BATCH = int(os.environ.get("BROKER_MAX_BATCH", str(PUBLISH_BATCH)))
+BROKER_LINGER_MS = float(os.environ.get("BROKER_LINGER_MS", "1"))
+
+
+class HistoryConsumer:
+    """Persists ingested messages, then republishes them to their rooms in the order they were written."""
+
+    def __init__(self, redis_client: redis.Redis, writer: GroupCommitWriter, indexer: SearchIndexer):
+        self.redis_client = redis_client
+        self.writer = writer
+        self.indexer = indexer
+        # Ingest channels are subscribed, and room channels published to, through one batching broker
+        self.broker = BatchingRedisBroker(redis_client, max_batch=BROKER_MAX_BATCH, linger=BROKER_LINGER_MS / 1000)
+        # (envelope, future of its sequence number), in write order
+        self._outbox: "asyncio.Queue[Tuple[Envelope, asyncio.Future]]" = asyncio.Queue()
+        self._publisher: Optional[asyncio.Task] = None
+        self._shards: List[int] = []
+
+    async def start(self, shards):
+        self.writer.start()
+        # Each room is indexed by the consumer owning its shard; existing history is indexed in the background
+        owned = set(shards)
+        rooms = [room for room in self.writer.store.rooms() if ingest_shard(room, INGEST_SHARDS) in owned]
+        self.indexer.start(backfill=rooms)
+        self.broker.start()
+        self._publisher = asyncio.create_task(self._publish())
+        self._shards = list(shards)
+        for shard in shards:
+            await self.broker.subscribe(shard_channel(shard), self.on_ingest)
+
+    async def close(self):
+        # Stop taking new messages first
+        for shard in self._shards:
+            await self.broker.unsubscribe(shard_channel(shard))
+        # Let everything already received be written and published
+        await self._outbox.join()
+        self._publisher.cancel()
+        await self.broker.close()
+        await self.writer.close()
+        await self.indexer.close()
+
+    async def on_ingest(self, data: bytes):
+        try:
+            envelope, _ = decode(data)
+        except EnvelopeError as e:
+            logger.error(f"Dropping malformed ingest message: {e}")
+            return
+        # Not awaited: the group-commit writer batches everything that arrives while a write is in progress
+        self._outbox.put_nowait((envelope, self.writer.submit(envelope.room, envelope)))
+
+    async def _publish(self):
+        while True:
+            envelope, future = await self._outbox.get()
+            try:
+                try:
+                    seq = await future
+                    logger.debug("Message %d saved to history of %s", seq, envelope.room)
+                    self.indexer.add(envelope.room, envelope)
+                except Exception as e:
+                    # Still delivered, but without a seq since it is not in the history
+                    logger.error(f"Error saving message to history of {envelope.room}: {e}")
+                    envelope.seq = 0
+                # Not awaited: submitted in write order, the broker pipelines them in that order
+                self.broker.submit(envelope.room, envelope.encode())
+            finally:
+                self._outbox.task_done()
+
+
+async def main():
+    shards = parse_shards(HISTORY_CONSUMER_SHARDS, INGEST_SHARDS)
+    # Envelopes are binary, so payloads are left as bytes
+    redis_client = redis.from_url(REDIS_URL)
+    store = HistoryStore(
+        CHAT_HISTORY_DIR,
+        segment_bytes=HISTORY_SEGMENT_BYTES,
+        segment_seconds=HISTORY_SEGMENT_SECONDS,
+        codec=HISTORY_CODEC,
+    )
+
+    # Rooms created before cluster mode only exist on disk; index them for the read-only
+    # workers and make them visible to every worker
+    rooms = store.rooms()
+    await asyncio.to_thread(lambda: [store.count(room) for room in rooms])
+    adopted = await RoomDirectory(redis_client).adopt(rooms)
+    if adopted:
+        logger.info(f"Registered {adopted} existing rooms in the shared room directory")
+
+    writer = GroupCommitWriter(store, durability=HISTORY_DURABILITY, fsync_interval=HISTORY_FSYNC_INTERVAL)
+    indexer = SearchIndexer(SearchIndex(CHAT_SEARCH_DIR), store)
+    consumer = HistoryConsumer(redis_client, writer, indexer)
+    await consumer.start(shards)
+    logger.info(f"History consumer owns ingest shards {shards} of {INGEST_SHARDS}")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:  # Windows
+            pass
+    try:
+        await stop.wait()
+    finally:
+        await consumer.close()
+        await redis_client.aclose()
+        logger.info("History consumer stopped")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
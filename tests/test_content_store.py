@@ -0,0 +1,122 @@
+"""Chunked, content-addressed uploads (content_store.py): resuming, deduplication and completeness."""
+import hashlib
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from content_store import ContentStore, file_id_for, is_hash
+
+CHUNK_SIZE = 64
+DATA = bytes(range(256)) * 2 + b"tail"
+
+
+def sha256(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def chunks_of(data: bytes, chunk_size: int = CHUNK_SIZE):
+    return [data[start:start + chunk_size] for start in range(0, len(data), chunk_size)]
+
+
+@pytest.fixture
+def store(tmp_path):
+    return ContentStore(str(tmp_path))
+
+
+def test_upload_resumes_with_the_missing_chunks(store):
+    chunks = chunks_of(DATA)
+    hashes = [sha256(chunk) for chunk in chunks]
+    file_id, missing = store.begin(len(DATA), CHUNK_SIZE, hashes)
+    assert file_id == file_id_for(len(DATA), CHUNK_SIZE, hashes) and is_hash(file_id)
+    assert missing == list(range(len(chunks)))
+    assert not store.is_complete(file_id)
+
+    # Interrupted after every other chunk
+    for i in missing[::2]:
+        assert store.put_chunk(hashes[i], chunks[i])
+    assert store.begin(len(DATA), CHUNK_SIZE, hashes) == (file_id, missing[1::2])
+    assert not store.is_complete(file_id)
+    for i in missing[1::2]:
+        assert store.put_chunk(hashes[i], chunks[i])
+    assert store.begin(len(DATA), CHUNK_SIZE, hashes) == (file_id, [])
+    assert store.is_complete(file_id)
+    assert store.read(file_id) == DATA
+    assert store.manifest(file_id) == {"size": len(DATA), "chunk_size": CHUNK_SIZE, "chunks": hashes}
+
+
+def test_hash_mismatch_is_rejected(store):
+    chunk = DATA[:CHUNK_SIZE]
+    assert not store.put_chunk(sha256(chunk), chunk[:-1] + b"!")
+    assert not store.has_chunk(sha256(chunk))
+    assert store.put_chunk(sha256(chunk), chunk)
+    # Storing it again is a no-op
+    assert store.put_chunk(sha256(chunk), chunk)
+    assert store.has_chunk(sha256(chunk))
+
+
+def test_identical_files_and_chunks_are_stored_once(store, tmp_path):
+    first = store.put_file(DATA, CHUNK_SIZE)
+    assert store.put_file(DATA, CHUNK_SIZE) == first
+    # Repeated content inside a file shares chunks too
+    store.put_file(b"a" * CHUNK_SIZE * 4, CHUNK_SIZE)
+    stored = [name for _, _, names in os.walk(tmp_path / "chunks") for name in names]
+    assert len(stored) == len(set(chunks_of(DATA))) + 1
+
+
+def test_wrong_size_is_not_complete(store):
+    file_id = store.put_file(DATA, CHUNK_SIZE)
+    manifest = store.manifest(file_id)
+    # Chunks that are all stored, registered with a size they do not add up to
+    for size in (len(DATA) - 1, len(DATA) + 1, len(DATA) + CHUNK_SIZE, 0):
+        wrong_id, _ = store.begin(size, CHUNK_SIZE, manifest["chunks"])
+        assert wrong_id != file_id
+        assert not store.is_complete(wrong_id), size
+    # ... or with another chunk size
+    wrong_id, _ = store.begin(len(DATA), CHUNK_SIZE * 2, manifest["chunks"])
+    assert wrong_id != file_id and not store.is_complete(wrong_id)
+    assert store.is_complete(file_id)
+
+
+def test_short_chunk_is_not_complete(store):
+    # A short chunk anywhere but last makes the chunks add up to less than their positions claim
+    full, short = b"f" * CHUNK_SIZE, b"s" * (CHUNK_SIZE - 1)
+    for chunk in (full, short):
+        store.put_chunk(sha256(chunk), chunk)
+    hashes = [sha256(short), sha256(full)]
+    file_id, missing = store.begin(CHUNK_SIZE * 2 - 1, CHUNK_SIZE, hashes)
+    assert missing == []
+    assert not store.is_complete(file_id)
+    # The same chunks the right way round are a complete file
+    file_id, _ = store.begin(CHUNK_SIZE * 2 - 1, CHUNK_SIZE, hashes[::-1])
+    assert store.is_complete(file_id)
+    assert store.read(file_id) == full + short
+
+
+def test_unknown_or_invalid_ids(store):
+    assert store.manifest("0" * 64) is None and not store.is_complete("0" * 64)
+    for file_id in ("../names.log", "x" * 64, "ab", None):
+        assert store.manifest(file_id) is None
+        assert not store.is_complete(file_id)
+
+
+def test_byte_range_segments(store):
+    file_id = store.put_file(DATA, CHUNK_SIZE)
+    for offset, length in [(0, len(DATA)), (10, 100), (CHUNK_SIZE, CHUNK_SIZE), (len(DATA) - 3, 50), (len(DATA), 10), (5, 0)]:
+        data = b""
+        for path, start, count in store.segments(file_id, offset, length):
+            assert count > 0
+            with open(path, "rb") as f:
+                f.seek(start)
+                data += f.read(count)
+        assert data == DATA[offset:offset + length], (offset, length)
+
+
+def test_names_survive_a_restart(store, tmp_path):
+    first = store.put_file(b"one", CHUNK_SIZE)
+    second = store.put_file(b"two", CHUNK_SIZE)
+    store.name("notes.txt", first)
+    store.name("notes.txt", second)
+    store.name("other.txt", first)
+    assert ContentStore(str(tmp_path)).names == {"notes.txt": second, "other.txt": first}
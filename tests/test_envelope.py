@@ -0,0 +1,91 @@
+"""Encoding and decoding of the binary envelope (common/envelope.py)."""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "server")))
+from common.envelope import (
+    EVENT, HEADER, MAGIC, MAX_NAME_BYTES, MESSAGE, PRESENCE, Envelope, EnvelopeError, decode, decode_all, fits_name,
+    is_envelope, peek_seq, record_size,
+)
+
+ENVELOPES = [
+    Envelope(MESSAGE, "room", "hello", "alice", seq=1, timestamp=1_700_000_000_000),
+    Envelope(MESSAGE, "sälle 🏠", "ünïcödé 👋 text", "ßob", seq=2**64 - 1, timestamp=0),
+    Envelope(EVENT, "room", "🟢 alice created the room 'room'"),
+    Envelope(PRESENCE, "room", '{"joined": ["alice"], "count": 1}'),
+    Envelope(MESSAGE, "", "", ""),
+    Envelope(MESSAGE, "r" * MAX_NAME_BYTES, "x" * 100_000, "s" * MAX_NAME_BYTES, seq=7),
+]
+
+
+def fields(envelope: Envelope) -> tuple:
+    return envelope.kind, envelope.room, envelope.seq, envelope.sender, envelope.timestamp, envelope.body
+
+
+@pytest.mark.parametrize("envelope", ENVELOPES, ids=range(len(ENVELOPES)))
+def test_round_trip(envelope):
+    data = envelope.encode()
+    assert is_envelope(data) and data[0] == MAGIC
+    assert record_size(data) == len(data)
+    assert peek_seq(data) == envelope.seq
+    decoded, end = decode(data)
+    assert end == len(data)
+    assert fields(decoded) == fields(envelope)
+    assert decoded.encode() == data
+
+
+def test_back_to_back_records():
+    data = b"".join(envelope.encode() for envelope in ENVELOPES)
+    assert [fields(envelope) for envelope in decode_all(data)] == [fields(envelope) for envelope in ENVELOPES]
+    # Walking the records by their sizes and decoding from an offset agree
+    offset = 0
+    for envelope in ENVELOPES:
+        assert peek_seq(data, offset) == envelope.seq
+        size = record_size(data, offset)
+        decoded, end = decode(data, offset)
+        assert end == offset + size and fields(decoded) == fields(envelope)
+        offset = end
+    assert offset == len(data)
+
+
+def test_truncated_record_is_rejected_at_every_length():
+    data = ENVELOPES[1].encode()
+    for length in range(len(data)):
+        with pytest.raises(EnvelopeError):
+            decode(data[:length])
+        assert record_size(data[:length]) == (len(data) if length >= HEADER.size else None)
+    with pytest.raises(EnvelopeError):
+        decode_all(ENVELOPES[0].encode() + data[:-1])
+
+
+def test_bad_magic_is_rejected():
+    data = bytearray(ENVELOPES[0].encode())
+    data[0] = ord("a")
+    assert not is_envelope(data)
+    for read in (decode, record_size, peek_seq, decode_all):
+        with pytest.raises(EnvelopeError):
+            read(bytes(data))
+    # Plain-text history lines never start with the magic byte
+    assert not is_envelope("0xFE as text".encode("utf-8"))
+
+
+def test_invalid_text_is_rejected():
+    envelope = Envelope(MESSAGE, "room", "ab", "alice")
+    data = envelope.encode()
+    # Cut a UTF-8 sequence in the body
+    broken = data[:-2] + b"\xe2\x82"
+    with pytest.raises(EnvelopeError):
+        decode(broken)
+    # EnvelopeError is a ValueError, so callers catching that see it too
+    assert issubclass(EnvelopeError, ValueError)
+
+
+def test_fits_name():
+    assert fits_name("r" * MAX_NAME_BYTES)
+    assert not fits_name("r" * (MAX_NAME_BYTES + 1))
+    # Measured in UTF-8 bytes, not characters
+    assert fits_name("é" * (MAX_NAME_BYTES // 2))
+    assert not fits_name("é" * (MAX_NAME_BYTES // 2 + 1))
+    assert not fits_name("🏠" * (MAX_NAME_BYTES // 4 + 1))
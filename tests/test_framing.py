@@ -0,0 +1,71 @@
+"""Frames of the raw TCP protocol (framing.py) fed to FrameDecoder whole, split and pipelined."""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from framing import FRAME_PREFIX, FrameDecoder, FrameError, encode_frame, encode_prefix
+
+FRAMES = [
+    ({"command": "login", "username": "alice"}, b""),
+    ({"type": "file", "filename": "ünïcödé.bin", "length": 5}, b"\x00\x01\xfe\xff\n"),
+    ({}, b"x" * 3000),
+    ({"command": "message", "content": "{not json}"}, b""),
+]
+STREAM = b"".join(encode_frame(header, payload) for header, payload in FRAMES)
+
+
+def test_round_trip():
+    for header, payload in FRAMES:
+        assert FrameDecoder().feed(encode_frame(header, payload)) == [(header, payload)]
+
+
+def test_prefix_then_payload_is_one_frame():
+    header, payload = FRAMES[1]
+    assert encode_prefix(header, len(payload)) + payload == encode_frame(header, payload)
+
+
+def test_pipelined_frames_in_one_read():
+    assert FrameDecoder().feed(STREAM) == FRAMES
+
+
+def test_frame_split_at_every_offset():
+    for split in range(len(STREAM) + 1):
+        decoder = FrameDecoder()
+        frames = decoder.feed(STREAM[:split]) + decoder.feed(STREAM[split:])
+        assert frames == FRAMES, split
+
+
+def test_byte_at_a_time():
+    decoder = FrameDecoder()
+    frames = []
+    for i in range(len(STREAM)):
+        frames += decoder.feed(STREAM[i:i + 1])
+    assert frames == FRAMES
+
+
+def test_received_buffers_are_not_kept():
+    # The decoder copies what it holds on to, so a reused receive buffer cannot change a pending frame
+    decoder = FrameDecoder()
+    data = bytearray(STREAM[:10])
+    assert decoder.feed(data) == []
+    data[:] = b"\xff" * 10
+    assert decoder.feed(STREAM[10:]) == FRAMES
+
+
+def test_oversized_frame_is_rejected_before_its_body_arrives():
+    decoder = FrameDecoder(max_header_size=100, max_payload_size=1000)
+    with pytest.raises(FrameError):
+        decoder.feed(FRAME_PREFIX.pack(101, 0))
+    with pytest.raises(FrameError):
+        FrameDecoder(max_header_size=100, max_payload_size=1000).feed(FRAME_PREFIX.pack(2, 1001))
+    assert FrameDecoder(max_header_size=100, max_payload_size=1000).feed(encode_frame({}, b"x" * 1000)) == [({}, b"x" * 1000)]
+
+
+@pytest.mark.parametrize("body", [b"{not json", b"[1, 2]", b"\"text\"", b"\xff\xfe"])
+def test_invalid_header_is_rejected(body):
+    with pytest.raises(FrameError):
+        FrameDecoder().feed(FRAME_PREFIX.pack(len(body), 0) + body)
+    # FrameError is a ValueError, so callers catching that see it too
+    assert issubclass(FrameError, ValueError)
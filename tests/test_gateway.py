@@ -0,0 +1,116 @@
+"""WebSocket sessions served by the Gateway, with an in-process broker and no Redis."""
+import os
+import sys
+
+import pytest
+from fastapi import FastAPI, WebSocket
+from fastapi.testclient import TestClient
+from starlette.websockets import WebSocketDisconnect
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "server")))
+from common.broker import create_broker
+from common.envelope import EVENT, Envelope, decode_all
+from common.gateway import CLOSE_POLICY_VIOLATION, Gateway
+from common.history_store import HistoryStore
+from common.presence import PresenceTracker
+from common.ratelimit import RateLimiter
+from common.recent_cache import RecentMessageCache
+from common.tokens import TokenSigner, TokenVerifier
+
+KEYS = {"k1": b"secret"}
+
+
+def make_client(tmp_path, verifier=None, rate_limiter=None):
+    """A test client of an app serving /ws/{room} through a Gateway, and the messages it was sent."""
+    submitted = []
+
+    async def submit(room: str, envelope: Envelope):
+        submitted.append(envelope)
+
+    async def publish(room: str, message: bytes):
+        pass
+
+    gateway = Gateway(
+        create_broker("inprocess"),
+        HistoryStore(str(tmp_path)),
+        submit,
+        RecentMessageCache(),
+        PresenceTracker(publish),
+        rate_limiter or RateLimiter(connection_rate=100, connection_burst=100, room_rate=100, room_burst=100, max_message_bytes=1024),
+        verifier=verifier,
+    )
+    app = FastAPI()
+
+    @app.websocket("/ws/{room}")
+    async def websocket_endpoint(websocket: WebSocket, room: str, username: str = None, token: str = None):
+        await gateway.serve(websocket, room, username=username, token=token)
+
+    return TestClient(app), submitted
+
+
+@pytest.fixture
+def auth_client(tmp_path):
+    return make_client(tmp_path, TokenVerifier(KEYS))
+
+
+def test_valid_token_names_the_sender(auth_client):
+    client, submitted = auth_client
+    token, _ = TokenSigner(KEYS).issue("alice")
+    # The username in the query string is ignored once the gateway checks tokens
+    with client.websocket_connect(f"/ws/room?username=mallory&token={token}") as websocket:
+        websocket.send_json({"message": "hi"})
+    assert [(envelope.sender, envelope.body) for envelope in submitted] == [("alice", "hi")]
+
+
+@pytest.mark.parametrize("headers", [
+    {},
+    {"Authorization": "Bearer not-a-token"},
+    {"Authorization": "Basic " + TokenSigner(KEYS).issue("alice")[0]},
+    {"Authorization": "Bearer " + TokenSigner({"k1": b"other secret"}).issue("alice")[0]},
+    {"Authorization": "Bearer " + TokenSigner(KEYS, ttl=-3600).issue("alice")[0]},
+])
+def test_bad_bearer_token_is_refused(auth_client, headers):
+    client, submitted = auth_client
+    with pytest.raises(WebSocketDisconnect) as refused:
+        with client.websocket_connect("/ws/room?username=alice", headers=headers):
+            pass
+    assert refused.value.code == CLOSE_POLICY_VIOLATION
+    assert not submitted
+
+
+def test_bearer_header_is_accepted(auth_client):
+    client, submitted = auth_client
+    token, _ = TokenSigner(KEYS).issue("alice")
+    with client.websocket_connect("/ws/room", headers={"Authorization": f"Bearer {token}"}) as websocket:
+        websocket.send_json({"message": "hi"})
+    assert [envelope.sender for envelope in submitted] == ["alice"]
+
+
+@pytest.mark.parametrize("frame", ["not json", "", "[1, 2]", '{"message": 5}', b"\xff\xfe", b""])
+def test_malformed_message_gets_a_notice_and_keeps_the_connection(tmp_path, frame):
+    client, submitted = make_client(tmp_path)
+    with client.websocket_connect("/ws/room?username=alice") as websocket:
+        if isinstance(frame, bytes):
+            websocket.send_bytes(frame)
+        else:
+            websocket.send_text(frame)
+        [notice] = decode_all(websocket.receive_bytes())
+        assert notice.kind == EVENT and "Invalid message format" in notice.body
+        websocket.send_json({"message": "still here"})
+    assert [envelope.body for envelope in submitted] == ["still here"]
+
+
+def test_reconnecting_does_not_reset_the_room_allowance(tmp_path):
+    # Two messages, then next to nothing
+    rate_limiter = RateLimiter(connection_rate=0, connection_burst=0, room_rate=0.001, room_burst=2, max_message_bytes=1024)
+    client, submitted = make_client(tmp_path, rate_limiter=rate_limiter)
+    with client.websocket_connect("/ws/room?username=alice") as websocket:
+        for body in ("one", "two", "three"):
+            websocket.send_json({"message": body})
+        [notice] = decode_all(websocket.receive_bytes())
+        assert "Too many messages" in notice.body
+    # The room's last connection has gone; a new one gets no fresh burst
+    with client.websocket_connect("/ws/room?username=alice") as websocket:
+        websocket.send_json({"message": "four"})
+    assert [envelope.body for envelope in submitted] == ["one", "two"]
+    assert rate_limiter.stats.room_limited == 2
@@ -0,0 +1,180 @@
+"""Round trips through HistoryStore: appends across seals, compression, reopening and legacy files."""
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "server")))
+from common import history_store
+from common.envelope import MESSAGE, Envelope
+from common.history_store import CODECS, HistoryStore
+
+ROOM = "room"
+# Small segments and blocks, so a few hundred messages span several of each
+SEGMENT_BYTES = 4096
+BLOCK_BYTES = 512
+
+
+@pytest.fixture(autouse=True)
+def small_blocks(monkeypatch):
+    monkeypatch.setattr(history_store, "BLOCK_BYTES", BLOCK_BYTES)
+
+
+@pytest.fixture(params=sorted(CODECS))
+def codec(request):
+    return request.param
+
+
+def message(i: int) -> Envelope:
+    return Envelope(MESSAGE, ROOM, f"message {i} " + "x" * (i % 50), "alice")
+
+
+def fill(store: HistoryStore, count: int, start: int = 1, batch: int = 7):
+    for first in range(start, start + count, batch):
+        store.append_many(ROOM, [message(i) for i in range(first, min(first + batch, start + count))])
+
+
+def wait_compressed(store: HistoryStore, room: str = ROOM):
+    """Wait for the background compressor to finish with every sealed segment."""
+    deadline = time.monotonic() + 10
+    while any(segment.codec is None for segment in store.segments(room)[:-1]):
+        assert time.monotonic() < deadline, "sealed segments were not compressed"
+        time.sleep(0.01)
+
+
+def check_messages(page, first: int, stop: int):
+    assert [envelope.seq for envelope in page] == list(range(first, stop))
+    assert [envelope.body for envelope in page] == [message(i).body for i in range(first, stop)]
+
+
+def check_reads(store: HistoryStore, count: int):
+    check_messages(store.read_range(ROOM, 1, count + 1), 1, count + 1)
+    check_messages(store.read_page(ROOM), count - 49, count + 1)
+    check_messages(store.read_page(ROOM, before=250, limit=20), 230, 250)
+    check_messages(store.read_page(ROOM, before=3, limit=20), 1, 3)
+    assert store.read_page(ROOM, before=1) == []
+    check_messages(store.read_after(ROOM, 100, limit=30), 101, 131)
+    assert store.read_after(ROOM, count) == []
+    check_messages(store.read_tail(ROOM, after=count - 20, limit=50), count - 19, count + 1)
+    check_messages(store.read_tail(ROOM, after=0, limit=5), count - 4, count + 1)
+    # Every range boundary, wherever the segments and blocks start
+    for first in range(1, count + 1, 37):
+        check_messages(store.read_range(ROOM, first, first + 45), first, min(first + 45, count + 1))
+
+
+def test_append_across_seals_and_read_back(tmp_path, codec):
+    store = HistoryStore(str(tmp_path), segment_bytes=SEGMENT_BYTES, codec=codec)
+    fill(store, 500)
+    assert store.count(ROOM) == 500
+    segments = store.segments(ROOM)
+    assert len(segments) > 3
+    # Sealed segments cover consecutive ranges, the active one starts right after them
+    for previous, segment in zip(segments, segments[1:]):
+        assert segment.first == previous.last + 1
+    check_reads(store, 500)
+
+    wait_compressed(store)
+    assert all(segment.codec == codec for segment in store.segments(ROOM)[:-1])
+    # Only the compressed copies of sealed segments are left
+    assert not os.path.exists(store.data_path(ROOM))
+    for segment in store.segments(ROOM)[:-1]:
+        assert not os.path.exists(os.path.join(str(tmp_path), *segment.path.split("/")) + ".txt")
+    check_reads(store, 500)
+    store.close()
+
+
+def test_reopen_and_keep_appending(tmp_path, codec):
+    store = HistoryStore(str(tmp_path), segment_bytes=SEGMENT_BYTES, codec=codec)
+    fill(store, 300)
+    wait_compressed(store)
+    store.close()
+
+    reopened = HistoryStore(str(tmp_path), segment_bytes=SEGMENT_BYTES, codec=codec)
+    assert reopened.rooms() == [ROOM]
+    assert reopened.count(ROOM) == 300
+    fill(reopened, 200, start=301)
+    assert reopened.count(ROOM) == 500
+    check_reads(reopened, 500)
+    wait_compressed(reopened)
+    reopened.close()
+
+    reader = HistoryStore(str(tmp_path), read_only=True)
+    assert reader.count(ROOM) == 500
+    check_reads(reader, 500)
+
+
+def test_segments_sealed_before_a_restart_are_compressed_on_reopen(tmp_path, monkeypatch):
+    store = HistoryStore(str(tmp_path), segment_bytes=SEGMENT_BYTES, codec="gzip")
+    # Crash before compressing: nothing is handed to the compressor
+    monkeypatch.setattr(store, "_compress_later", lambda room, segment: None)
+    fill(store, 300)
+    assert all(segment.codec is None for segment in store.segments(ROOM))
+    store.close()
+
+    reopened = HistoryStore(str(tmp_path), segment_bytes=SEGMENT_BYTES, codec="gzip")
+    assert reopened.count(ROOM) == 300
+    wait_compressed(reopened)
+    check_messages(reopened.read_range(ROOM, 1, 301), 1, 301)
+    reopened.close()
+
+
+def test_read_retries_when_a_segment_is_compressed_under_it(tmp_path, monkeypatch):
+    writer = HistoryStore(str(tmp_path), segment_bytes=SEGMENT_BYTES, codec="gzip")
+    sealed = []
+    monkeypatch.setattr(writer, "_compress_later", lambda room, segment: sealed.append(segment.first))
+    fill(writer, 300)
+
+    reader = HistoryStore(str(tmp_path), read_only=True)
+    check_messages(reader.read_range(ROOM, 1, 301), 1, 301)
+    # The reader holds the manifest listing the raw files, which compression then removes
+    stale = reader.segments(ROOM)
+    for first in sealed:
+        writer._compress(ROOM, first)
+    layouts = iter([stale])
+    fresh = reader.segments
+    monkeypatch.setattr(reader, "segments", lambda room: next(layouts, None) or fresh(room))
+    check_messages(reader.read_range(ROOM, 1, 301), 1, 301)
+    writer.close()
+
+
+def test_legacy_flat_file_is_sealed_and_read_back(tmp_path, codec):
+    # A room written before envelopes and the index existed: lines of text, no .idx
+    lines = [f"bob: legacy line {i}" for i in range(1, 201)]
+    with open(os.path.join(tmp_path, f"{ROOM}.txt"), "w") as f:
+        f.write("".join(line + "\n" for line in lines))
+
+    store = HistoryStore(str(tmp_path), segment_bytes=SEGMENT_BYTES, codec=codec)
+    assert store.count(ROOM) == 200
+    assert [envelope.text for envelope in store.read_page(ROOM, limit=10)] == lines[-10:]
+
+    # The flat file is over the segment size, so the first append seals it
+    store.append_many(ROOM, [message(i) for i in range(201, 211)])
+    segments = store.segments(ROOM)
+    assert (segments[0].first, segments[0].last, segments[0].path) == (1, 210, ROOM)
+    fill(store, 100, start=211)
+    wait_compressed(store)
+    store.close()
+
+    for reader in (HistoryStore(str(tmp_path), codec=codec), HistoryStore(str(tmp_path), read_only=True)):
+        assert reader.count(ROOM) == 310
+        page = reader.read_range(ROOM, 1, 311)
+        assert [envelope.seq for envelope in page] == list(range(1, 311))
+        assert [envelope.text for envelope in page[:200]] == lines
+        assert [envelope.body for envelope in page[200:]] == [message(i).body for i in range(201, 311)]
+        check_messages(reader.read_after(ROOM, 195, limit=10)[5:], 201, 206)
+
+
+def test_torn_write_is_dropped_on_reopen(tmp_path):
+    store = HistoryStore(str(tmp_path), segment_bytes=0, codec="gzip")
+    fill(store, 20)
+    store.close()
+    # An append interrupted halfway through its record
+    with open(store.data_path(ROOM), "ab") as f:
+        f.write(message(21).encode()[:10])
+
+    reopened = HistoryStore(str(tmp_path), segment_bytes=0, codec="gzip")
+    assert reopened.count(ROOM) == 20
+    assert reopened.append(ROOM, message(21)) == 21
+    check_messages(reopened.read_range(ROOM, 1, 22), 1, 22)
+    reopened.close()
@@ -0,0 +1,96 @@
+"""Byte-range downloads over old_server.py's transfer connections, including empty ranges."""
+import asyncio
+import importlib
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from framing import FrameDecoder, encode_frame
+
+
+@pytest.fixture(scope="module")
+def old_server(tmp_path_factory):
+    # The server keeps its uploads and history relative to the working directory
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp("old_server"))
+    try:
+        yield importlib.import_module("old_server")
+    finally:
+        os.chdir(cwd)
+
+
+async def download(server, *commands):
+    """Log in as a transfer connection, send the download commands one after the other on it
+    and return the file frame answering each."""
+    listener = await asyncio.start_server(server.handle_client, "127.0.0.1", 0)
+    port = listener.sockets[0].getsockname()[1]
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    decoder = FrameDecoder()
+    frames = []
+
+    async def until(kind):
+        while True:
+            for i, (header, payload) in enumerate(frames):
+                if header.get("type") == kind:
+                    del frames[:i + 1]
+                    return header, payload
+            data = await asyncio.wait_for(reader.read(65536), 5)
+            assert data, "connection closed"
+            frames.extend(decoder.feed(data))
+
+    try:
+        writer.write(encode_frame({"command": "login", "username": "t", "transfer": True}))
+        await until("ready")
+        replies = []
+        for command in commands:
+            writer.write(encode_frame({"command": "download", **command}))
+            replies.append(await until("file"))
+        return replies
+    finally:
+        writer.close()
+        listener.close()
+
+
+@pytest.fixture(scope="module")
+def data_file(old_server):
+    with open(os.path.join(old_server.UPLOAD_DIR, "data.bin"), "wb") as f:
+        f.write(b"0123456789")
+    return "data.bin"
+
+
+# Every empty range is followed by a non-empty one on the same connection, which must still be open
+
+def test_empty_legacy_file(old_server, data_file):
+    open(os.path.join(old_server.UPLOAD_DIR, "empty.txt"), "wb").close()
+    (header, payload), (_, after) = asyncio.run(
+        download(old_server, {"filename": "empty.txt"}, {"filename": data_file})
+    )
+    assert (header["filesize"], header["length"], payload) == (0, 0, b"")
+    assert after == b"0123456789"
+
+
+def test_range_at_end_of_legacy_file(old_server, data_file):
+    (header, payload), (_, after) = asyncio.run(
+        download(old_server, {"filename": data_file, "offset": 10}, {"filename": data_file, "offset": 4, "length": 3})
+    )
+    assert (header["offset"], header["length"], payload) == (10, 0, b"")
+    assert after == b"456"
+
+
+def test_range_at_end_of_stored_file(old_server):
+    file_id = old_server.store.put_file(b"x" * 1000, 256)
+    (header, payload), (_, after) = asyncio.run(
+        download(old_server, {"object": file_id, "offset": 1000}, {"object": file_id, "offset": 250, "length": 20})
+    )
+    assert (header["length"], payload) == (0, b"")
+    assert after == b"x" * 20
+
+
+def test_negative_length_is_an_empty_range(old_server, data_file):
+    (header, payload), (_, after) = asyncio.run(
+        download(old_server, {"filename": data_file, "offset": 2, "length": -5}, {"filename": data_file})
+    )
+    assert (header["length"], payload) == (0, b"")
+    assert after == b"0123456789"
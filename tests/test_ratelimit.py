@@ -0,0 +1,95 @@
+"""Room buckets of the RateLimiter across their rooms emptying and filling again."""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "server")))
+from common import ratelimit
+from common.ratelimit import ROOM_LIMITED, TOO_LARGE, RateLimiter
+
+# Room allowance: bursts of 10, refilled at 2 messages per second, so an empty bucket refills in 5 s
+ROOM_RATE = 2
+ROOM_BURST = 10
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(ratelimit, "time", clock)
+    return clock
+
+
+@pytest.fixture
+def limiter(clock):
+    return RateLimiter(connection_rate=0, connection_burst=0, room_rate=ROOM_RATE, room_burst=ROOM_BURST, max_message_bytes=100)
+
+
+def send(limiter: RateLimiter, count: int, room: str = "room") -> list:
+    return [limiter.check(room, None, 10) for _ in range(count)]
+
+
+def test_room_burst_then_rate(limiter, clock):
+    assert send(limiter, ROOM_BURST) == [None] * ROOM_BURST
+    assert send(limiter, 1) == [ROOM_LIMITED]
+    clock.now += 1
+    assert send(limiter, ROOM_RATE + 1) == [None] * ROOM_RATE + [ROOM_LIMITED]
+    assert limiter.check("room", None, 101) == TOO_LARGE
+
+
+def test_reconnecting_does_not_refill_the_room(limiter, clock):
+    assert send(limiter, ROOM_BURST) == [None] * ROOM_BURST
+    # The last connection leaves and another one joins straight away
+    limiter.forget("room")
+    assert send(limiter, 1) == [ROOM_LIMITED]
+    clock.now += 1
+    limiter.forget("room")
+    assert send(limiter, ROOM_RATE + 1) == [None] * ROOM_RATE + [ROOM_LIMITED]
+
+
+def test_refilled_buckets_are_dropped(limiter, clock):
+    # A room whose bucket is full is no different from one never seen
+    send(limiter, 1)
+    clock.now += 1 / ROOM_RATE
+    limiter.forget("room")
+    assert "room" not in limiter._rooms
+
+    send(limiter, ROOM_BURST, "drained")
+    send(limiter, 3, "quiet")
+    limiter.forget("drained")
+    limiter.forget("quiet")
+    assert set(limiter._rooms) == {"drained", "quiet"}
+    # Both have refilled after burst / rate seconds, and go with the next room to empty
+    clock.now += ROOM_BURST / ROOM_RATE
+    limiter.forget("other")
+    assert limiter._rooms == {} and not limiter._idle
+
+
+def test_room_used_again_keeps_its_bucket(limiter, clock):
+    send(limiter, ROOM_BURST)
+    limiter.forget("room")
+    # Back in use: draining it again long after it emptied
+    clock.now += ROOM_BURST / ROOM_RATE
+    assert send(limiter, ROOM_BURST + 1) == [None] * ROOM_BURST + [ROOM_LIMITED]
+    limiter.forget("other")
+    assert send(limiter, 1) == [ROOM_LIMITED]
+    # Emptied again, it is only dropped once refilled
+    limiter.forget("room")
+    clock.now += ROOM_BURST / ROOM_RATE - 1
+    limiter.forget("other")
+    assert send(limiter, ROOM_BURST - ROOM_RATE + 1) == [None] * (ROOM_BURST - ROOM_RATE) + [ROOM_LIMITED]
+
+
+def test_unlimited_rooms_keep_no_buckets(clock):
+    limiter = RateLimiter(connection_rate=0, connection_burst=0, room_rate=0, room_burst=0, max_message_bytes=100)
+    assert send(limiter, 100) == [None] * 100
+    limiter.forget("room")
+    assert limiter._rooms == {} and not limiter._idle
@@ -0,0 +1,125 @@
+"""Connection churn in the registry, checked against a plain reference model.
+
+Run from the repository root with ``python -m pytest tests``.
+"""
+import os
+import random
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "server")))
+from common.registry import ConnectionRegistry
+
+CONNECTIONS = 100_000
+
+
+def check(registry: ConnectionRegistry, live: dict):
+    """Compare the registry with the reference model {websocket: (room, username)}."""
+    assert len(registry) == len(live)
+    rooms = {}
+    users = {}
+    for room, username in live.values():
+        rooms[room] = rooms.get(room, 0) + 1
+        users[username] = users.get(username, 0) + 1
+    assert set(registry.rooms) == set(rooms)
+    for name, count in rooms.items():
+        assert len(registry.room(name)) == count, name
+    for username, count in users.items():
+        assert len(registry.connections_of(username)) == count, username
+
+
+def test_single_room_is_removed_by_its_last_leave():
+    registry = ConnectionRegistry()
+    websockets = [object() for _ in range(CONNECTIONS)]
+    connections = {ws: registry.connect("big", ws, f"user{i}")[0] for i, ws in enumerate(websockets)}
+    assert len(registry.room("big").live) == CONNECTIONS
+
+    order = websockets[:]
+    random.Random(1).shuffle(order)
+    emptied = [registry.disconnect(connections[ws]) for ws in order]
+    assert emptied.count(True) == 1 and emptied[-1]
+    check(registry, {})
+
+
+@pytest.mark.parametrize("room_size", [1, 100, 10_000])
+def test_churn_matches_reference_model(room_size):
+    rng = random.Random(room_size)
+    room_count = max(1, CONNECTIONS // room_size)
+    # Half as many users as connections, so that some users hold several connections
+    users = CONNECTIONS // 2
+    registry = ConnectionRegistry()
+    live = {}
+    connections = {}
+    # Connections per room in the model, to check when rooms come and go
+    sizes = {}
+
+    def join():
+        ws = object()
+        room, username = f"room{rng.randrange(room_count)}", f"user{rng.randrange(users)}"
+        connection, created = registry.connect(room, ws, username)
+        assert created == (room not in sizes)
+        sizes[room] = sizes.get(room, 0) + 1
+        connections[ws] = connection
+        live[ws] = (room, username)
+        return ws
+
+    sockets = [join() for _ in range(CONNECTIONS)]
+    check(registry, live)
+
+    for _ in range(2 * CONNECTIONS):
+        if rng.random() < 0.5 and sockets:
+            # Swap-remove a random socket
+            i = rng.randrange(len(sockets))
+            sockets[i], sockets[-1] = sockets[-1], sockets[i]
+            ws = sockets.pop()
+            room, _ = live.pop(ws)
+            sizes[room] -= 1
+            assert registry.disconnect(connections.pop(ws)) == (sizes[room] == 0)
+            if not sizes[room]:
+                del sizes[room]
+        else:
+            sockets.append(join())
+    check(registry, live)
+
+    for ws in sockets:
+        registry.disconnect(connections.pop(ws))
+        del live[ws]
+    check(registry, live)
+    assert not registry.rooms
+
+
+def test_disconnecting_twice_changes_nothing():
+    registry = ConnectionRegistry()
+    first, _ = registry.connect("room", object(), "alice")
+    registry.connect("room", object(), "alice")
+    assert not registry.disconnect(first)
+    assert not registry.disconnect(first)
+    assert len(registry) == 1
+    assert len(registry.connections_of("alice")) == 1
+
+
+def test_pending_connection_goes_live():
+    registry = ConnectionRegistry()
+    ws = object()
+    connection, created = registry.connect("room", ws, "alice", live=False)
+    assert created and not connection.live and connection.held is not None
+    assert list(registry.room("room").live) == []
+
+    registry.go_live(connection)
+    assert connection.live and connection.held is None
+    assert list(registry.room("room").live) == [ws]
+    assert registry.disconnect(connection)
+    assert not registry.rooms
+
+
+def test_connections_of_spans_rooms():
+    registry = ConnectionRegistry()
+    a, _ = registry.connect("one", object(), "alice")
+    b, _ = registry.connect("two", object(), "alice", live=False)
+    registry.connect("two", object(), "bob")
+    registry.connect("two", object())
+    assert registry.connections_of("alice") == [a, b]
+    assert registry.connections_of("carol") == []
+    registry.disconnect(a)
+    assert registry.connections_of("alice") == [b]
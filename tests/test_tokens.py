@@ -0,0 +1,132 @@
+"""Signed tokens and password hashes (common/tokens.py), and the auth service issuing them."""
+import importlib
+import os
+import sys
+
+import pytest
+from fastapi.testclient import TestClient
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "server")))
+from common.tokens import (
+    BAD_SIGNATURE, EXPIRED, MALFORMED, UNKNOWN_KEY, TokenError, TokenSigner, TokenVerifier, check_password,
+    hash_password, parse_keys, parse_users,
+)
+
+KEYS = {"k1": b"secret", "k0": b"old secret"}
+NOW = 1_700_000_000
+# Cheap hashes keep the tests fast; a hash records its own iteration count
+ITERATIONS = 1000
+
+
+def rejection(verifier: TokenVerifier, token, now=NOW) -> str:
+    with pytest.raises(TokenError) as e:
+        verifier.verify(token, now=now)
+    return e.value.reason
+
+
+def test_round_trip_and_key_rotation():
+    verifier = TokenVerifier(KEYS)
+    token, expires = TokenSigner(KEYS, ttl=60).issue("alice", now=NOW)
+    assert expires == NOW + 60
+    assert verifier.verify(token, now=NOW) == "alice"
+    # Tokens signed with a key listed after the first are still accepted
+    old, _ = TokenSigner({"k0": b"old secret"}).issue("bob:with:colons", now=NOW)
+    assert verifier.verify(old, now=NOW) == "bob:with:colons"
+    assert verifier.stats.verified == 2
+
+
+def test_tampered_token_is_rejected():
+    verifier = TokenVerifier(KEYS)
+    token, _ = TokenSigner(KEYS).issue("alice", now=NOW)
+    payload, signature = token.split(".")
+    forged, _ = TokenSigner(KEYS).issue("mallory", now=NOW)
+
+    # Another user's payload under alice's signature
+    assert rejection(verifier, f"{forged.split('.')[0]}.{signature}") == BAD_SIGNATURE
+    # A flipped signature character
+    flipped = signature[:-1] + ("A" if signature[-1] != "A" else "B")
+    assert rejection(verifier, f"{payload}.{flipped}") == BAD_SIGNATURE
+    # Signed with a key of the same id but another secret
+    other, _ = TokenSigner({"k1": b"guessed"}).issue("alice", now=NOW)
+    assert rejection(verifier, other) == BAD_SIGNATURE
+    unknown, _ = TokenSigner({"k9": b"secret"}).issue("alice", now=NOW)
+    assert rejection(verifier, unknown) == UNKNOWN_KEY
+    assert verifier.stats.bad_signature == 3 and verifier.stats.unknown_key == 1
+
+
+@pytest.mark.parametrize("token", [None, "", "no-dot", "é.é", "!!!.sig", "YWxpY2U.sig"])
+def test_malformed_token_is_rejected(token):
+    assert rejection(TokenVerifier(KEYS), token) == MALFORMED
+
+
+def test_expired_token_is_rejected():
+    verifier = TokenVerifier(KEYS, leeway=30)
+    token, expires = TokenSigner(KEYS, ttl=60).issue("alice", now=NOW)
+    # Accepted up to the leeway past its expiry, for clock skew between the services
+    assert verifier.verify(token, now=expires + 30) == "alice"
+    assert rejection(verifier, token, now=expires + 31) == EXPIRED
+    assert verifier.stats.expired == 1
+
+
+def test_password_hashes():
+    password_hash = hash_password("correct horse", iterations=ITERATIONS)
+    assert check_password("correct horse", password_hash)
+    assert not check_password("Correct horse", password_hash)
+    assert not check_password("", password_hash)
+    # Salted: the same password hashes differently every time
+    assert hash_password("correct horse", iterations=ITERATIONS) != password_hash
+    for broken in ["", "plain", "md5$1000$c2FsdA$ZGlnZXN0", "pbkdf2_sha256$x$c2FsdA$ZGlnZXN0", "pbkdf2_sha256$1000$!!$ZGlnZXN0"]:
+        assert not check_password("correct horse", broken)
+
+
+def test_parse_keys_and_users():
+    assert list(parse_keys(" k2:new , k1:old:with:colons,")) == ["k2", "k1"]
+    assert parse_keys("k1:old:with:colons")["k1"] == b"old:with:colons"
+    assert parse_keys("") == {}
+    with pytest.raises(ValueError):
+        parse_keys("k1")
+    password_hash = hash_password("pw", iterations=ITERATIONS)
+    assert parse_users(f"alice:{password_hash}, bob:{password_hash}") == {"alice": password_hash, "bob": password_hash}
+    with pytest.raises(ValueError):
+        parse_users("alice:pw")
+
+
+@pytest.fixture
+def auth_service(monkeypatch):
+    """The auth service app, with alice as its only user and open signup off."""
+    monkeypatch.setenv("AUTH_KEYS", "k1:secret")
+    monkeypatch.syspath_prepend(os.path.join(os.path.dirname(__file__), "..", "server", "auth_service"))
+    module = importlib.import_module("auth_service")
+    monkeypatch.setattr(module, "AUTH_USERS", {"alice": hash_password("correct horse", iterations=ITERATIONS)})
+    monkeypatch.setattr(module, "AUTH_OPEN_SIGNUP", False)
+    return module
+
+
+def request_token(module, **body):
+    return TestClient(module.app).post("/token", json=body)
+
+
+def test_token_issued_for_the_right_password(auth_service):
+    response = request_token(auth_service, username="alice", password="correct horse")
+    assert response.status_code == 200
+    body = response.json()
+    assert body["username"] == "alice" and body["token_type"] == "bearer"
+    assert TokenVerifier({"k1": b"secret"}).verify(body["token"]) == "alice"
+
+
+@pytest.mark.parametrize("password", ["wrong", "", None])
+def test_wrong_password_is_refused(auth_service, password):
+    response = request_token(auth_service, username="alice", password=password)
+    assert response.status_code == 401
+    assert "token" not in response.json()
+
+
+def test_signup_refused_unless_open(auth_service, monkeypatch):
+    assert request_token(auth_service, username="newcomer").status_code == 401
+
+    monkeypatch.setattr(auth_service, "AUTH_OPEN_SIGNUP", True)
+    response = request_token(auth_service, username="newcomer")
+    assert response.status_code == 200
+    assert TokenVerifier({"k1": b"secret"}).verify(response.json()["token"]) == "newcomer"
+    # Listed users still need their password with open signup
+    assert request_token(auth_service, username="alice").status_code == 401
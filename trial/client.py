@@ -1,7 +1,13 @@
 import asyncio
-import json
+import os
+import sys
+
 import websockets
 
+# Make the shared `common` package (server/common) importable when run from this directory
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "server")))
+from common.envelope import decode_all
+
 
 async def send_messages(websocket):
     """Reads user input and sends messages to the server."""
@@ -16,11 +22,9 @@ async def receive_messages(websocket):
     while True:
         message = await websocket.recv()
         try:
-            # Attempt to parse the JSON message from the server.
-            data = json.loads(message)
-            sender = data.get("sender", "Unknown")
-            text = data.get("message", "")
-            print(f"{sender}: {text}")
+            # Each binary frame carries one or more envelopes back to back.
+            for envelope in decode_all(message):
+                print(envelope.text)
         except Exception as e:
             print(f"An error occurred: {e} \nresponse from server: {message}")
 
@@ -1,20 +1,59 @@
-import asyncio
-import json
-from typing import Dict, List, Optional
+import os
+import sys
+from collections import defaultdict
+from typing import Dict, Optional, Tuple
 from contextlib import asynccontextmanager
 
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
 import redis.asyncio as redis
 
+# Make the shared `common` package (server/common) importable when run from this directory
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "server")))
+from common.broker import PUBLISH_BATCH, Broker, create_broker
+from common.envelope import EVENT, MESSAGE, Envelope
+from common.fanout import FanOut
+from common.presence import PresenceTracker
+from common.ratelimit import CLOSE_TOO_BIG, TOO_LARGE, RateLimiter, message_size
+from common.serializer import JSONResponse
+from common.registry import Connection, ConnectionRegistry
+
+
+REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost")
+# Message bus between server instances (see common/broker.py). With "inprocess" a single instance
+# runs without Redis: sequence numbers and the presence roster are then kept in memory.
+CHAT_BROKER = os.environ.get("CHAT_BROKER", "batching")
+# The batching broker pipelines up to BROKER_MAX_BATCH publishes, adding at most BROKER_LINGER_MS to each
+BROKER_MAX_BATCH = int(os.environ.get("BROKER_MAX_BATCH", str(PUBLISH_BATCH)))
+BROKER_LINGER_MS = float(os.environ.get("BROKER_LINGER_MS", "1"))
+# Per-room message counters: "chat:seq:<room>" holds the last sequence number handed out
+SEQ_KEY_PREFIX = "chat:seq:"
+# Joins and leaves are announced in one digest per room every PRESENCE_INTERVAL seconds
+PRESENCE_INTERVAL = float(os.environ.get("PRESENCE_INTERVAL", "1.0"))
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    app.state.redis_client = redis.from_url("redis://localhost", decode_responses=True)
+    # Messages travel as binary envelopes, so payloads are left as bytes
+    redis_client = redis.from_url(REDIS_URL) if CHAT_BROKER != "inprocess" else None
+    app.state.redis_client = redis_client
+    app.state.broker = create_broker(CHAT_BROKER, redis_client, max_batch=BROKER_MAX_BATCH, linger=BROKER_LINGER_MS / 1000)
+    app.state.broker.start()
+    # The roster is shared through Redis by every server instance
+    app.state.presence = PresenceTracker(
+        app.state.broker.publish,
+        interval=PRESENCE_INTERVAL,
+        redis_client=redis_client,
+    )
+    app.state.presence.start()
     yield
-    await app.state.redis_client.close()
+    await app.state.presence.close()
+    await app.state.broker.close()
+    if redis_client is not None:
+        await redis_client.close()
 
-app = FastAPI(lifespan=lifespan)
+# Responses are rendered with the fastest JSON library installed (see common/serializer.py)
+app = FastAPI(lifespan=lifespan, default_response_class=JSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -24,93 +63,137 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-room_listeners: Dict[str, asyncio.Task] = {}
+# Per-client outgoing queue size and what to do when a client falls that far behind
+FANOUT_QUEUE_SIZE = int(os.environ.get("FANOUT_QUEUE_SIZE", "256"))
+FANOUT_OVERFLOW_POLICY = os.environ.get("FANOUT_OVERFLOW_POLICY", "drop_oldest")
+
+# Messages are checked before anything else is done with them: at most MAX_MESSAGE_BYTES each, and
+# token buckets of <rate> messages/s with bursts of <burst> per connection and per room (0 = unlimited)
+rate_limiter = RateLimiter(
+    connection_rate=float(os.environ.get("CONNECTION_MESSAGE_RATE", "5")),
+    connection_burst=float(os.environ.get("CONNECTION_MESSAGE_BURST", "20")),
+    room_rate=float(os.environ.get("ROOM_MESSAGE_RATE", "200")),
+    room_burst=float(os.environ.get("ROOM_MESSAGE_BURST", "400")),
+    max_message_bytes=int(os.environ.get("MAX_MESSAGE_BYTES", str(16 * 1024))),
+)
 
 
 class ConnectionManager:
     def __init__(self):
-        self.rooms: Dict[str, List[WebSocket]] = {}
+        self.registry = ConnectionRegistry()
+        self.fanout = FanOut(max_queue=FANOUT_QUEUE_SIZE, policy=FANOUT_OVERFLOW_POLICY)
 
-    async def connect(self, room_name: str, websocket: WebSocket):
+    async def connect(self, room_name: str, websocket: WebSocket, client_name: str) -> Tuple[Connection, bool]:
+        """Accept a client. Returns its connection and whether it is the room's first on this instance."""
         await websocket.accept()
-        if room_name not in self.rooms:
-            self.rooms[room_name] = []
-        self.rooms[room_name].append(websocket)
-
-    def disconnect(self, room_name: str, websocket: WebSocket):
-        if room_name in self.rooms and websocket in self.rooms[room_name]:
-            self.rooms[room_name].remove(websocket)
-            if not self.rooms[room_name]:
-                del self.rooms[room_name]
-                if room_name in room_listeners:
-                    room_listeners[room_name].cancel()
-                    del room_listeners[room_name]
-
-    async def send_message(self, room_name: str, message: str):
-        if room_name in self.rooms:
-            for connection in self.rooms[room_name]:
-                try:
-                    await connection.send_text(message)
-                except Exception as e:
-                    print(f"Error sending message: {e}")
+        connection, created = self.registry.connect(room_name, websocket, client_name)
+        self.fanout.register(websocket)
+        return connection, created
+
+    async def disconnect(self, connection: Connection, broker: Optional[Broker]):
+        self.fanout.unregister(connection.websocket)
+        if self.registry.disconnect(connection):
+            room_name = connection.room.name
+            rate_limiter.forget(room_name)
+            if broker:
+                await broker.unsubscribe(room_name)
+
+    async def send_message(self, room_name: str, message: bytes):
+        # Only queues the encoded envelope; each client's writer task delivers it at that client's pace
+        room = self.registry.room(room_name)
+        if room is not None:
+            self.fanout.broadcast(room.live, message)
 
 
 manager = ConnectionManager()
 
 
-async def redis_listener(room_name: str, redis_client: redis.Redis):
-    pubsub = redis_client.pubsub()
-    await pubsub.subscribe(room_name)
-    try:
-        async for message in pubsub.listen():
-            if message.get("type") == "message":
-                data = message.get("data")
-                await manager.send_message(room_name, data)
-    except asyncio.CancelledError:
-        pass
-    except Exception as e:
-        print(f"Redis listener error in room {room_name}: {e}")
-    finally:
-        await pubsub.unsubscribe(room_name)
-        await pubsub.close()
+# Last sequence number per room when there is no Redis to count them (CHAT_BROKER=inprocess)
+local_seqs: Dict[str, int] = defaultdict(int)
 
 
-@app.websocket("/ws/{room_name}/{client_name}")
-async def websocket_endpoint(websocket: WebSocket, room_name: str, client_name: str):
-    redis_client: Optional[redis.Redis] = getattr(websocket.app.state, "redis_client", None)
+async def publish(broker: Broker, redis_client: Optional[redis.Redis], room_name: str, kind: int, body: str, sender: str = ""):
+    """Publish a message to a room as an envelope carrying the room's next sequence number.
+
+    Numbering and publishing are separate round trips, so concurrent senders may
+    publish slightly out of order; receivers order a room's messages by seq.
+    """
+    if redis_client is not None:
+        seq = await redis_client.incr(f"{SEQ_KEY_PREFIX}{room_name}")
+    else:
+        local_seqs[room_name] += 1
+        seq = local_seqs[room_name]
+    await broker.publish(room_name, Envelope(kind, room_name, body, sender, seq).encode())
+
+
+@app.get("/stats")
+async def get_stats():
+    """Counters of messages admitted and rejected by the rate limiter and published to the broker."""
+    broker = app.state.broker
+    return {
+        "rooms": len(manager.registry.rooms),
+        "connections": len(manager.registry),
+        "rate_limit": rate_limiter.stats.snapshot(),
+        "broker": {**broker.stats.snapshot(), "backend": broker.name, "channels": broker.channels},
+    }
+
 
-    is_new_room = room_name not in manager.rooms  # Check if this is a new room
+@app.get("/presence/{room_name}")
+async def get_presence(room_name: str):
+    """Who is connected to the room, on any server instance."""
+    members = await app.state.presence.members(room_name)
+    return {"room": room_name, "count": len(members), "members": members}
 
-    await manager.connect(room_name, websocket)
 
-    if redis_client and room_name not in room_listeners:
-        room_listeners[room_name] = asyncio.create_task(redis_listener(room_name, redis_client))
+@app.websocket("/ws/{room_name}/{client_name}")
+async def websocket_endpoint(websocket: WebSocket, room_name: str, client_name: str):
+    redis_client: Optional[redis.Redis] = getattr(websocket.app.state, "redis_client", None)
+    broker: Optional[Broker] = getattr(websocket.app.state, "broker", None)
+    presence: Optional[PresenceTracker] = getattr(websocket.app.state, "presence", None)
 
-    if is_new_room and redis_client:
-        create_message = json.dumps({"sender": "Server", "message": f"🟢 {client_name} created {room_name}"})
-        await redis_client.publish(room_name, create_message)
+    connection, first = await manager.connect(room_name, websocket, client_name)
 
-    join_message = json.dumps({"sender": "Server", "message": f"🔵 {client_name} joined {room_name}"})
-    if redis_client:
-        await redis_client.publish(room_name, join_message)
+    # Announced to the room with everyone else who joined or left in the same presence interval
+    if presence:
+        presence.join(room_name, client_name)
 
+    bucket = rate_limiter.connection()
+    # Whether the client was told it is sending too fast since its last accepted message
+    throttled = False
     try:
+        if first and broker:
+            # Subscribed while the room has clients on this instance
+            await broker.subscribe(room_name, lambda message: manager.send_message(room_name, message))
         while True:
-            data = await websocket.receive_text()
-            chat_message = json.dumps({"sender": client_name, "message": data})
-            if redis_client:
-                await redis_client.publish(room_name, chat_message)
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
+
+            rejected = rate_limiter.check(room_name, bucket, message_size(message))
+            if rejected == TOO_LARGE:
+                await websocket.close(code=CLOSE_TOO_BIG, reason="Message too large")
+                break
+            if rejected:
+                if not throttled:
+                    throttled = True
+                    notice = Envelope(EVENT, room_name, "❌ Too many messages, slow down. Messages are being dropped.")
+                    manager.fanout.send(websocket, notice.encode())
+                continue
+            throttled = False
+
+            data = message.get("text")
+            if data is None:
+                data = message["bytes"].decode("utf-8")
+            if broker:
+                await publish(broker, redis_client, room_name, MESSAGE, data, client_name)
     except WebSocketDisconnect:
-        manager.disconnect(room_name, websocket)
-        leave_message = json.dumps({"sender": "Server", "message": f"🔵 {client_name} left {room_name}"})
-        if redis_client:
-            await redis_client.publish(room_name, leave_message)
+        pass
     except Exception as e:
         print(f"Unexpected error in {room_name}: {e}")
-        manager.disconnect(room_name, websocket)
-        error_message = json.dumps({"sender": "Server", "message": f"🔴 {client_name} encountered an error in {room_name}"})
-        if redis_client:
-            await redis_client.publish(room_name, error_message)
+    finally:
+        await manager.disconnect(connection, broker)
+        if presence:
+            presence.leave(room_name, client_name)
 
 if __name__ == "__main__":
     import uvicorn